@@ -8,8 +8,11 @@ URL = os.getenv("API_URL")
 L = get_logger(__name__)
 L.debug(URL)
 
-def fetch_model(model_id: str, user_id: str):
-    model_r = requests.get(f"{URL}/model-detail/{model_id}?user_id={user_id}")
+def fetch_model(model_id: str, user_id: str, geometry: bool = True):
+    """Fetch a model from the API, without the geometry mesh unless `geometry` is set, `geometry_id` is always there."""
+    model_r = requests.get(
+        f"{URL}/model-detail/{model_id}", params={"user_id": user_id, "geometry": str(geometry).lower()}
+    )
     L.debug(model_r.status_code)
     L.debug(model_r.json())
 
@@ -2,29 +2,33 @@ import os
 import json
 import asyncio
 from types import FrameType
+from functools import partial
 from typing import Union, Any, Optional
 import signal
 from uuid import uuid4
 
 import tornado.ioloop
 import tornado.websocket
-from tornado.web import RequestHandler, Application, StaticFileHandler
+from tornado.http1connection import HTTP1Connection
+from tornado.web import RequestHandler, Application, StaticFileHandler, HTTPError, stream_request_body
 import sentry_sdk
 from sentry_sdk.integrations.tornado import TornadoIntegration
 
 from .utils import ExtendedJSONEncoder, umask
 from .sim_manager import SimManager, SimWorker
 from .db import Db
-from .geometry import create_geometry
+from .geometry import UPLOAD_ID_PATTERN, GeometryJobRunner, expire_uploads, prepare_geometry_dir, upload_path
 from .model_export import get_exported_model
 from .model_import import revision_from_excel
 from .viz import contact_map, reactivity_network
 from .sbml_to_bngl import sbml_to_bngl
 from .logger import get_logger
-from .envvars import SENTRY_DSN
+from .envvars import SENTRY_DSN, GEOMETRY_JOB_PROCESSES, TASK_PROCESSES, TASK_THREADS
+from .executor import TaskExecutor, TaskLimits
 from .api import fetch_model
+from .trace_store import read_trace, read_trace_window, iter_spatial_step_traces, remove_traces
 
-from .worker_message import SimWorkerMessage
+from .worker_message import SimWorkerMessage, decode_frame
 from .types import (
     SimConfig,
     Message,
@@ -33,6 +37,7 @@ from .types import (
     Simulation,
     UpdateSimulation,
     GetSimulations,
+    GetSimLogPage,
     GetExportedModel,
 )
 
@@ -50,6 +55,22 @@ L = get_logger(__name__)
 
 db = Db()
 sim_manager = SimManager(db)
+geometry_jobs = GeometryJobRunner(GEOMETRY_JOB_PROCESSES)
+
+GEOMETRY_UPLOAD_MAX_SIZE = 4 * 1024**3
+# Max number of points per observable of a stored trace sent when a client doesn't give a resolution
+TRACE_WINDOW_RESOLUTION = 2000
+GEOMETRY_UPLOAD_EXPIRY_INTERVAL_MS = 60 * 60 * 1000
+
+TASK_LIMITS = {
+    "fetch_model": TaskLimits(concurrency=TASK_THREADS, timeout=30, io_bound=True),
+    "contact_map": TaskLimits(concurrency=2, timeout=120),
+    "reactivity_network": TaskLimits(concurrency=2, timeout=300),
+    "export_model": TaskLimits(concurrency=2, timeout=120),
+    "sbml_to_bngl": TaskLimits(concurrency=2, timeout=60),
+    "revision_from_excel": TaskLimits(concurrency=2, timeout=60),
+}
+task_executor = TaskExecutor(TASK_LIMITS, TASK_PROCESSES, TASK_THREADS)
 
 
 class WSHandler(WebSocketHandler):
@@ -85,7 +106,12 @@ class WSHandler(WebSocketHandler):
             sim_conf = SimConfig(**msg.data)
             await sim_manager.schedule_sim(sim_conf)
 
-        if msg.cmd == "get_log":
+        if msg.cmd == "get_log" and isinstance(msg.data, dict):
+            page = GetSimLogPage(**msg.data)
+            sim_log_page = await db.get_sim_log_page(page.simId, page.source, page.offset, page.limit)
+            await self.send_message("logPage", sim_log_page, cmdid=msg.cmdid)
+
+        elif msg.cmd == "get_log":
             sim_id = msg.data
 
             self.validate_id(sim_id)
@@ -103,9 +129,16 @@ class WSHandler(WebSocketHandler):
             if sim_id in sim_manager.running_sim_ids:
                 await sim_manager.request_tmp_sim_trace(sim_id, msg.cmdid)
             else:
-                traces = db.db.simTraces.find({"simId": sim_id})
-                async for trace in traces:
-                    await self.send_message("simTrace", trace)
+                trace_window = await tornado.ioloop.IOLoop.current().run_in_executor(
+                    None, read_trace_window, sim_id, TRACE_WINDOW_RESOLUTION
+                )
+                if trace_window is not None:
+                    await self.send_message("trace_window", trace_window, cmdid=msg.cmdid)
+                else:
+                    # sims stored before the trace store only have trace documents
+                    traces = db.db.simTraces.find({"simId": sim_id})
+                    async for trace in traces:
+                        await self.send_message("simTrace", trace)
 
         if msg.cmd == "cancel_simulation":
             await sim_manager.cancel_sim(SimId(**msg.data))
@@ -125,12 +158,7 @@ class WSHandler(WebSocketHandler):
             await db.delete_sim_trace(sim)
             await db.delete_sim_log(sim)
 
-            for path in [
-                f"/data/spatial-traces/{sim.id}.json",
-                f"/data/straces/{sim.id}.json",
-            ]:
-                if os.path.exists(path):
-                    os.remove(path)
+            remove_traces(sim.id)
 
         if msg.cmd == "get_simulations":
             model_id = GetSimulations(**msg.data).modelId
@@ -140,26 +168,21 @@ class WSHandler(WebSocketHandler):
             await self.send_message("simulations", {"simulations": simulations}, cmdid=msg.cmdid)
 
         if msg.cmd == "create_geometry":
-            geometry_config = msg.data
-
-            id_ = str(uuid4())
-            structure_sizes = create_geometry(id_, geometry_config)
-
-            await self.send_message(
-                "geometry",
-                {"id": id_, "structureSize": structure_sizes},
-                cmdid=msg.cmdid,
-            )
+            asyncio.create_task(self.create_geometry(msg.data, msg.cmdid))
 
         if msg.cmd == "contact-map":
-            model = fetch_model(msg.data["model_id"], msg.data["user_id"])
-            cm = contact_map(model)
+            model = await task_executor.run(
+                "fetch_model", fetch_model, msg.data["model_id"], msg.data["user_id"], False
+            )
+            cm = await task_executor.run("contact_map", contact_map, model)
 
             await self.send_message("contact-map", cm)
 
         if msg.cmd == "reactivity-network":
-            model = fetch_model(msg.data["model_id"], msg.data["user_id"])
-            rn = reactivity_network(model)
+            model = await task_executor.run(
+                "fetch_model", fetch_model, msg.data["model_id"], msg.data["user_id"], False
+            )
+            rn = await task_executor.run("reactivity_network", reactivity_network, model)
             await self.send_message("reactivity-network", rn)
 
         if msg.cmd == "get_exported_model":
@@ -168,7 +191,9 @@ class WSHandler(WebSocketHandler):
             model = ""
             error_msg = ""
             try:
-                model = get_exported_model(model_data.model.dict(exclude_none=True), model_data.format)
+                model = await task_executor.run(
+                    "export_model", get_exported_model, model_data.model.dict(exclude_none=True), model_data.format
+                )
             except Exception as error:
                 L.warning("Model export error")
                 error_msg = error.args[0] if len(error.args) > 0 else "Model export error"
@@ -182,14 +207,15 @@ class WSHandler(WebSocketHandler):
         if msg.cmd == "convert_from_sbml":
             sbml = ""
             try:
-                sbml = sbml_to_bngl(msg.data["sbml"])
+                sbml = await task_executor.run("sbml_to_bngl", sbml_to_bngl, msg.data["sbml"])
             except (ValueError, KeyError) as e:
                 L.warning(f"Model import error {type(e)}: {e.args}")
 
             await self.send_message("from_sbml", sbml, cmdid=msg.cmdid)
 
         if msg.cmd == "revision_from_excel":
-            await self.send_message("revision_from_excel", revision_from_excel(msg.data), cmdid=msg.cmdid)
+            revision = await task_executor.run("revision_from_excel", revision_from_excel, msg.data)
+            await self.send_message("revision_from_excel", revision, cmdid=msg.cmdid)
 
         if msg.cmd == "query_molecular_repo":
             query = msg.data
@@ -231,11 +257,62 @@ class WSHandler(WebSocketHandler):
             spatial_step_trace = await db.get_spatial_step_trace(sim_id, step_idx)
             await self.send_message("spatial_step_trace", spatial_step_trace, cmdid=msg.cmdid)
 
+        if msg.cmd == "get_trace_window":
+            sim_id = msg.data["simId"]
+            self.validate_id(sim_id)
+
+            read_fn = partial(
+                read_trace_window,
+                sim_id,
+                int(msg.data["resolution"]),
+                msg.data.get("observables"),
+                msg.data.get("tStart"),
+                msg.data.get("tEnd"),
+            )
+            trace_window = await tornado.ioloop.IOLoop.current().run_in_executor(None, read_fn)
+            await self.send_message("trace_window", trace_window, cmdid=msg.cmdid)
+
+        if msg.cmd == "subscribe_spatial_trace":
+            sim_id = msg.data["simId"]
+            self.validate_id(sim_id)
+            sim_manager.subscribe_spatial_trace(self, sim_id, msg.data.get("fps"), msg.data.get("stride") or 1)
+
+        if msg.cmd == "unsubscribe_spatial_trace":
+            sim_id = msg.data["simId"]
+            self.validate_id(sim_id)
+            sim_manager.unsubscribe_spatial_trace(self, sim_id)
+
         if msg.cmd == "get_last_spatial_step_trace_idx":
             sim_id = msg.data["simId"]
             step_idx = await db.get_last_spatial_step_trace_idx(sim_id)
             await self.send_message("last_spatial_step_trace_idx", step_idx, cmdid=msg.cmdid)
 
+    async def create_geometry(self, geometry_config: dict, cmdid: Optional[int]) -> None:
+        """Create a geometry from TetGen files uploaded with `GeometryUploadHandler` or given as raw text.
+
+        Geometry creation runs as a job, `geometryProgress` messages are sent while it's running
+        and the `geometry` response with structure sizes or an error when it's done.
+        """
+        id_ = str(uuid4())
+        meta = geometry_config["meta"]
+        upload_id = geometry_config.get("uploadId")
+        raw = None if upload_id is not None else geometry_config["mesh"]["volume"]["raw"]
+
+        async def send_progress(stage: str, progress: float) -> None:
+            await self.send_message("geometryProgress", {"id": id_, "stage": stage, "progress": progress})
+
+        try:
+            io_loop = tornado.ioloop.IOLoop.current()
+            await io_loop.run_in_executor(None, partial(prepare_geometry_dir, id_, meta, upload_id=upload_id, raw=raw))
+            structure_sizes = await geometry_jobs.run(id_, meta, send_progress)
+        except Exception as error:
+            L.warning(f"geometry {id_} creation has failed")
+            L.exception(error)
+            await self.send_message("geometry", {"id": id_, "error": str(error)}, cmdid=cmdid)
+            return
+
+        await self.send_message("geometry", {"id": id_, "structureSize": structure_sizes}, cmdid=cmdid)
+
     def on_close(self) -> None:
         self.closed = True
         if self.user_id is not None:
@@ -270,7 +347,8 @@ class SimRunnerWSHandler(WebSocketHandler):
 
     # pylint: disable=invalid-overridden-method
     async def on_message(self, rawMessage: Union[str, bytes]) -> None:
-        msg = SimWorkerMessage(**json.loads(rawMessage))
+        raw_msg_dict = decode_frame(rawMessage) if isinstance(rawMessage, bytes) else json.loads(rawMessage)
+        msg = SimWorkerMessage(**raw_msg_dict)
         await sim_manager.process_worker_message(self.sim_worker, msg)
 
     def on_close(self) -> None:
@@ -339,17 +417,135 @@ class CreateSimHandler(RequestHandler):
 
 
 class GetSimTracesHandler(RequestHandler):
+    """Serve the trace of a simulation as a list of trace chunks.
+
+    Stored traces are read from the trace store as a single chunk, downsampled as by `read_trace_window`
+    with the `resolution` argument. Traces of sims stored before the trace store are read from the db.
+    """
+
     async def get(self) -> None:
         sim_id = self.get_argument("sim_id")
-        traces = await db.get_sim_trace(sim_id)
+        resolution = self.get_argument("resolution", None)
+
+        try:
+            if resolution is None:
+                read_fn = partial(read_trace, sim_id)
+            else:
+                read_fn = partial(read_trace_window, sim_id, int(resolution))
+
+            trace = await tornado.ioloop.IOLoop.current().run_in_executor(None, read_fn)
+        except ValueError as error:
+            raise HTTPError(400, str(error)) from error
+
+        traces = [{"simId": sim_id, "index": 0, **trace}] if trace is not None else await db.get_sim_trace(sim_id)
         self.write(json.dumps(traces, cls=ExtendedJSONEncoder))
 
 
+class TraceHandler(RequestHandler):
+    """Serve a stored trace, optionally limited to given observables and time window.
+
+    With the `resolution` argument at most that many points per observable are returned, as min/max
+    bins when the window has more rows, see `read_trace_window`.
+    Raw trace columns are also available with HTTP range requests via /data/traces/{sim_id}/.
+    """
+
+    async def get(self, sim_id: str) -> None:
+        observables = self.get_arguments("observable") or None
+        t_start = self.get_argument("t_start", None)
+        t_end = self.get_argument("t_end", None)
+        resolution = self.get_argument("resolution", None)
+
+        try:
+            t_start_value = None if t_start is None else float(t_start)
+            t_end_value = None if t_end is None else float(t_end)
+
+            if resolution is None:
+                read_fn = partial(read_trace, sim_id, observables, t_start_value, t_end_value)
+            else:
+                read_fn = partial(read_trace_window, sim_id, int(resolution), observables, t_start_value, t_end_value)
+
+            trace = await tornado.ioloop.IOLoop.current().run_in_executor(None, read_fn)
+        except ValueError as error:
+            raise HTTPError(400, str(error)) from error
+
+        if trace is None:
+            raise HTTPError(404)
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(trace, cls=ExtendedJSONEncoder))
+
+
+class SpatialTraceHandler(RequestHandler):
+    """Stream all spatial step traces of a simulation as a JSON array."""
+
+    async def get(self, sim_id: str) -> None:
+        self.set_header("Content-Type", "application/json")
+        self.write("[")
+
+        spatial_step_traces = iter_spatial_step_traces(sim_id)
+        io_loop = tornado.ioloop.IOLoop.current()
+        lead_char = ""
+
+        while True:
+            spatial_step_trace = await io_loop.run_in_executor(None, next, spatial_step_traces, None)
+            if spatial_step_trace is None:
+                break
+
+            self.write(lead_char + json.dumps(spatial_step_trace, cls=ExtendedJSONEncoder))
+            lead_char = ", "
+            await self.flush()
+
+        self.write("]")
+
+
+@stream_request_body
+class GeometryUploadHandler(RequestHandler):
+    """Stream a TetGen file of a new geometry to disk, the upload id is then given to `create_geometry`."""
+
+    def prepare(self) -> None:
+        upload_id, tetgen_type = self.path_args
+
+        try:
+            path = upload_path(upload_id, tetgen_type)
+        except ValueError as error:
+            raise HTTPError(400, str(error)) from error
+
+        assert isinstance(self.request.connection, HTTP1Connection)
+        self.request.connection.set_max_body_size(GEOMETRY_UPLOAD_MAX_SIZE)
+
+        with umask():
+            os.makedirs(os.path.dirname(path), 0o777, exist_ok=True)
+
+        self.path = path
+        self.file = open(path, "wb")  # pylint: disable=consider-using-with
+
+    def data_received(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+
+    def put(self, upload_id: str, tetgen_type: str) -> None:  # pylint: disable=unused-argument
+        self.file.close()
+        self.write({"uploadId": upload_id})
+
+    def on_connection_close(self) -> None:
+        if hasattr(self, "file") and not self.file.closed:
+            self.file.close()
+            os.remove(self.path)
+
+
+async def expire_geometry_uploads() -> None:
+    await tornado.ioloop.IOLoop.current().run_in_executor(None, expire_uploads)
+
+
 class HealthHandler(RequestHandler):
     def get(self) -> None:
         self.write("ok")
 
 
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.write({"dbSimWriteBuffer": db.sim_write_buffer_metrics, "tasks": task_executor.metrics})
+
+
 def on_terminate(signum: int, frame: FrameType):  # pylint: disable=unused-argument
     L.debug("received shutdown signal")
     tornado.ioloop.IOLoop.current().stop()
@@ -372,6 +568,7 @@ app = Application(
         ("/ws", WSHandler),
         ("/sim", SimRunnerWSHandler),
         ("/api/health", HealthHandler),
+        ("/api/metrics", MetricsHandler),
         (
             "/data/spatial-traces/(.*)",
             StaticFileHandler,
@@ -386,7 +583,10 @@ app = Application(
         ("/api/run_sim", RunSimulationHandler),
         ("/api/create_sim", CreateSimHandler),
         ("/api/get_sim_traces", GetSimTracesHandler),
+        (r"/api/traces/([\w-]+)", TraceHandler),
+        (r"/api/spatial-traces/([\w-]+)", SpatialTraceHandler),
         ("/api/models", ModelsHandler),
+        (rf"/api/geometry-uploads/({UPLOAD_ID_PATTERN})/(\w+)", GeometryUploadHandler),
     ],
     debug=os.getenv("DEBUG", None) or False,
     websocket_max_message_size=100 * 1024 * 1024,
@@ -402,4 +602,5 @@ app.listen(8000)
 
 loop = tornado.ioloop.IOLoop.current()
 loop.run_sync(db.create_indexes)
+tornado.ioloop.PeriodicCallback(expire_geometry_uploads, GEOMETRY_UPLOAD_EXPIRY_INTERVAL_MS).start()
 loop.start()
@@ -1,9 +1,11 @@
 import re
+import time
 import asyncio
+from typing import Dict, List, Optional
 
 import pymongo
 import wrapt
-from pymongo.errors import ConfigurationError, AutoReconnect
+from pymongo.errors import ConfigurationError, AutoReconnect, BulkWriteError
 from motor.motor_asyncio import AsyncIOMotorClient
 from sentry_sdk import capture_message
 
@@ -11,6 +13,10 @@ from .model_to_bngl import ENTITY_TYPES
 from .logger import get_logger, log_many
 from .envvars import MONGO_URI, DB_HOST, DB_PASSWORD
 from .types import SimId, Simulation, UpdateSimulation
+from .utils import ndarrays_to_lists
+from .spatial_encoding import decode_steps
+from .sim import SimLogBatch
+from .sim_log import compress_lines, decompress_lines, SIM_LOG_TAIL_LINES
 
 L = get_logger(__name__)
 
@@ -18,6 +24,14 @@ L = get_logger(__name__)
 L.debug(f"Using mongo host: {DB_HOST}")
 
 
+# Buffered simulation writes are flushed when a buffer reaches this number of documents
+SIM_WRITE_BUFFER_MAX_SIZE = 200
+# or when the oldest buffered write is older than this number of seconds
+SIM_WRITE_BUFFER_MAX_AGE = 1
+# Max number of lines of a requested page of a sim log
+SIM_LOG_PAGE_MAX_LINES = 10000
+
+
 mol_def_r = re.compile(r"([a-zA-Z][a-zA-Z_0-9]*)\(")
 st_def_r = re.compile("@([a-zA-Z][a-zA-Z_0-9]*)")
 param_def_r = re.compile("([a-zA-Z][a-zA-Z_0-9]*)")
@@ -81,6 +95,21 @@ async def mongo_autoreconnect(wrapped, instance, args, kwargs):  # pylint: disab
     log_many("Can't connect to mongodb", L.error, capture_message)
 
 
+class SimWriteBuffer:
+    """Pending writes of a single simulation."""
+
+    def __init__(self) -> None:
+        self.sim_traces: List[dict] = []
+        self.spatial_step_traces: List[dict] = []
+        self.log_chunks: List[dict] = []
+        self.progress: Optional[UpdateSimulation] = None
+        self.created_at = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.sim_traces) + len(self.spatial_step_traces) + len(self.log_chunks) + (self.progress is not None)
+
+
 class Db:
     def __init__(self):
         uri = f"mongodb://admin:{DB_PASSWORD}@{DB_HOST}:27017/" if DB_PASSWORD else f"mongodb://{DB_HOST}:27017/"
@@ -95,6 +124,16 @@ class Db:
 
         self.db = self.mongo_client[MONGO_URI]
 
+        self.sim_write_buffers: Dict[str, SimWriteBuffer] = {}
+        self.sim_write_flush_task: Optional[asyncio.Task] = None
+        self.sim_write_metrics = {
+            "flushes": 0,
+            "flushedDocs": 0,
+            "lastFlushLatency": 0.0,
+            "maxFlushLatency": 0.0,
+            "totalFlushLatency": 0.0,
+        }
+
     def create_indexes(self):
         asyncio.create_task(self._create_indexes())
 
@@ -127,12 +166,26 @@ class Db:
 
         await self.db.simLogs.create_index([("simId", pymongo.ASCENDING)], unique=True, background=True)
 
+        await self.db.simLogChunks.create_index(
+            [
+                ("simId", pymongo.ASCENDING),
+                ("source", pymongo.ASCENDING),
+                ("firstLine", pymongo.ASCENDING),
+            ],
+            unique=True,
+            background=True,
+        )
+
         L.debug("Created db indexes")
 
     @mongo_autoreconnect
     async def create_simulation(self, simulation: Simulation):
         await self.db.simulations.insert_one({**simulation.dict(), "deleted": False})
 
+    @mongo_autoreconnect
+    async def get_model(self, model_id: str) -> Optional[dict]:
+        return await self.db.models.find_one({"_id": model_id})
+
     @mongo_autoreconnect
     async def get_simulations(self, user_id: str, model_id: str):
         return await self.db.simulations.find({"userId": user_id, "modelId": model_id, "deleted": False}).to_list(None)
@@ -146,43 +199,210 @@ class Db:
 
     @mongo_autoreconnect
     async def create_sim_spatial_step_trace(self, spatial_step_trace: dict) -> None:
-        await self.db.simSpatialStepTraces.insert_one(spatial_step_trace)
+        await self.db.simSpatialStepTraces.insert_one(ndarrays_to_lists(spatial_step_trace))
 
     @mongo_autoreconnect
     async def create_sim_trace(self, sim_trace: dict) -> None:
-        await self.db.simTraces.insert_one(sim_trace)
+        await self.db.simTraces.insert_one(ndarrays_to_lists(sim_trace))
 
     @mongo_autoreconnect
     async def get_sim_trace(self, sim_id: str) -> None:
+        await self.flush_sim_writes(sim_id)
         return await self.db.simTraces.find({"simId": sim_id}).to_list(None)
 
+    def get_sim_write_buffer(self, sim_id: str) -> SimWriteBuffer:
+        if self.sim_write_flush_task is None or self.sim_write_flush_task.done():
+            self.sim_write_flush_task = asyncio.create_task(self.flush_stale_sim_writes())
+
+        if sim_id not in self.sim_write_buffers:
+            self.sim_write_buffers[sim_id] = SimWriteBuffer()
+
+        return self.sim_write_buffers[sim_id]
+
+    async def buffer_sim_trace(self, sim_id: str, sim_trace: dict) -> None:
+        buffer = self.get_sim_write_buffer(sim_id)
+        buffer.sim_traces.append(ndarrays_to_lists(sim_trace))
+        if buffer.size >= SIM_WRITE_BUFFER_MAX_SIZE:
+            await self.flush_sim_writes(sim_id)
+
+    async def buffer_sim_spatial_step_trace(self, sim_id: str, spatial_step_trace: dict) -> None:
+        buffer = self.get_sim_write_buffer(sim_id)
+        buffer.spatial_step_traces.append(ndarrays_to_lists(spatial_step_trace))
+        if buffer.size >= SIM_WRITE_BUFFER_MAX_SIZE:
+            await self.flush_sim_writes(sim_id)
+
+    async def buffer_sim_log_batch(self, sim_id: str, user_id: str, batch: SimLogBatch) -> None:
+        """Buffer lines of a log batch as a compressed chunk per source."""
+        buffer = self.get_sim_write_buffer(sim_id)
+        for source, lines in batch.lines.items():
+            first_line = batch.firstLine[source]
+            buffer.log_chunks.append(
+                {
+                    "simId": sim_id,
+                    "userId": user_id,
+                    "source": source,
+                    "firstLine": first_line,
+                    "endLine": first_line + len(lines),
+                    "data": compress_lines(lines),
+                }
+            )
+        if buffer.size >= SIM_WRITE_BUFFER_MAX_SIZE:
+            await self.flush_sim_writes(sim_id)
+
+    async def buffer_sim_progress(self, simulation: UpdateSimulation) -> None:
+        """Buffer a progress update, only the latest one is written to the db."""
+        if simulation.id is None:
+            raise ValueError("Simulation id is required to buffer its progress")
+
+        self.get_sim_write_buffer(simulation.id).progress = simulation
+
+    async def flush_sim_writes(self, sim_id: str) -> None:
+        buffer = self.sim_write_buffers.pop(sim_id, None)
+        if buffer is None or buffer.size == 0:
+            return
+
+        t_start = time.monotonic()
+        await self.write_sim_buffer(buffer)
+        latency = time.monotonic() - t_start
+
+        metrics = self.sim_write_metrics
+        metrics["flushes"] += 1
+        metrics["flushedDocs"] += buffer.size
+        metrics["lastFlushLatency"] = latency
+        metrics["maxFlushLatency"] = max(metrics["maxFlushLatency"], latency)
+        metrics["totalFlushLatency"] += latency
+
+    async def flush_stale_sim_writes(self) -> None:
+        while self.sim_write_buffers:
+            await asyncio.sleep(SIM_WRITE_BUFFER_MAX_AGE)
+            now = time.monotonic()
+            stale_sim_ids = [
+                sim_id
+                for sim_id, buffer in self.sim_write_buffers.items()
+                if now - buffer.created_at >= SIM_WRITE_BUFFER_MAX_AGE
+            ]
+            for sim_id in stale_sim_ids:
+                try:
+                    await self.flush_sim_writes(sim_id)
+                except Exception as error:
+                    L.exception(error)
+
+    @mongo_autoreconnect
+    async def write_sim_buffer(self, buffer: SimWriteBuffer) -> None:
+        try:
+            if buffer.sim_traces:
+                await self.db.simTraces.insert_many(buffer.sim_traces, ordered=False)
+            if buffer.spatial_step_traces:
+                await self.db.simSpatialStepTraces.insert_many(buffer.spatial_step_traces, ordered=False)
+            if buffer.log_chunks:
+                await self.db.simLogChunks.insert_many(buffer.log_chunks, ordered=False)
+        except BulkWriteError as error:
+            L.warning(f"Failed to insert some of buffered sim traces: {error.details.get('writeErrors')}")
+
+        if buffer.progress is not None:
+            await self.update_simulation(buffer.progress)
+
+    @property
+    def sim_write_buffer_metrics(self) -> dict:
+        flushes = self.sim_write_metrics["flushes"]
+        return {
+            **self.sim_write_metrics,
+            "avgFlushLatency": self.sim_write_metrics["totalFlushLatency"] / flushes if flushes else 0.0,
+            "bufferedSims": len(self.sim_write_buffers),
+            "queueDepth": sum(buffer.size for buffer in self.sim_write_buffers.values()),
+        }
+
     @mongo_autoreconnect
     async def delete_sim_trace(self, simulation: SimId):
         await self.db.simTraces.delete_many({"simId": simulation.id})
 
     @mongo_autoreconnect
-    async def create_sim_log(self, sim_log):
-        await self.db.simLogs.insert_one(sim_log)
+    async def get_sim_log(self, sim_id: str, tail_lines: int = SIM_LOG_TAIL_LINES) -> dict:
+        """Last lines of every log source of a sim and total numbers of lines."""
+        await self.flush_sim_writes(sim_id)
+
+        log: Dict[str, List[str]] = {}
+        total_lines: Dict[str, int] = {}
+
+        for source in await self.db.simLogChunks.distinct("source", {"simId": sim_id}):
+            chunks = self.db.simLogChunks.find({"simId": sim_id, "source": source}).sort("firstLine", -1)
+            lines: List[str] = []
+            async for chunk in chunks:
+                total_lines.setdefault(source, chunk["endLine"])
+                lines = decompress_lines(chunk["data"]) + lines
+                if len(lines) >= tail_lines:
+                    break
+            log[source] = lines[-tail_lines:]
+
+        if not log:
+            # logs stored as a single document before they were chunked
+            legacy_sim_log = await self.db.simLogs.find_one({"simId": sim_id})
+            if legacy_sim_log is not None:
+                log = legacy_sim_log["log"]
+                total_lines = {source: len(lines) for source, lines in log.items()}
+
+        return {"simId": sim_id, "log": log, "totalLines": total_lines}
 
     @mongo_autoreconnect
-    async def get_sim_log(self, sim_id):
-        return await self.db.simLogs.find_one({"simId": sim_id})
+    async def get_sim_log_page(self, sim_id: str, source: str, offset: int, limit: int) -> dict:
+        """Lines [offset, offset + limit) of a log source of a sim."""
+        await self.flush_sim_writes(sim_id)
+
+        offset = max(offset, 0)
+        limit = min(max(limit, 0), SIM_LOG_PAGE_MAX_LINES)
+
+        query: dict = {"simId": sim_id, "source": source}
+        last_chunk = await self.db.simLogChunks.find_one(query, sort=[("firstLine", -1)])
+        total_lines = last_chunk["endLine"] if last_chunk is not None else 0
+
+        chunks = self.db.simLogChunks.find(
+            {**query, "firstLine": {"$lt": offset + limit}, "endLine": {"$gt": offset}}
+        ).sort("firstLine", 1)
+
+        lines: List[str] = []
+        async for chunk in chunks:
+            chunk_lines = decompress_lines(chunk["data"])
+            start = max(offset - chunk["firstLine"], 0)
+            end = min(offset + limit - chunk["firstLine"], len(chunk_lines))
+            lines.extend(chunk_lines[start:end])
+
+        return {"simId": sim_id, "source": source, "offset": offset, "lines": lines, "totalLines": total_lines}
 
     @mongo_autoreconnect
     async def delete_sim_log(self, simulation: SimId):
+        self.sim_write_buffers.pop(simulation.id, None)
         await self.db.simLogs.delete_many({"simId": simulation.id})
+        await self.db.simLogChunks.delete_many({"simId": simulation.id})
 
     @mongo_autoreconnect
     async def get_spatial_step_trace(self, sim_id, step_idx):
-        return await self.db.simSpatialStepTraces.find_one(
-            {
-                "simId": sim_id,
-                "stepIdx": step_idx,
-            }
-        )
+        """Get a full step, delta steps are reconstructed from the nearest preceding keyframe."""
+        await self.flush_sim_writes(sim_id)
+
+        # Steps stored before keyframes were introduced don't have the flag and are all full steps
+        keyframes = await self.db.simSpatialStepTraces.find(
+            {"simId": sim_id, "stepIdx": {"$lte": step_idx}, "keyframe": {"$ne": False}},
+            projection=["stepIdx"],
+            sort=[("stepIdx", pymongo.DESCENDING)],
+            limit=1,
+        ).to_list(None)
+
+        if len(keyframes) == 0:
+            return None
+
+        steps = await self.db.simSpatialStepTraces.find(
+            {"simId": sim_id, "stepIdx": {"$gte": keyframes[0]["stepIdx"], "$lte": step_idx}},
+            sort=[("stepIdx", pymongo.ASCENDING)],
+        ).to_list(None)
+
+        if steps[-1]["stepIdx"] != step_idx:
+            return None
+
+        return {**steps[-1], "data": decode_steps(steps), "keyframe": True}
 
     @mongo_autoreconnect
     async def get_last_spatial_step_trace_idx(self, sim_id):
+        await self.flush_sim_writes(sim_id)
         spatial_step_traces = await self.db.simSpatialStepTraces.find(
             {"simId": sim_id},
             projection=["stepIdx"],
@@ -0,0 +1,379 @@
+import itertools
+import warnings
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .types import SimConfig
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+# Number of member values kept per time point and observable to estimate quantiles
+RESERVOIR_SIZE = 64
+DEFAULT_BASE_SEED = 654
+
+
+def member_id(ensemble_id: str, member_idx: int) -> str:
+    return f"{ensemble_id}-m{member_idx}"
+
+
+def expand_ensemble(sim_conf: SimConfig) -> List[SimConfig]:
+    """Create configs of all member runs of an ensemble.
+
+    Every replicate has its own seed, the same seeds are used at every grid point so that differences
+    between grid points don't come from different random streams.
+    """
+    spec = sim_conf.ensemble
+    if spec is None:
+        raise ValueError("Sim config doesn't describe an ensemble")
+
+    if spec.replicates < 1:
+        raise ValueError("Number of replicates should be positive")
+
+    if spec.seeds is not None and len(spec.seeds) != spec.replicates:
+        raise ValueError("Number of seeds should match number of replicates")
+
+    base_seed = sim_conf.solverConf.get("seed", DEFAULT_BASE_SEED)
+    seeds = spec.seeds if spec.seeds is not None else [base_seed + idx for idx in range(spec.replicates)]
+
+    param_names = list(spec.paramGrid)
+    grid_points = list(itertools.product(*[spec.paramGrid[name] for name in param_names]))
+
+    members: List[SimConfig] = []
+    for grid_point in grid_points:
+        for seed in seeds:
+            member_idx = len(members)
+            members.append(
+                sim_conf.copy(
+                    deep=True,
+                    update={
+                        "id": member_id(sim_conf.id, member_idx),
+                        "ensemble": None,
+                        "ensembleId": sim_conf.id,
+                        "ensembleIdx": member_idx,
+                        "paramOverrides": dict(zip(param_names, grid_point)),
+                        "solverConf": {
+                            **sim_conf.solverConf,
+                            "seed": seed,
+                            "spatialSampling": {"enabled": False},
+                        },
+                    },
+                )
+            )
+
+    return members
+
+
+def grow_rows(array: np.ndarray, shape: Tuple[int, ...]) -> np.ndarray:
+    """Copy of an array with more rows, new rows are zeros."""
+    grown = np.zeros(shape, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def quantile_label(quantile: float) -> str:
+    return f"q{quantile * 100:g}"
+
+
+def grid_point_label(param_overrides: Dict[str, float]) -> str:
+    """Label of a point of the parameter grid, e.g. `kf=0.1,kr=2`, empty for an ensemble of replicates only."""
+    return ",".join(f"{name}={value:g}" for name, value in param_overrides.items())
+
+
+class EnsembleAggregator:
+    """Running summary statistics of member traces, aligned by row index.
+
+    Mean and standard deviation are exact (Welford's algorithm). Quantiles are estimated from a
+    uniform reservoir sample of at most RESERVOIR_SIZE member values for every row and observable,
+    so memory doesn't grow with the number of members. The reservoir is no larger than the number
+    of members and isn't allocated at all when no quantiles are requested.
+    """
+
+    def __init__(
+        self,
+        quantiles: List[float],
+        n_members: Optional[int] = None,
+        reservoir_size: int = RESERVOIR_SIZE,
+        seed: int = 0,
+    ) -> None:
+        self.quantiles = quantiles
+        if not quantiles:
+            reservoir_size = 0
+        elif n_members is not None:
+            reservoir_size = min(reservoir_size, n_members)
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+
+        self.observables: Optional[List[str]] = None
+        self.length = 0
+        self.times = np.zeros(0)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, 0))
+        self.m2 = np.zeros((0, 0))
+        self.reservoir = np.zeros((0, 0, reservoir_size))
+
+    def ensure_rows(self, n_rows: int) -> None:
+        if n_rows <= len(self.count):
+            return
+
+        capacity = max(n_rows, 2 * len(self.count), 1024)
+        n_observables = len(self.observables or [])
+
+        self.times = grow_rows(self.times, (capacity,))
+        self.count = grow_rows(self.count, (capacity,))
+        self.mean = grow_rows(self.mean, (capacity, n_observables))
+        self.m2 = grow_rows(self.m2, (capacity, n_observables))
+        self.reservoir = grow_rows(self.reservoir, (capacity, n_observables, self.reservoir_size))
+
+    def pad(self, length: int) -> None:
+        """Extend the summary to `length` rows, rows no member has reached have no values."""
+        if self.observables is None:
+            return
+
+        self.ensure_rows(length)
+        self.length = max(self.length, length)
+
+    def add(
+        self,
+        index: int,
+        times: Union[np.ndarray, List[float]],
+        values_by_observable: Dict[str, Union[np.ndarray, List[float]]],
+    ) -> None:
+        """Add a chunk of rows of one member trace, starting at row `index`."""
+        if self.observables is None:
+            self.observables = list(values_by_observable)
+            self.mean = np.zeros((0, len(self.observables)))
+            self.m2 = np.zeros((0, len(self.observables)))
+            self.reservoir = np.zeros((0, len(self.observables), self.reservoir_size))
+
+        times = np.asarray(times, dtype=np.float64)
+        n_rows = len(times)
+        if n_rows == 0:
+            return
+
+        values = np.column_stack(
+            [np.asarray(values_by_observable[name], dtype=np.float64) for name in self.observables]
+        )
+
+        self.ensure_rows(index + n_rows)
+        rows = np.arange(index, index + n_rows)
+        self.length = max(self.length, index + n_rows)
+        self.times[rows] = times
+
+        self.count[rows] += 1
+        count = self.count[rows]
+
+        delta = values - self.mean[rows]
+        self.mean[rows] += delta / count[:, np.newaxis]
+        self.m2[rows] += delta * (values - self.mean[rows])
+
+        if not self.reservoir_size:
+            return
+
+        # reservoir sampling: the n-th value of a row replaces a random kept one with probability K/n
+        slots = np.where(count <= self.reservoir_size, count - 1, self.rng.integers(0, count))
+        kept = slots < self.reservoir_size
+        self.reservoir[rows[kept], :, slots[kept]] = values[kept]
+
+    def summary(self, start: int = 0, end: Optional[int] = None) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Summary traces of rows [start, end): mean, std and quantiles of every observable."""
+        end = self.length if end is None else min(end, self.length)
+        rows = slice(start, end)
+        count = self.count[rows]
+
+        std = np.sqrt(self.m2[rows] / np.maximum(count - 1, 1)[:, np.newaxis])
+
+        quantile_values = None
+        if self.reservoir_size and end > start:
+            samples = self.reservoir[rows].copy()
+            missing = np.arange(self.reservoir_size) >= np.minimum(count, self.reservoir_size)[:, np.newaxis]
+            samples[np.broadcast_to(missing[:, np.newaxis, :], samples.shape)] = np.nan
+            # rows no member has reached have only missing values
+            with np.errstate(all="ignore"), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                quantile_values = np.nanquantile(samples, self.quantiles, axis=2)
+
+        values_by_observable: Dict[str, np.ndarray] = {}
+        for obs_idx, name in enumerate(self.observables or []):
+            values_by_observable[f"{name}:mean"] = self.mean[rows, obs_idx]
+            values_by_observable[f"{name}:std"] = std[:, obs_idx]
+            for quantile_idx, quantile in enumerate(self.quantiles):
+                label = f"{name}:{quantile_label(quantile)}"
+                if quantile_values is None:
+                    values_by_observable[label] = np.zeros(0)
+                else:
+                    values_by_observable[label] = quantile_values[quantile_idx, :, obs_idx]
+
+        return self.times[rows], values_by_observable
+
+
+class Ensemble:
+    """State of a running ensemble job.
+
+    Replicates at the same point of the parameter grid are aggregated together, summary traces of every
+    grid point are stored as columns of the ensemble trace labeled with the grid point, e.g. `A:mean[kf=0.1]`.
+    """
+
+    def __init__(self, sim_conf: SimConfig, members: List[SimConfig]) -> None:
+        self.sim_conf = sim_conf
+        self.member_ids = [member.id for member in members]
+        self.progress_by_member: Dict[str, float] = {member.id: 0 for member in members}
+        self.status_by_member: Dict[str, str] = {}
+        self.started = False
+
+        quantiles = sim_conf.ensemble.quantiles if sim_conf.ensemble else []
+        self.grid_point_by_member = {member.id: grid_point_label(member.paramOverrides or {}) for member in members}
+        n_members_by_grid_point = Counter(self.grid_point_by_member.values())
+        self.aggregator_by_grid_point = {
+            grid_point: EnsembleAggregator(quantiles, n_members)
+            for grid_point, n_members in n_members_by_grid_point.items()
+        }
+
+    def add_trace(
+        self,
+        member_id: str,
+        index: int,
+        times: Union[np.ndarray, List[float]],
+        values_by_observable: Dict[str, Union[np.ndarray, List[float]]],
+    ) -> None:
+        """Add a chunk of rows of a member trace to the summary of its grid point."""
+        self.aggregator_by_grid_point[self.grid_point_by_member[member_id]].add(index, times, values_by_observable)
+
+    @property
+    def length(self) -> int:
+        return max((aggregator.length for aggregator in self.aggregator_by_grid_point.values()), default=0)
+
+    def summary(self, start: int, end: int) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Summary traces of rows [start, end) of every grid point, see `EnsembleAggregator.summary`."""
+        length = self.length
+        times = np.zeros(max(min(end, length) - start, 0))
+        values_by_observable: Dict[str, np.ndarray] = {}
+
+        for grid_point, aggregator in self.aggregator_by_grid_point.items():
+            # grid points whose runs have all failed early have fewer rows
+            aggregator.pad(length)
+            if aggregator.observables is None:
+                continue
+
+            grid_point_times, grid_point_values = aggregator.summary(start, end)
+            # members share the time points, rows no member of a grid point has reached have zero time
+            times = np.maximum(times, grid_point_times)
+            for label, values in grid_point_values.items():
+                values_by_observable[f"{label}[{grid_point}]" if grid_point else label] = values
+
+        return times, values_by_observable
+
+    @property
+    def progress(self) -> float:
+        return sum(self.progress_by_member.values()) / max(len(self.member_ids), 1)
+
+    @property
+    def done(self) -> bool:
+        return len(self.status_by_member) == len(self.member_ids)
+
+    @property
+    def n_finished(self) -> int:
+        return sum(1 for status in self.status_by_member.values() if status == "finished")
+
+
+class ReplicateTraceMerger:
+    """Merge traces of replicates of one sim into rows with values of every replicate, their mean and std.
+
+    Replicates run at their own pace, a row is complete once all replicates have reached it. Values are
+    kept in arrays of (rows, replicates, observables) grown like those of `EnsembleAggregator`, as rows
+    of the first replicates may wait for replicates which haven't started yet. Rows which have been
+    popped are dropped from the arrays, which only hold rows from `offset` on.
+    """
+
+    def __init__(self, n_replicates: int) -> None:
+        self.n_replicates = n_replicates
+        self.observables: Optional[List[str]] = None
+        self.length = 0
+        self.times = np.zeros(0)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros((0, n_replicates, 0))
+        self.next_index = 0
+        self.offset = 0
+
+    def ensure_rows(self, n_rows: int) -> None:
+        n_rows -= self.offset
+        if n_rows <= len(self.count):
+            return
+
+        capacity = max(n_rows, 2 * len(self.count), 1024)
+
+        self.times = grow_rows(self.times, (capacity,))
+        self.count = grow_rows(self.count, (capacity,))
+        self.values = grow_rows(self.values, (capacity, self.n_replicates, len(self.observables or [])))
+
+    def add(
+        self,
+        replicate_idx: int,
+        index: int,
+        times: Union[np.ndarray, List[float]],
+        values_by_observable: Dict[str, Union[np.ndarray, List[float]]],
+    ) -> None:
+        if self.observables is None:
+            self.observables = list(values_by_observable)
+            self.values = np.zeros((0, self.n_replicates, len(self.observables)))
+
+        times = np.asarray(times, dtype=np.float64)
+        n_rows = len(times)
+        if n_rows == 0:
+            return
+
+        self.ensure_rows(index + n_rows)
+        rows = slice(index - self.offset, index + n_rows - self.offset)
+        self.length = max(self.length, index + n_rows)
+
+        self.times[rows] = times
+        for obs_idx, name in enumerate(self.observables):
+            self.values[rows, replicate_idx, obs_idx] = values_by_observable[name]
+        self.count[rows] += 1
+
+    def compact(self) -> None:
+        """Drop popped rows from the arrays, once they take at least half of them."""
+        n_popped = self.next_index - self.offset
+        if n_popped == 0 or n_popped < len(self.count) // 2:
+            return
+
+        n_left = self.length - self.next_index
+        arrays: List[np.ndarray] = [self.times, self.count, self.values]
+        for array in arrays:
+            array[:n_left] = array[n_popped : n_popped + n_left]
+            array[n_left : n_popped + n_left] = 0
+
+        self.offset = self.next_index
+
+    def pop_complete(self) -> Optional[Tuple[int, np.ndarray, Dict[str, np.ndarray]]]:
+        """Remove complete rows following the previously returned ones.
+
+        Returns:
+            Index of the first row, times and values by observable, or None if no new row is complete.
+        """
+        start = self.next_index
+        incomplete = np.flatnonzero(self.count[start - self.offset : self.length - self.offset] < self.n_replicates)
+        end = start + int(incomplete[0]) if len(incomplete) else self.length
+
+        if end == start:
+            return None
+
+        self.next_index = end
+        rows = slice(start - self.offset, end - self.offset)
+        times = self.times[rows].copy()
+        values = self.values[rows].copy()  # (rows, replicates, obs)
+        self.compact()
+
+        mean = values.mean(axis=1)
+        std = values.std(axis=1, ddof=1) if self.n_replicates > 1 else np.zeros_like(mean)
+
+        values_by_observable: Dict[str, np.ndarray] = {}
+        for obs_idx, name in enumerate(self.observables or []):
+            values_by_observable[f"{name}:mean"] = mean[:, obs_idx]
+            values_by_observable[f"{name}:std"] = std[:, obs_idx]
+            for replicate_idx in range(self.n_replicates):
+                values_by_observable[f"{name}:r{replicate_idx}"] = values[:, replicate_idx, obs_idx]
+
+        return start, times, values_by_observable
@@ -7,3 +7,33 @@ MASTER_HOST = os.getenv("MASTER_HOST")
 DB_HOST = os.getenv("DB_HOST")
 DB_USER = os.getenv("username")
 DB_PASSWORD = os.getenv("admin_password") or ""
+
+# Number of simulations a sim worker runs concurrently, each in its own process
+SIM_WORKER_SLOTS = int(os.getenv("SIM_WORKER_SLOTS", "1"))
+
+MODEL_CACHE_MAX_SIZE = int(os.getenv("MODEL_CACHE_MAX_SIZE", str(2 * 1024**3)))
+
+# Format of sim worker -> backend messages, "binary" or "json"
+SIM_WORKER_WIRE_FORMAT = os.getenv("SIM_WORKER_WIRE_FORMAT", "binary")
+
+# Number of processes running replicates of one STEPS simulation, the cores of a worker are shared by its slots
+STEPS_REPLICATE_PROCESSES = int(
+    os.getenv("STEPS_REPLICATE_PROCESSES", str(max((os.cpu_count() or 1) // SIM_WORKER_SLOTS, 1)))
+)
+
+# Default number of MPI ranks of a TetOpSplit simulation, the cores of a worker are shared by its slots
+STEPS_MPI_RANKS = int(os.getenv("STEPS_MPI_RANKS", str(max((os.cpu_count() or 1) // SIM_WORKER_SLOTS, 1))))
+
+# Number of processes of the backend creating geometries from TetGen meshes
+GEOMETRY_JOB_PROCESSES = int(os.getenv("GEOMETRY_JOB_PROCESSES", "1"))
+
+# Number of processes and threads of the backend running blocking work of websocket commands
+TASK_PROCESSES = int(os.getenv("TASK_PROCESSES", "2"))
+TASK_THREADS = int(os.getenv("TASK_THREADS", "8"))
+
+# Lowest level of sim log messages which are sent by sims, "debug", "info", "warning" or "error"
+SIM_LOG_LEVEL = os.getenv("SIM_LOG_LEVEL", "info")
+
+# Size in bytes of the shared memory ring buffer every sim worker slot uses to get trace arrays from its sim process,
+# all slots should fit into /dev/shm, 64MB by default in Docker
+SIM_WORKER_SHM_SIZE = int(os.getenv("SIM_WORKER_SHM_SIZE", str(16 * 1024**2)))
@@ -0,0 +1,212 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Set
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+class TaskLimits:
+    """Max number of concurrently running tasks of a kind and time to wait for one, including queueing.
+
+    IO bound tasks run in threads, the rest in the process pool.
+    """
+
+    def __init__(self, concurrency: int, timeout: float, io_bound: bool = False) -> None:
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.io_bound = io_bound
+
+
+class TaskTimeoutError(TimeoutError):
+    pass
+
+
+class TaskMetrics:
+    def __init__(self) -> None:
+        self.submitted = 0
+        self.started = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.total_queue_latency = 0.0
+        self.max_queue_latency = 0.0
+        self.total_run_latency = 0.0
+        self.max_run_latency = 0.0
+
+    def as_dict(self) -> dict:
+        finished = self.started - self.running
+        return {
+            "submitted": self.submitted,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timedOut": self.timed_out,
+            "avgQueueLatency": self.total_queue_latency / self.started if self.started else 0.0,
+            "maxQueueLatency": self.max_queue_latency,
+            "avgRunLatency": self.total_run_latency / finished if finished else 0.0,
+            "maxRunLatency": self.max_run_latency,
+        }
+
+
+class ProcessPool:
+    """Process pool which is retired when a task running in it times out.
+
+    A task can't be cancelled once it runs in a worker process, a new pool takes the following tasks
+    and worker processes of the retired one are terminated once only timed out tasks are left in it.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending: Set[asyncio.Future] = set()
+        self.timed_out: Set[asyncio.Future] = set()
+        self.retired = False
+        self.processes: list = []
+
+    def submit(self, fn: Callable, *args) -> asyncio.Future:
+        future = asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(self.executor, fn, *args))
+        self.pending.add(future)
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future: asyncio.Future) -> None:
+        self.pending.discard(future)
+        self.timed_out.discard(future)
+        self.terminate_if_stuck()
+
+    def retire(self, timed_out_future: asyncio.Future) -> None:
+        self.timed_out.add(timed_out_future)
+        if not self.retired:
+            self.retired = True
+            # shutdown drops references to worker processes
+            self.processes = list(self.executor._processes.values())  # type: ignore # pylint: disable=protected-access
+            self.executor.shutdown(wait=False)
+        self.terminate_if_stuck()
+
+    def terminate_if_stuck(self) -> None:
+        if not self.retired or self.pending - self.timed_out:
+            return
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+
+class TaskExecutor:
+    """Run blocking functions of websocket commands outside of the event loop.
+
+    CPU bound tasks run in a bounded pool of spawned processes, IO bound ones in a thread pool.
+    The number of concurrently running tasks of every kind is limited, so that one kind of
+    requests can't occupy the whole pool.
+
+    Functions and arguments of CPU bound tasks should be picklable, i.e. module level functions.
+    """
+
+    def __init__(self, limits: Dict[str, TaskLimits], max_processes: int, max_threads: int) -> None:
+        self.limits = limits
+        self.max_processes = max_processes
+        self.max_threads = max_threads
+
+        self.process_pool: Optional[ProcessPool] = None
+        self.thread_pool: Optional[ThreadPoolExecutor] = None
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.metrics_by_kind: Dict[str, TaskMetrics] = {kind: TaskMetrics() for kind in limits}
+
+    def get_thread_pool(self) -> ThreadPoolExecutor:
+        if self.thread_pool is None:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="task")
+        return self.thread_pool
+
+    def get_process_pool(self) -> ProcessPool:
+        if self.process_pool is None:
+            self.process_pool = ProcessPool(self.max_processes)
+        return self.process_pool
+
+    def get_semaphore(self, kind: str) -> asyncio.Semaphore:
+        # created lazily to be bound to the running event loop
+        if kind not in self.semaphores:
+            self.semaphores[kind] = asyncio.Semaphore(self.limits[kind].concurrency)
+        return self.semaphores[kind]
+
+    async def run(self, kind: str, fn: Callable, *args) -> Any:
+        """Run `fn(*args)` as a task of a kind, return its result or raise its exception.
+
+        Raises:
+            TaskTimeoutError: If the task hasn't completed within the timeout of its kind.
+        """
+        limits = self.limits[kind]
+        metrics = self.metrics_by_kind[kind]
+        submitted_at = time.monotonic()
+        deadline = submitted_at + limits.timeout
+        metrics.submitted += 1
+        metrics.queued += 1
+
+        try:
+            await asyncio.wait_for(self.get_semaphore(kind).acquire(), limits.timeout)
+        except asyncio.TimeoutError as error:
+            metrics.queued -= 1
+            metrics.timed_out += 1
+            raise TaskTimeoutError(f"{kind} has not started within {limits.timeout}s") from error
+
+        try:
+            return await self.run_started(kind, fn, args, submitted_at, deadline)
+        finally:
+            self.get_semaphore(kind).release()
+
+    async def run_started(self, kind: str, fn: Callable, args: tuple, submitted_at: float, deadline: float) -> Any:
+        limits = self.limits[kind]
+        metrics = self.metrics_by_kind[kind]
+
+        metrics.queued -= 1
+        metrics.started += 1
+        started_at = time.monotonic()
+        queue_latency = started_at - submitted_at
+        metrics.total_queue_latency += queue_latency
+        metrics.max_queue_latency = max(metrics.max_queue_latency, queue_latency)
+        metrics.running += 1
+
+        pool = None
+        future: asyncio.Future
+        if limits.io_bound:
+            future = asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(self.get_thread_pool(), fn, *args))
+        else:
+            pool = self.get_process_pool()
+            future = pool.submit(fn, *args)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError as error:
+            metrics.timed_out += 1
+            # result of an abandoned task is dropped, even if it fails
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            if pool is not None:
+                if pool is self.process_pool:
+                    L.warning(f"{kind} task has timed out, replacing process pool")
+                    self.process_pool = None
+                pool.retire(future)
+            raise TaskTimeoutError(f"{kind} has not completed within {limits.timeout}s") from error
+        except Exception as error:
+            metrics.failed += 1
+            if isinstance(error, BrokenProcessPool) and pool is self.process_pool:
+                L.warning("process pool is broken, replacing it")
+                self.process_pool = None
+            raise
+        finally:
+            metrics.running -= 1
+            run_latency = time.monotonic() - started_at
+            metrics.total_run_latency += run_latency
+            metrics.max_run_latency = max(metrics.max_run_latency, run_latency)
+
+        metrics.completed += 1
+        return result
+
+    @property
+    def metrics(self) -> dict:
+        return {kind: metrics.as_dict() for kind, metrics in self.metrics_by_kind.items()}
@@ -0,0 +1,78 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+BLOCK_SIZE = 1_000_000  # Roughly 1 MB of text per trace chunk
+
+
+class GdatReader:
+    """Incremental reader of .gdat files written by BNG and NFsim.
+
+    Only complete lines are parsed, so the file can be read while the simulator is still writing it.
+    Every call to `read` parses at most BLOCK_SIZE bytes, which keeps memory bounded by the block size
+    rather than by the size of the file.
+    """
+
+    def __init__(self, path: str, delimiter: Optional[str] = None) -> None:
+        self.path = path
+        self.delimiter = delimiter
+        self.offset = 0
+        self.remainder = b""
+        self.observables: Optional[List[str]] = None
+
+    def parse_header(self, line: bytes) -> None:
+        names = line.decode("utf-8").lstrip("#").split(self.delimiter)
+        # first column is time
+        self.observables = [name.strip() for name in names[1:] if name.strip()]
+
+    def parse_rows(self, text: bytes) -> np.ndarray:
+        if self.delimiter is not None:
+            text = text.replace(self.delimiter.encode("utf-8"), b" ")
+
+        n_cols = len(self.observables or []) + 1
+        values = np.fromstring(text.decode("utf-8"), sep=" ")  # pylint: disable=no-member
+
+        if values.size % n_cols != 0:
+            raise ValueError(f"Can't parse {self.path}, rows don't match {n_cols} columns")
+
+        return values.reshape(-1, n_cols)
+
+    def read(self, final: bool = False) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Parse next block of complete rows.
+
+        Args:
+            final: Set when the writer has exited, a trailing line without a newline is parsed as well.
+
+        Returns:
+            Tuple of times and values of shape (n_rows, n_observables), None if there are no new rows.
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        while True:
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                chunk = file.read(BLOCK_SIZE)
+            self.offset += len(chunk)
+            eof = len(chunk) < BLOCK_SIZE
+
+            data = self.remainder + chunk
+            end = len(data) if final and eof else data.rfind(b"\n") + 1
+            data, self.remainder = data[:end], data[end:]
+
+            if self.observables is None and data:
+                header_end = data.find(b"\n") + 1 or len(data)
+                self.parse_header(data[:header_end])
+                data = data[header_end:]
+
+            if data.strip():
+                rows = self.parse_rows(data)
+                return rows[:, 0], rows[:, 1:]
+
+            if eof:
+                return None
@@ -1,17 +1,34 @@
 import os
+import re
 import json
-from typing import Dict
+import time
+import queue
+import shutil
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SyncManager
+from typing import Dict, Optional, Callable, Awaitable
 
 from steps.utilities import meshio
 import numpy as np
 
+from .geometry_store import GeometryStore, GEOMETRY_ROOT_PATH
 from .logger import get_logger
 
 
 L = get_logger(__name__)
 
-GEOMETRY_ROOT_PATH = "/data/geometries"
 TETGEN_TYPE_EXTENSION = {"nodes": "node", "faces": "face", "elements": "ele"}
+UPLOADS_PATH = os.path.join(GEOMETRY_ROOT_PATH, ".uploads")
+# Upload ids are client supplied, they are restricted to a single path component
+UPLOAD_ID_PATTERN = r"[\w-]+"
+PROGRESS_POLL_SECS = 0.2
+# Uploads not turned into a geometry within this time are removed
+UPLOAD_MAX_AGE_SECS = 24 * 60 * 60
+
+ProgressCallback = Callable[[str, float], None]
 
 if not os.path.exists(GEOMETRY_ROOT_PATH):
     umask = os.umask(0)
@@ -19,28 +36,100 @@ if not os.path.exists(GEOMETRY_ROOT_PATH):
     os.umask(umask)
 
 
-def create_geometry(id_: str, geometry_config: dict) -> Dict[str, float]:
-    meta = geometry_config["meta"]
-    mesh_name_root = meta["meshNameRoot"]
+def mesh_arrays(mesh) -> Dict[str, np.ndarray]:
+    """Flat node coordinates and tet/triangle vertex indices of a STEPS mesh."""
+    nodes = np.zeros(mesh.nverts * 3, dtype=np.float64)
+    mesh.getBatchVerticesNP(np.arange(mesh.nverts, dtype=np.uintc), nodes)
+
+    tets = np.zeros(mesh.ntets * 4, dtype=np.uintc)
+    mesh.getBatchTetVerticesNP(np.arange(mesh.ntets, dtype=np.uintc), tets)
+
+    tris = np.zeros(mesh.ntris * 3, dtype=np.uintc)
+    mesh.getBatchTriVerticesNP(np.arange(mesh.ntris, dtype=np.uintc), tris)
+
+    return {"nodes": nodes, "tets": tets, "tris": tris}
+
+
+def check_upload_id(upload_id: str) -> None:
+    """Raise `ValueError` for upload ids which could point outside of their upload directory."""
+    if not re.fullmatch(UPLOAD_ID_PATTERN, upload_id):
+        raise ValueError(f"Invalid upload id {upload_id!r}")
+
+
+def upload_path(upload_id: str, tetgen_type: str) -> str:
+    """Path of an uploaded TetGen file."""
+    check_upload_id(upload_id)
+
+    if tetgen_type not in TETGEN_TYPE_EXTENSION:
+        raise ValueError(f"Unknown TetGen file type {tetgen_type}")
+
+    return os.path.join(UPLOADS_PATH, upload_id, f"mesh.{TETGEN_TYPE_EXTENSION[tetgen_type]}")
+
+
+def expire_uploads(max_age: float = UPLOAD_MAX_AGE_SECS) -> None:
+    """Remove uploads which haven't been written to for `max_age` seconds."""
+    if not os.path.exists(UPLOADS_PATH):
+        return
+
+    expire_before = time.time() - max_age
+    for upload_id in os.listdir(UPLOADS_PATH):
+        path = os.path.join(UPLOADS_PATH, upload_id)
+        try:
+            mtimes = [os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path)]
+        except OSError:
+            continue
+
+        if max(mtimes) < expire_before:
+            L.debug(f"removing expired geometry upload {upload_id}")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def prepare_geometry_dir(id_: str, meta: dict, upload_id: Optional[str] = None, raw: Optional[dict] = None) -> None:
+    """Create the geometry directory with TetGen files, moved from an upload or written from raw text."""
+    if upload_id is not None:
+        check_upload_id(upload_id)
 
     geometry_path = os.path.join(GEOMETRY_ROOT_PATH, id_)
     os.makedirs(geometry_path)
-    os.chdir(geometry_path)
+
     for tetgen_type, extension in TETGEN_TYPE_EXTENSION.items():
-        filename = f"{mesh_name_root}.{extension}"
-        with open(filename, "w") as file:
-            file.write(geometry_config["mesh"]["volume"]["raw"][tetgen_type])
+        path = os.path.join(geometry_path, f"{meta['meshNameRoot']}.{extension}")
+
+        if upload_id is not None:
+            shutil.move(upload_path(upload_id, tetgen_type), path)
+        elif raw is not None:
+            with open(path, "w") as file:
+                file.write(raw[tetgen_type])
+        else:
+            raise ValueError("Either an upload id or raw TetGen files are required")
+
+    if upload_id is not None:
+        shutil.rmtree(os.path.join(UPLOADS_PATH, upload_id), ignore_errors=True)
+
 
-    mesh = meshio.importTetGen(mesh_name_root, meta["scale"])[0]
+def create_geometry(id_: str, meta: dict, progress_cb: Optional[ProgressCallback] = None) -> Dict[str, float]:
+    """Import TetGen files prepared by `prepare_geometry_dir` and save the mesh, return structure sizes."""
+
+    def report(stage: str, progress: float) -> None:
+        if progress_cb is not None:
+            progress_cb(stage, progress)
+
+    geometry_path = os.path.join(GEOMETRY_ROOT_PATH, id_)
+
+    report("import", 0)
+    mesh = meshio.importTetGen(os.path.join(geometry_path, meta["meshNameRoot"]), meta["scale"])[0]
+
+    report("save", 0.4)
     meshio.saveMesh(os.path.join(geometry_path, "mesh"), mesh)
 
-    with open("geometry.json", "w") as file:
+    with open(os.path.join(geometry_path, "geometry.json"), "w") as file:
         file.write(json.dumps(meta))
 
     idx_map = {"compartment": "tetIdxs", "membrane": "triIdxs"}
 
     structure_sizes = {}
 
+    report("sizes", 0.7)
     for structure in meta["structures"]:
         idxs = np.array(structure[idx_map[structure["type"]]], dtype=np.uintc)
         sizes = np.zeros(len(idxs), dtype=np.float64)
@@ -52,4 +141,83 @@ def create_geometry(id_: str, geometry_config: dict) -> Dict[str, float]:
         structure["size"] = sizes.sum()
         structure_sizes[structure["name"]] = sizes.sum()
 
+    report("store", 0.8)
+    GeometryStore().write(
+        id_,
+        {
+            **mesh_arrays(mesh),
+            "structures": [
+                {
+                    "name": structure["name"],
+                    "type": structure["type"],
+                    "idxs": structure[idx_map[structure["type"]]],
+                }
+                for structure in meta["structures"]
+            ],
+            "freeDiffusionBoundaries": meta.get("freeDiffusionBoundaries") or [],
+        },
+    )
+
+    report("done", 1)
     return structure_sizes
+
+
+def run_geometry_job(id_: str, meta: dict, progress_queue) -> Dict[str, float]:
+    return create_geometry(id_, meta, lambda stage, progress: progress_queue.put((stage, progress)))
+
+
+def relay_progress(
+    progress_queue,
+    stop: threading.Event,
+    loop: asyncio.AbstractEventLoop,
+    progress_cb: Callable[[str, float], Awaitable[None]],
+) -> None:
+    """Forward progress of a geometry job to the event loop, until stopped and the queue is drained.
+
+    Runs in a thread, as each read of a manager queue is a round trip to the manager process.
+    """
+    while True:
+        try:
+            stage, progress = progress_queue.get(timeout=PROGRESS_POLL_SECS)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+
+        try:
+            asyncio.run_coroutine_threadsafe(progress_cb(stage, progress), loop).result()
+        except Exception as error:  # pylint: disable=broad-except
+            L.warning(f"can't report geometry progress: {error}")
+
+
+class GeometryJobRunner:
+    """Run geometry creation in a process pool, so that mesh import doesn't block the event loop.
+
+    Processes are spawned rather than forked from the server process, progress is reported through
+    a manager queue, which is created with the pool on the first job.
+    """
+
+    def __init__(self, max_workers: int = 1) -> None:
+        self.max_workers = max_workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.manager: Optional[SyncManager] = None
+
+    def start(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        self.manager = context.Manager()
+
+    async def run(self, id_: str, meta: dict, progress_cb: Callable[[str, float], Awaitable[None]]) -> Dict[str, float]:
+        if self.executor is None:
+            self.start()
+
+        progress_queue = self.manager.Queue()  # type: ignore
+        loop = asyncio.get_event_loop()
+        stop = threading.Event()
+        relay = loop.run_in_executor(None, relay_progress, progress_queue, stop, loop, progress_cb)
+
+        try:
+            return await loop.run_in_executor(self.executor, run_geometry_job, id_, meta, progress_queue)
+        finally:
+            stop.set()
+            await relay
@@ -0,0 +1,124 @@
+import os
+import json
+import shutil
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from .utils import umask
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+GEOMETRY_ROOT_PATH = "/data/geometries"
+STORE_DIRNAME = "arrays"
+STORE_MANIFEST_FILENAME = "manifest.json"
+STORE_VERSION = 1
+
+NODE_DTYPE = np.dtype("<f8")
+IDX_DTYPE = np.dtype("<u4")
+
+
+class GeometryStore:
+    """Mesh arrays of geometries as .npy files, loaded memory-mapped.
+
+    Layout of `{geometry_path}/arrays`:
+        manifest.json: structures and free diffusion boundaries without their index arrays
+        nodes.npy, tets.npy, tris.npy: flat node coordinates and vertex indices, as in the model geometry
+        structure-{idx}.npy: tet or triangle indices of a structure
+        diff-boundary-{idx}.npy: triangle indices of a free diffusion boundary
+
+    Loaded arrays are read-only memory maps, so sims using the same geometry on one node share
+    the page cache instead of holding their own copies. A store is written to a temp dir which is
+    renamed when complete, readers never see a partially written one.
+    """
+
+    def __init__(self, root_path: str = GEOMETRY_ROOT_PATH) -> None:
+        self.root_path = root_path
+
+    def path(self, geometry_id: str) -> str:
+        return os.path.join(self.root_path, geometry_id, STORE_DIRNAME)
+
+    def has(self, geometry_id: str) -> bool:
+        return os.path.exists(os.path.join(self.path(geometry_id), STORE_MANIFEST_FILENAME))
+
+    def write(self, geometry_id: str, geometry: dict) -> None:
+        """Store a geometry given in the model format.
+
+        Args:
+            geometry_id: Id of the geometry, nothing is written if it is already stored.
+            geometry: Dict with flat `nodes`, `tets` and `tris` and `structures` with their `idxs`,
+                optionally `freeDiffusionBoundaries` with their `triIdxs`.
+        """
+        path = self.path(geometry_id)
+        if self.has(geometry_id):
+            return
+
+        with umask():
+            os.makedirs(os.path.dirname(path), 0o777, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix=f".{STORE_DIRNAME}-", dir=os.path.dirname(path))
+
+        try:
+            np.save(os.path.join(tmp_path, "nodes.npy"), np.asarray(geometry["nodes"], dtype=NODE_DTYPE))
+            np.save(os.path.join(tmp_path, "tets.npy"), np.asarray(geometry["tets"], dtype=IDX_DTYPE))
+            np.save(os.path.join(tmp_path, "tris.npy"), np.asarray(geometry["tris"], dtype=IDX_DTYPE))
+
+            structures = []
+            for idx, structure in enumerate(geometry["structures"]):
+                np.save(os.path.join(tmp_path, f"structure-{idx}.npy"), np.asarray(structure["idxs"], dtype=IDX_DTYPE))
+                structures.append({key: value for key, value in structure.items() if key != "idxs"})
+
+            diff_boundaries = []
+            for idx, diff_boundary in enumerate(geometry.get("freeDiffusionBoundaries") or []):
+                np.save(
+                    os.path.join(tmp_path, f"diff-boundary-{idx}.npy"),
+                    np.asarray(diff_boundary["triIdxs"], dtype=IDX_DTYPE),
+                )
+                diff_boundaries.append({key: value for key, value in diff_boundary.items() if key != "triIdxs"})
+
+            manifest = {
+                "version": STORE_VERSION,
+                "structures": structures,
+                "freeDiffusionBoundaries": diff_boundaries,
+            }
+            with open(os.path.join(tmp_path, STORE_MANIFEST_FILENAME), "w") as file:
+                json.dump(manifest, file)
+
+            os.chmod(tmp_path, 0o777)
+            os.rename(tmp_path, path)
+        except OSError as error:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            # another process has stored the same geometry in the meantime
+            if self.has(geometry_id):
+                return
+            raise error
+
+        L.debug(f"stored geometry {geometry_id} arrays")
+
+    def load(self, geometry_id: str) -> Optional[dict]:
+        """Load a geometry in the model format with memory-mapped arrays, None if it's not stored."""
+        path = self.path(geometry_id)
+
+        try:
+            with open(os.path.join(path, STORE_MANIFEST_FILENAME)) as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return None
+
+        def load_array(filename: str) -> np.ndarray:
+            return np.load(os.path.join(path, filename), mmap_mode="r")
+
+        return {
+            "nodes": load_array("nodes.npy"),
+            "tets": load_array("tets.npy"),
+            "tris": load_array("tris.npy"),
+            "structures": [
+                {**structure, "idxs": load_array(f"structure-{idx}.npy")}
+                for idx, structure in enumerate(manifest["structures"])
+            ],
+            "freeDiffusionBoundaries": [
+                {**diff_boundary, "triIdxs": load_array(f"diff-boundary-{idx}.npy")}
+                for idx, diff_boundary in enumerate(manifest["freeDiffusionBoundaries"])
+            ],
+        }
@@ -0,0 +1,72 @@
+from typing import List
+
+import numpy as np
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+COMPARTMENT = "compartment"
+
+TET_FACE_VERTS = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]], dtype=np.intp)
+
+
+# Sorted vertices of a triangle viewed as a single opaque value, which can be sorted and searched
+FACE_KEY_DTYPE = np.dtype((np.void, 3 * np.dtype(np.int64).itemsize))
+
+
+def face_keys(faces: np.ndarray) -> np.ndarray:
+    """Encode triangles given as (n, 3) vertex arrays into orientation independent keys."""
+    faces = np.ascontiguousarray(np.sort(faces, axis=1), dtype=np.int64)
+    return faces.view(FACE_KEY_DTYPE).ravel()
+
+
+class MeshIndex:
+    """Tet and triangle lookup tables for a tetrahedral mesh, built once per geometry.
+
+    Attributes:
+        compartment_names: Names of geometry compartments, position in the list is a compartment label.
+        tet_labels: Compartment label for every tetrahedron, -1 for tets outside of any compartment.
+    """
+
+    def __init__(self, geometry: dict) -> None:
+        self.tets = np.asarray(geometry["tets"], dtype=np.int64).reshape(-1, 4)
+        self.tris = np.asarray(geometry["tris"], dtype=np.int64).reshape(-1, 3)
+
+        compartments = [st for st in geometry["structures"] if st["type"] == COMPARTMENT]
+        self.compartment_names: List[str] = [compartment["name"] for compartment in compartments]
+        self.tet_labels = np.full(len(self.tets), -1, dtype=np.int32)
+        for label, compartment in enumerate(compartments):
+            self.tet_labels[np.asarray(compartment["idxs"], dtype=np.intp)] = label
+
+        # Every tet contributes 4 faces, sorting them by key allows to find tets sharing a triangle
+        # with a binary search instead of querying the mesh triangle by triangle.
+        keys = face_keys(self.tets[:, TET_FACE_VERTS].reshape(-1, 3))
+        order = np.argsort(keys, kind="stable")
+        self.face_keys = keys[order]
+        self.face_tets = (order // 4).astype(np.int64)
+
+    def tri_tet_neighbs(self, tri_idxs) -> np.ndarray:
+        """Get (n, 2) array of tets neighbouring given triangles, -1 when there is no tet from one side.
+
+        Batched equivalent of calling `Tetmesh.getTriTetNeighb` for every triangle.
+        """
+        keys = face_keys(self.tris[np.asarray(tri_idxs, dtype=np.intp)])
+        left = np.searchsorted(self.face_keys, keys, side="left")
+        right = np.searchsorted(self.face_keys, keys, side="right")
+        n_neighbs = right - left
+
+        neighbs = np.full((len(keys), 2), -1, dtype=np.int64)
+        has_first = n_neighbs >= 1
+        has_second = n_neighbs >= 2
+        neighbs[has_first, 0] = self.face_tets[left[has_first]]
+        neighbs[has_second, 1] = self.face_tets[left[has_second] + 1]
+
+        return neighbs
+
+    def neighb_compartment_names(self, tri_idxs) -> List[str]:
+        """Get names of geometry compartments bordering given triangles."""
+        tet_idxs = self.tri_tet_neighbs(tri_idxs).ravel()
+        labels = np.unique(self.tet_labels[tet_idxs[tet_idxs >= 0]])
+        return [self.compartment_names[label] for label in labels if label >= 0]
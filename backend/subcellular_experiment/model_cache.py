@@ -0,0 +1,103 @@
+import os
+import pickle
+import hashlib
+from typing import Optional
+
+import pysb
+
+from .utils import umask
+from .logger import get_logger
+from .envvars import MODEL_CACHE_MAX_SIZE
+
+L = get_logger(__name__)
+
+MODEL_CACHE_PATH = "/data/model-cache"
+CACHE_FILE_EXTENSION = ".pickle"
+
+
+class ModelCache:
+    """On-disk LRU cache of PySB models with generated reaction networks.
+
+    Entries are keyed by a content hash of the BNGL model, recency is tracked by file mtime
+    which is updated on every cache hit, so the cache can be shared by all workers on a node.
+    """
+
+    def __init__(self, path: str = MODEL_CACHE_PATH, max_size: int = MODEL_CACHE_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(bngl_str: str) -> str:
+        content = f"pysb-{pysb.__version__}\n{bngl_str}"
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}{CACHE_FILE_EXTENSION}")
+
+    def get(self, key: str) -> Optional[pysb.Model]:
+        path = self.entry_path(key)
+
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, "rb") as file:
+                pysb_model = pickle.load(file)
+            os.utime(path)
+        except Exception as error:
+            L.warning(f"can't load cached model {key}, removing the entry")
+            L.exception(error)
+            self.remove(key)
+            return None
+
+        return pysb_model
+
+    def put(self, key: str, pysb_model: pysb.Model) -> None:
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+
+        try:
+            with umask():
+                os.makedirs(self.path, 0o777, exist_ok=True)
+
+            with open(tmp_path, "wb") as file:
+                pickle.dump(pysb_model, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as error:
+            L.warning(f"can't save model {key} to the cache")
+            L.exception(error)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits into max_size."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(CACHE_FILE_EXTENSION):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            L.debug(f"evicting {path} from the model cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -1,13 +1,13 @@
-import os
 import subprocess
 import math
-from typing import Callable, Any
-import numpy as np
-import pandas as pd
+from typing import Callable, Any, Optional
 
 from subcellular_experiment.api import fetch_model
 
-from .sim import SimStatus, SimTrace, SimLogMessage, decompress_stimulation
+from .sim import SimStatus, SimLogMessage
+from .stimulation import get_stimuli, group_stimuli, TIME_TOLERANCE
+from .gdat import GdatReader
+from .process_runner import ProcessRunner
 from .model_to_bngl import model_to_bngl
 from .settings import BNG_PATH, NFSIM_PATH
 from .logger import get_logger
@@ -19,8 +19,9 @@ BNG_MODEL_EXPORT_TIMEOUT = 5
 
 
 class NfSim:
-    def __init__(self, sim_config: dict, progress_cb: Callable[[Any], None]) -> None:
+    def __init__(self, sim_config: dict, progress_cb: Callable[[Any], None], model: Optional[dict] = None) -> None:
         self.sim_config = sim_config
+        self.model = model
         self.send_progress = progress_cb
 
     def log(self, message: str, source=None) -> None:
@@ -30,29 +31,28 @@ class NfSim:
     def generate_rnf(self) -> str:
         solver_conf = self.sim_config["solverConf"]
 
-        stimuli = solver_conf.get("stimulation", [])
-
-        if isinstance(stimuli, list):
-            pass
-        else:
-            stimuli = decompress_stimulation(stimuli)
+        stimuli = get_stimuli(solver_conf)
 
         t_end = solver_conf["tEnd"]
         dt = solver_conf["dt"]
         next_step_dt = None
 
-        rnf_actions = []
+        rnf_actions = [
+            "  set {} {}".format(name, value) for name, value in (self.sim_config.get("paramOverrides") or {}).items()
+        ]
+        if rnf_actions:
+            rnf_actions.append("  update")
 
-        action_t_vec = list(set([stim["t"] for stim in stimuli if stim["t"] < t_end] + [0, t_end]))
-        action_t_vec.sort()
-        t = 0
+        stimuli_by_t = dict(group_stimuli(stimuli, dt * TIME_TOLERANCE))
+        action_t_vec = sorted({t for t in stimuli_by_t if t < t_end} | {0, t_end})
+        t = 0.0
         for action_t in action_t_vec:
             delta_t = action_t - t
             if delta_t != 0:
                 n_steps = math.ceil(delta_t / (next_step_dt or dt))
                 sim_action = "  sim {} {}".format(delta_t, n_steps)
                 rnf_actions.append(sim_action)
-            actions = [action for action in stimuli if action["t"] == action_t]
+            actions = stimuli_by_t.get(action_t, [])
             for action in actions:
                 rnf_action = None
 
@@ -81,7 +81,7 @@ class NfSim:
 
     @tempdir()
     def run(self) -> None:
-        model_dict = fetch_model(self.sim_config["modelId"], self.sim_config["userId"])
+        model_dict = self.model or fetch_model(self.sim_config["modelId"], self.sim_config["userId"], geometry=False)
 
         bngl = model_to_bngl(model_dict, write_xml_op=True)
 
@@ -97,73 +97,37 @@ class NfSim:
 
         L.debug("starting BNG xml model export")
         try:
-            bng_run = subprocess.run(
-                [BNG_PATH, "model.bngl"],
-                check=False,
-                capture_output=True,
-                timeout=BNG_MODEL_EXPORT_TIMEOUT,
+            bng_returncode = ProcessRunner(self.send_progress, "bng").run(
+                [BNG_PATH, "model.bngl"], timeout=BNG_MODEL_EXPORT_TIMEOUT
             )
         except subprocess.TimeoutExpired:
             self.log("BNGL was not been able to convert a model into xml within 5 seconds")
             self.send_progress(SimStatus(status="error"))
             return
 
-        self.log(bng_run.stdout.decode("utf-8"), "bng_stdout")
-        self.log(bng_run.stderr.decode("utf-8"), "bng_stderr")
-        if bng_run.returncode != 0:
+        if bng_returncode != 0:
             self.send_progress(SimStatus(status="error"))
             return
         L.debug("BNG xml model export has been finished")
 
         L.debug("starting NFsim")
-        nfsim_run = subprocess.run(
-            [NFSIM_PATH, "-csv", "-logo", "-gml", "10000000", "-rnf", "model.rnf"],
-            check=False,
-            capture_output=True,
+        reader = GdatReader("model.gdat", delimiter=",")
+        nfsim_runner = ProcessRunner(
+            self.send_progress, "nfsim", gdat_reader=reader, t_end=self.sim_config["solverConf"]["tEnd"]
         )
-        self.log(nfsim_run.stdout.decode("utf-8"), "nfsim_stdout")
-        self.log(nfsim_run.stderr.decode("utf-8"), "nfsim_stderr")
+        nfsim_cmd = [NFSIM_PATH, "-csv", "-logo", "-gml", "10000000", "-rnf", "model.rnf"]
+        if "seed" in self.sim_config["solverConf"]:
+            nfsim_cmd += ["-seed", str(self.sim_config["solverConf"]["seed"])]
+        nfsim_returncode = nfsim_runner.run(nfsim_cmd)
 
-        L.debug("NFsim return code is {}".format(nfsim_run.returncode))
-        if nfsim_run.returncode != 0:
+        L.debug("NFsim return code is {}".format(nfsim_returncode))
+        if nfsim_returncode != 0:
             self.send_progress(SimStatus(status="error"))
             return
 
-        if not os.path.isfile("model.gdat"):
+        if reader.observables is None:
             self.log("NFsim hasn\t generated model.gdat, check the logs for more information")
             self.send_progress(SimStatus(status="error"))
             return
 
-        sim_traces = pd.read_csv("model.gdat")
-        observables = list(map(str.lstrip, sim_traces.columns.tolist()[1:]))
-
-        times = np.array(sim_traces.values.tolist())[:, 0]
-
-        values = np.array(sim_traces.values.tolist())[:, 1:]
-
-        times_size_bytes = times.itemsize * len(times)
-        values_size_bytes = values.size * values.itemsize
-        total_size_bytes = times_size_bytes + values_size_bytes
-
-        chunk_size = 1_000_000  # Roughly 1 MB
-        nchunks = total_size_bytes // chunk_size + 1
-
-        elements_per_chunk = len(times) // nchunks
-
-        for i in range(0, len(times), elements_per_chunk):
-            times_chunk = times[i : i + elements_per_chunk]
-
-            values_chunk = values[i : i + elements_per_chunk].T
-
-            values_by_observable = {observables[i]: values_chunk[i].tolist() for i in range(len(observables))}
-
-            self.send_progress(
-                SimTrace(
-                    index=i,
-                    times=times_chunk.tolist(),
-                    values_by_observable=values_by_observable,
-                    persist=True,
-                )
-            )
-
         self.send_progress(SimStatus(status="finished"))
@@ -0,0 +1,208 @@
+import os
+import re
+import time
+import queue
+import signal
+import subprocess
+from threading import Thread
+from typing import Callable, Any, Dict, List, Optional, IO
+
+import numpy as np
+
+from .sim import SimTrace, SimProgress, SimLogMessage
+from .gdat import GdatReader
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+POLL_INTERVAL_SECS = 0.5
+LOG_BATCH_INTERVAL_SECS = 1
+LOG_BATCH_MAX_LINES = 500
+# Time a stopped process gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE_SECS = 5
+
+# Simulated time reported by NFsim ("Sim time: 1.5 ...") and BNG run_network ("t = 1.5 ...")
+SIM_TIME_RES = [
+    re.compile(r"sim(?:ulation)?\s+time\s*[:=]\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)", re.IGNORECASE),
+    re.compile(r"^\s*(?:t|time)\s*[:=]\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)", re.IGNORECASE),
+]
+
+
+def parse_sim_time(line: str) -> Optional[float]:
+    for sim_time_re in SIM_TIME_RES:
+        match = sim_time_re.search(line)
+        if match is not None:
+            return float(match.group(1))
+    return None
+
+
+def signal_process_group(proc: subprocess.Popen, sig: int) -> None:
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        # all processes of the group have exited
+        pass
+
+
+class ProcessRunner:
+    """Run a simulator executable and forward its output while it is running.
+
+    Stdout and stderr are read line by line by two threads and sent as batched `SimLogMessage`s.
+    When a .gdat reader is given, new rows are sent as `SimTrace` chunks. Simulated time parsed
+    from the output or taken from the .gdat file is used to send `SimProgress` with an ETA.
+    """
+
+    def __init__(
+        self,
+        progress_cb: Callable[[Any], None],
+        log_source_prefix: str,
+        gdat_reader: Optional[GdatReader] = None,
+        t_end: Optional[float] = None,
+    ) -> None:
+        self.progress_cb = progress_cb
+        self.log_source_prefix = log_source_prefix
+        self.gdat_reader = gdat_reader
+        self.t_end = t_end
+
+        self.lines: queue.Queue = queue.Queue()
+        self.log_batches: Dict[str, List[str]] = {}
+        self.last_log_flush = time.time()
+        self.trace_index = 0
+        self.sim_time = 0.0
+        self.progress = -1
+        self.t_start = time.time()
+
+    def read_pipe(self, pipe: IO[bytes], source: str) -> None:
+        for line in iter(pipe.readline, b""):
+            self.lines.put((source, line.decode("utf-8", "replace").rstrip("\n")))
+        pipe.close()
+
+    def run(self, cmd: List[str], timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None) -> int:
+        """Run the command until it exits and return its return code.
+
+        The process is stopped if the runner is interrupted, e.g. when the simulation is cancelled.
+
+        Raises:
+            subprocess.TimeoutExpired: If the process is still running after `timeout` seconds,
+                the process is stopped in this case.
+        """
+        self.t_start = time.time()
+        # the process outlives this statement, it is waited for or stopped below
+        proc = subprocess.Popen(  # pylint: disable=consider-using-with
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, start_new_session=True
+        )
+
+        pipe_threads = [
+            Thread(target=self.read_pipe, args=(proc.stdout, f"{self.log_source_prefix}_stdout"), daemon=True),
+            Thread(target=self.read_pipe, args=(proc.stderr, f"{self.log_source_prefix}_stderr"), daemon=True),
+        ]
+        for pipe_thread in pipe_threads:
+            pipe_thread.start()
+
+        try:
+            while proc.poll() is None:
+                self.process_lines(POLL_INTERVAL_SECS)
+                self.process_gdat(final=False)
+                self.send_progress()
+
+                if timeout is not None and time.time() - self.t_start > timeout:
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+        except BaseException:
+            self.stop(proc)
+            raise
+        finally:
+            for pipe_thread in pipe_threads:
+                pipe_thread.join()
+            self.process_lines(0)
+            self.flush_logs()
+
+        self.process_gdat(final=True)
+        self.send_progress()
+
+        return proc.returncode
+
+    def stop(self, proc: subprocess.Popen) -> None:
+        """Stop a process and the processes it has started, e.g. MPI ranks.
+
+        The process runs in its own session, its whole group gets SIGTERM first so that mpirun can
+        tear down its ranks, what is left after TERMINATE_GRACE_SECS is killed.
+        """
+        signal_process_group(proc, signal.SIGTERM)
+        try:
+            proc.wait(TERMINATE_GRACE_SECS)
+        except subprocess.TimeoutExpired:
+            L.warning(f"process {proc.pid} is still running {TERMINATE_GRACE_SECS}s after SIGTERM, killing it")
+
+        signal_process_group(proc, signal.SIGKILL)
+        proc.wait()
+
+    def process_lines(self, wait_secs: float) -> None:
+        """Consume output lines for `wait_secs` seconds, or only already available ones if it's 0."""
+        deadline = time.time() + wait_secs
+
+        while True:
+            remaining_secs = deadline - time.time()
+            try:
+                if remaining_secs > 0:
+                    source, line = self.lines.get(timeout=remaining_secs)
+                else:
+                    source, line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+
+            self.log_batches.setdefault(source, []).append(line)
+
+            sim_time = parse_sim_time(line)
+            if sim_time is not None:
+                self.sim_time = max(self.sim_time, sim_time)
+
+            if len(self.log_batches[source]) >= LOG_BATCH_MAX_LINES:
+                self.flush_logs()
+
+        if time.time() - self.last_log_flush > LOG_BATCH_INTERVAL_SECS:
+            self.flush_logs()
+
+    def flush_logs(self) -> None:
+        for source, lines in self.log_batches.items():
+            if lines:
+                self.progress_cb(SimLogMessage(message="\n".join(lines), source=source))
+        self.log_batches = {}
+        self.last_log_flush = time.time()
+
+    def process_gdat(self, final: bool) -> None:
+        if self.gdat_reader is None:
+            return
+
+        block = self.gdat_reader.read(final=final)
+        while block is not None:
+            times, values = block
+            values = np.where(np.isnan(values), 0, values)
+            observables = self.gdat_reader.observables or []
+
+            self.progress_cb(
+                SimTrace(
+                    index=self.trace_index,
+                    times=times,
+                    values_by_observable={observables[i]: values[:, i] for i in range(len(observables))},
+                    persist=True,
+                )
+            )
+            self.trace_index += len(times)
+
+            if len(times):
+                self.sim_time = max(self.sim_time, float(times[-1]))
+
+            block = self.gdat_reader.read(final=final)
+
+    def send_progress(self) -> None:
+        if not self.t_end:
+            return
+
+        progress = int(min(self.sim_time / self.t_end, 1) * 100)
+        if progress <= self.progress:
+            return
+
+        self.progress = progress
+        elapsed = time.time() - self.t_start
+        eta = elapsed * (100 - progress) / progress if progress else None
+        self.progress_cb(SimProgress(progress=progress, eta=eta))
@@ -0,0 +1,115 @@
+from collections import defaultdict
+from typing import Dict, List, Set
+
+import numpy as np
+import sympy
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+def rate_constant_expr(pysb_reac: dict):
+    """Rate constant of a mass action reaction, the last factor of its rate."""
+    return pysb_reac["rate"].as_ordered_factors()[-1]
+
+
+class RateEvaluator:
+    """Numeric values of reaction rate constants and initial conditions of a PySB model.
+
+    Parameters and expressions are inputs of functions compiled with `sympy.lambdify` once, so that
+    rates don't go through SymPy substitution on every evaluation. Expressions are evaluated in
+    definition order from parameters and preceding expressions, an expression can also be set to
+    a constant value by a stimulus, as with PySB where its `expr` is replaced.
+
+    An index of reactions which depend, also through expressions, on every parameter and expression
+    allows to update only rates affected by a change of one value.
+    """
+
+    def __init__(self, pysb_model) -> None:
+        parameters = list(pysb_model.parameters)
+        expressions = list(pysb_model.expressions)
+        atoms = parameters + expressions
+
+        self.names = [atom.name for atom in atoms]
+        self.idx_by_name = {name: idx for idx, name in enumerate(self.names)}
+        self.n_params = len(parameters)
+
+        symbols = [sympy.Symbol(f"_a{idx}") for idx in range(len(atoms))]
+        symbol_by_atom = dict(zip(atoms, symbols))
+
+        def compile_exprs(exprs: list):
+            return sympy.lambdify(symbols, [sympy.sympify(expr).xreplace(symbol_by_atom) for expr in exprs], "numpy")
+
+        def atom_idxs(expr) -> Set[int]:
+            free_symbols = sympy.sympify(expr).free_symbols
+            return {self.idx_by_name[symbol.name] for symbol in free_symbols if symbol.name in self.idx_by_name}
+
+        self.expr_fns = [compile_exprs([expression.expr]) for expression in expressions]
+
+        # all atoms every expression depends on, expressions only refer to preceding ones
+        deps_by_expr_idx: Dict[int, Set[int]] = {}
+        self.expr_idxs_by_atom_idx: Dict[int, List[int]] = defaultdict(list)
+        for expr_idx, expression in enumerate(expressions, self.n_params):
+            deps = set()
+            for atom_idx in atom_idxs(expression.expr):
+                deps |= {atom_idx} | deps_by_expr_idx.get(atom_idx, set())
+            deps_by_expr_idx[expr_idx] = deps
+            for atom_idx in deps:
+                self.expr_idxs_by_atom_idx[atom_idx].append(expr_idx)
+
+        rate_exprs = [rate_constant_expr(pysb_reac) for pysb_reac in pysb_model.reactions]
+        self.rate_fn = compile_exprs(rate_exprs)
+
+        initial_exprs = [expr for _, expr in pysb_model.initial_conditions]
+        self.initial_fn = compile_exprs(initial_exprs)
+
+        self.reac_idxs_by_atom_idx: Dict[int, List[int]] = defaultdict(list)
+        for reac_idx, rate_expr in enumerate(rate_exprs):
+            deps = set()
+            for atom_idx in atom_idxs(rate_expr):
+                deps |= {atom_idx} | deps_by_expr_idx.get(atom_idx, set())
+            for atom_idx in deps:
+                self.reac_idxs_by_atom_idx[atom_idx].append(reac_idx)
+
+        self.initial_param_values = np.array([parameter.value for parameter in parameters], dtype=np.float64)
+        self.reset()
+
+    def reset(self) -> None:
+        """Restore parameter values of the model and expressions defined by it."""
+        self.values = np.zeros(len(self.names), dtype=np.float64)
+        self.values[: self.n_params] = self.initial_param_values
+        self.fixed_expr_idxs: Set[int] = set()
+        self.update_expressions(range(self.n_params, len(self.names)))
+
+    def update_expressions(self, expr_idxs) -> None:
+        """Evaluate expressions, their indices should be in definition order."""
+        for expr_idx in expr_idxs:
+            if expr_idx not in self.fixed_expr_idxs:
+                self.values[expr_idx] = self.expr_fns[expr_idx - self.n_params](*self.values)[0]
+
+    def set_value(self, name: str, value: float) -> List[int]:
+        """Set a parameter or fix an expression to a value.
+
+        Returns:
+            Indices of reactions with rates depending on the value.
+        """
+        if name not in self.idx_by_name:
+            raise ValueError(f"Expression or Parameter {name} not found")
+
+        atom_idx = self.idx_by_name[name]
+        if atom_idx >= self.n_params:
+            self.fixed_expr_idxs.add(atom_idx)
+
+        self.values[atom_idx] = value
+        self.update_expressions(self.expr_idxs_by_atom_idx.get(atom_idx, []))
+
+        return self.reac_idxs_by_atom_idx.get(atom_idx, [])
+
+    def rates(self) -> np.ndarray:
+        """Rate constants of all reactions."""
+        return np.array(self.rate_fn(*self.values), dtype=np.float64)
+
+    def initial_values(self) -> np.ndarray:
+        """Values of initial conditions, in the order of `pysb_model.initial_conditions`."""
+        return np.array(self.initial_fn(*self.values), dtype=np.float64)
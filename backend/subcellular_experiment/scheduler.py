@@ -0,0 +1,222 @@
+import heapq
+import itertools
+from typing import Optional, Dict, List, Tuple, Iterator
+
+from .types import SimConfig
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+# Rough wall time in seconds per simulated time step and per model entity
+SOLVER_COST_FACTORS: Dict[str, float] = {
+    "ode": 1e-5,
+    "ssa": 1e-4,
+    "nfsim": 2e-4,
+    "tetopsplit": 5e-4,
+    "tetexact": 1e-3,
+}
+MODEL_ENTITY_KEYS = ["structures", "molecules", "species", "reactions", "diffusions", "observables", "functions"]
+DEFAULT_MODEL_SIZE = 10
+MIN_SIM_COST = 1.0
+
+HeapKey = Tuple[int, float, int]
+
+
+def estimate_model_size(model: Optional[dict], model_str: str = "") -> int:
+    """Number of entities of a model, or number of non-empty lines of BNGL when a model string is given."""
+    if model_str:
+        return len([line for line in model_str.splitlines() if line.strip()])
+
+    if not model:
+        return DEFAULT_MODEL_SIZE
+
+    size = sum(len(model.get(key) or []) for key in MODEL_ENTITY_KEYS)
+    return size or DEFAULT_MODEL_SIZE
+
+
+def estimate_sim_cost(sim_conf: SimConfig, model_size: int) -> float:
+    """Estimated wall time of a simulation in seconds."""
+    t_end = sim_conf.solverConf.get("tEnd") or 0
+    dt = sim_conf.solverConf.get("dt") or 0
+    n_steps = t_end / dt if dt > 0 else 1
+
+    return max(SOLVER_COST_FACTORS.get(sim_conf.solver, 1e-4) * n_steps * model_size, MIN_SIM_COST)
+
+
+class IndexedHeap:
+    """Binary min-heap of ids with an index of their positions.
+
+    The index allows to remove any id in O(log n) time, push and pop are O(log n) as well.
+    """
+
+    def __init__(self) -> None:
+        self.entries: List[Tuple[HeapKey, str]] = []
+        self.position_by_id: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """Number of ids in the heap."""
+        return len(self.entries)
+
+    def __contains__(self, item_id: str) -> bool:
+        """Whether an id is in the heap."""
+        return item_id in self.position_by_id
+
+    def push(self, item_id: str, key: HeapKey) -> None:
+        if item_id in self.position_by_id:
+            raise ValueError(f"{item_id} is already in the heap")
+
+        self.entries.append((key, item_id))
+        self.position_by_id[item_id] = len(self.entries) - 1
+        self.sift_up(len(self.entries) - 1)
+
+    def peek(self) -> Optional[str]:
+        return self.entries[0][1] if self.entries else None
+
+    def pop(self) -> str:
+        if not self.entries:
+            raise IndexError("pop from an empty heap")
+
+        item_id = self.entries[0][1]
+        self.remove_at(0)
+        return item_id
+
+    def remove(self, item_id: str) -> bool:
+        position = self.position_by_id.get(item_id)
+        if position is None:
+            return False
+
+        self.remove_at(position)
+        return True
+
+    def ordered(self) -> List[str]:
+        """Ids in the order they would be popped, O(n log n)."""
+        return [item_id for _, item_id in sorted(self.entries)]
+
+    def remove_at(self, position: int) -> None:
+        last_position = len(self.entries) - 1
+        self.swap(position, last_position)
+
+        _, item_id = self.entries.pop()
+        del self.position_by_id[item_id]
+
+        if position < len(self.entries):
+            self.sift_down(position)
+            self.sift_up(position)
+
+    def swap(self, i: int, j: int) -> None:
+        self.entries[i], self.entries[j] = self.entries[j], self.entries[i]
+        self.position_by_id[self.entries[i][1]] = i
+        self.position_by_id[self.entries[j][1]] = j
+
+    def sift_up(self, position: int) -> None:
+        while position > 0:
+            parent = (position - 1) // 2
+            if self.entries[parent][0] <= self.entries[position][0]:
+                break
+            self.swap(position, parent)
+            position = parent
+
+    def sift_down(self, position: int) -> None:
+        size = len(self.entries)
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and self.entries[child][0] < self.entries[smallest][0]:
+                    smallest = child
+            if smallest == position:
+                break
+            self.swap(position, smallest)
+            position = smallest
+
+
+class SimScheduler:
+    """Queue of simulations with priorities and per user fair share.
+
+    Within a priority, sims are ordered by start-time fair queuing: every user has a virtual clock
+    which advances by the estimated cost of each of their sims. A user with many queued sims gets
+    their sims interleaved with the ones of other users instead of running them all first.
+    """
+
+    def __init__(self) -> None:
+        self.heap = IndexedHeap()
+        self.sim_conf_by_id: Dict[str, SimConfig] = {}
+        self.cost_by_id: Dict[str, float] = {}
+        self.start_tag_by_id: Dict[str, float] = {}
+        self.finish_tag_by_user: Dict[str, float] = {}
+        self.queued_count_by_user: Dict[str, int] = {}
+        self.virtual_time = 0.0
+        self.seq = itertools.count()
+
+    def __len__(self) -> int:
+        """Number of queued sims."""
+        return len(self.heap)
+
+    def __contains__(self, sim_id: str) -> bool:
+        """Whether a sim is queued."""
+        return sim_id in self.heap
+
+    def __iter__(self) -> Iterator[SimConfig]:
+        """Queued sims in the order they would be popped."""
+        return (self.sim_conf_by_id[sim_id] for sim_id in self.heap.ordered())
+
+    def push(self, sim_conf: SimConfig, cost: float) -> None:
+        user_id = sim_conf.userId
+
+        # Users without queued sims start at the current virtual time, so idle time is not saved up
+        if self.queued_count_by_user.get(user_id):
+            start_tag = max(self.finish_tag_by_user[user_id], self.virtual_time)
+        else:
+            start_tag = self.virtual_time
+
+        self.finish_tag_by_user[user_id] = start_tag + cost
+        self.queued_count_by_user[user_id] = self.queued_count_by_user.get(user_id, 0) + 1
+
+        self.sim_conf_by_id[sim_conf.id] = sim_conf
+        self.cost_by_id[sim_conf.id] = cost
+        self.start_tag_by_id[sim_conf.id] = start_tag
+        self.heap.push(sim_conf.id, (-(sim_conf.priority or 0), start_tag, next(self.seq)))
+
+    def pop(self) -> Tuple[SimConfig, float]:
+        """Remove the next sim to run and return it with its estimated cost."""
+        sim_id = self.heap.pop()
+        self.virtual_time = max(self.virtual_time, self.start_tag_by_id[sim_id])
+        return self.release(sim_id)
+
+    def remove(self, sim_id: str) -> Optional[SimConfig]:
+        if not self.heap.remove(sim_id):
+            return None
+
+        sim_conf, _ = self.release(sim_id)
+        return sim_conf
+
+    def release(self, sim_id: str) -> Tuple[SimConfig, float]:
+        sim_conf = self.sim_conf_by_id.pop(sim_id)
+        cost = self.cost_by_id.pop(sim_id)
+        del self.start_tag_by_id[sim_id]
+        self.queued_count_by_user[sim_conf.userId] -= 1
+
+        if not self.queued_count_by_user[sim_conf.userId]:
+            del self.queued_count_by_user[sim_conf.userId]
+            del self.finish_tag_by_user[sim_conf.userId]
+
+        return sim_conf, cost
+
+    def estimate_start_times(self, slot_free_times: List[float]) -> Dict[str, float]:
+        """Estimate number of seconds until each queued sim starts.
+
+        Args:
+            slot_free_times: Number of seconds until each worker slot becomes free, 0 for free slots.
+        """
+        if not slot_free_times:
+            return {}
+
+        slot_free_times = list(slot_free_times)
+        heapq.heapify(slot_free_times)
+
+        start_time_by_id = {}
+        for sim_id in self.heap.ordered():
+            start_time = heapq.heappop(slot_free_times)
+            start_time_by_id[sim_id] = start_time
+            heapq.heappush(slot_free_times, start_time + self.cost_by_id[sim_id])
+
+        return start_time_by_id
@@ -1,2 +1,3 @@
 BNG_PATH = "/BioNetGen/BNG2.pl"
 NFSIM_PATH = "/BioNetGen/bin/NFsim"
+MPIRUN_PATH = "mpirun"
@@ -1,8 +1,9 @@
 from typing import Dict, List, Optional, Union, Literal
-from pydantic import BaseModel
 
-from .types import SimStatus as SimStatusLiteral
+import numpy as np
+from pydantic import BaseModel
 
+from .types import SimStatus as SimStatusLiteral, LogLevel
 
 STIMULUS_TYPE_BY_CODE = {
     0: "setParam",
@@ -24,16 +25,37 @@ def decompress_stimulation(stimulation):
 
 
 class SimSpatialStepTrace(BaseModel):
+    """Molecule counts per tet/tri at a time step.
+
+    Attributes:
+        keyframe: Whether data holds all non-zero counts, otherwise only counts changed since the previous step
+    """
+
     type: Literal["simSpatialStepTrace"] = "simSpatialStepTrace"
     stepIdx: int
     t: float
     data: Dict[str, Dict[str, dict]]
+    keyframe: bool = True
 
 
 class SimLogMessage(BaseModel):
     type: Literal["simLogMessage"] = "simLogMessage"
     message: str
     source: str = "system"
+    level: LogLevel = "info"
+
+
+class SimLogBatch(BaseModel):
+    """Log lines of a sim sent together.
+
+    Attributes:
+        lines: New lines by log source
+        firstLine: Index of the first new line within its source
+    """
+
+    type: Literal["simLogBatch"] = "simLogBatch"
+    lines: Dict[str, List[str]]
+    firstLine: Dict[str, int]
 
 
 class SimLog(BaseModel):
@@ -42,15 +64,23 @@ class SimLog(BaseModel):
 
 
 class SimProgress(BaseModel):
+    """Simulation progress.
+
+    Attributes:
+        progress: Progress in percent
+        eta: Estimated number of seconds until the simulation finishes
+    """
+
     type: Literal["simProgress"] = "simProgress"
     progress: float
+    eta: Optional[float]
 
 
 class SimTrace(BaseModel):
     """Simulation trace for a given observable.
 
     Attributes:
-        times: List of time points
+        times: List or NumPy array of time points
         values: Dict mapping of observables to values
     """
 
@@ -58,8 +88,13 @@ class SimTrace(BaseModel):
     index: int
     persist: bool = False
     stream: bool = True
-    times: List[float]
-    values_by_observable: Dict[str, List[float]]
+    times: Union[np.ndarray, List[float]]
+    values_by_observable: Dict[str, Union[np.ndarray, List[float]]]
+
+    class Config:
+        """Allow NumPy arrays as values."""
+
+        arbitrary_types_allowed = True
 
 
 class SimStatus(BaseModel):
@@ -0,0 +1,288 @@
+import queue
+import struct
+import threading
+from collections import deque
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
+from typing import Deque, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .sim import SimData, SimSpatialStepTrace, SimTrace
+from .worker_message import extract_arrays, insert_arrays
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+# Position up to which the reader has released the ring, stored at the start of the shared memory
+RELEASED_POS = struct.Struct("<Q")
+RING_HEADER_SIZE = 64
+RING_ALIGNMENT = 8
+# Max number of consecutive trace frames merged into one message
+TRACE_COALESCE_MAX_FRAMES = 100
+
+# dtype, shape and position within the ring of an array
+ArrayDescriptor = Tuple[str, Tuple[int, ...], int]
+
+
+def _aligned(size: int) -> int:
+    return -(-size // RING_ALIGNMENT) * RING_ALIGNMENT
+
+
+def trace_continued_by(trace: SimTrace, next_trace: SimTrace) -> bool:
+    """Whether a trace which hasn't fit into the ring holds rows directly following the rows of another one."""
+    return (
+        next_trace.index == trace.index + len(trace.times)
+        and next_trace.persist == trace.persist
+        and next_trace.stream == trace.stream
+        and list(next_trace.values_by_observable) == list(trace.values_by_observable)
+    )
+
+
+def merge_traces(traces: List[SimTrace]) -> SimTrace:
+    """Trace with the rows of traces continuing each other."""
+    if len(traces) == 1:
+        return traces[0]
+
+    first = traces[0]
+    return SimTrace(
+        index=first.index,
+        persist=first.persist,
+        stream=first.stream,
+        times=np.concatenate([np.asarray(trace.times, dtype=np.float64) for trace in traces]),
+        values_by_observable={
+            name: np.concatenate([np.asarray(trace.values_by_observable[name], dtype=np.float64) for trace in traces])
+            for name in first.values_by_observable
+        },
+    )
+
+
+class RingFrame:
+    """Sim data message with its arrays in the ring buffer, only this descriptor goes through the queue.
+
+    Attributes:
+        header: Message without arrays, for a spatial trace arrays are replaced with references to descriptors
+        arrays: Descriptors of arrays of the message, times and rows of values for a trace
+        end: Position following the frame in the ring, which the reader releases once the frame is sent
+        observables: Observables of values of a trace, by column
+    """
+
+    def __init__(
+        self, type_: str, header: dict, arrays: List[ArrayDescriptor], end: int, observables: Optional[List[str]]
+    ) -> None:
+        self.type = type_
+        self.header = header
+        self.arrays = arrays
+        self.end = end
+        self.observables = observables
+
+    def continued_by(self, frame: "RingFrame") -> bool:
+        """Whether a frame holds trace rows directly following the rows of this one."""
+        if self.type != "simTrace" or frame.type != "simTrace":
+            return False
+
+        n_rows = self.arrays[0][1][0]
+        return (
+            frame.header["index"] == self.header["index"] + n_rows
+            and frame.header["persist"] == self.header["persist"]
+            and frame.header["stream"] == self.header["stream"]
+            and frame.observables == self.observables
+        )
+
+
+class SimDataChannel:
+    """Transport of sim data from a sim process to the worker thread forwarding it to the backend.
+
+    Arrays of traces and spatial traces are written to a shared memory ring buffer, the queue only
+    carries frame descriptors and small messages. The queue is unbounded and a message which doesn't
+    fit into the free space of the ring is sent pickled through the queue, so that a sim never waits
+    for a slow backend connection.
+
+    There is one writer, the sim process, and one reader. Frames are read in the order they were
+    written, the reader releases the ring space of a frame once its message has been sent.
+    The sim process is forked, so that it shares the channel with the worker.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.queue: Queue = Queue()
+        self.size = size
+        self.shm: Optional[SharedMemory] = None
+        try:
+            self.shm = SharedMemory(create=True, size=RING_HEADER_SIZE + size)
+            RELEASED_POS.pack_into(self.shm.buf, 0, 0)
+        except OSError as error:
+            L.warning(f"can't create shared memory, sim data will go through the queue: {error}")
+
+        # writer state, in the sim process
+        self.write_pos = 0
+        # reentrant, as the SIGTERM handler of the sim process sends its last messages from the main thread
+        self.lock = threading.RLock()
+        self.n_fallbacks = 0
+
+        # reader state
+        self.pending: Deque[Union[SimData, RingFrame]] = deque()
+
+    def array_view(self, descriptor: ArrayDescriptor) -> np.ndarray:
+        dtype, shape, position = descriptor
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=RING_HEADER_SIZE + position % self.size)  # type: ignore
+
+    def reserve(self, size: int) -> Optional[int]:
+        """Position of `size` contiguous bytes in the ring, None if they aren't free."""
+        if size > self.size:
+            return None
+
+        position = self.write_pos
+        offset = position % self.size
+        if offset + size > self.size:
+            # frames don't wrap around, the rest of the ring is skipped
+            position += self.size - offset
+
+        (released_pos,) = RELEASED_POS.unpack_from(self.shm.buf, 0)  # type: ignore
+        if position + size - released_pos > self.size:
+            return None
+
+        self.write_pos = position + size
+        return position
+
+    def put(self, sim_data: SimData) -> None:
+        """Send sim data to the reader, never blocks."""
+        with self.lock:
+            # frames are queued in the order they are written to the ring, also from several threads
+            frame = None
+            if self.shm is not None and isinstance(sim_data, (SimTrace, SimSpatialStepTrace)):
+                frame = self.write_frame(sim_data)
+
+            self.queue.put(sim_data if frame is None else frame)
+
+    def write_frame(self, sim_data: Union[SimTrace, SimSpatialStepTrace]) -> Optional[RingFrame]:
+        observables = None
+        if isinstance(sim_data, SimTrace):
+            observables = list(sim_data.values_by_observable)
+            times = np.asarray(sim_data.times, dtype=np.float64)
+            columns = [np.asarray(sim_data.values_by_observable[name], dtype=np.float64) for name in observables]
+            header = sim_data.dict(exclude={"times", "values_by_observable"})
+            shapes = [(times.shape, np.dtype(np.float64)), ((len(times), len(columns)), np.dtype(np.float64))]
+        else:
+            arrays: List[np.ndarray] = []
+            header = extract_arrays(sim_data.dict(), arrays)
+            if any(array.dtype.hasobject for array in arrays):
+                return None
+            shapes = [(array.shape, array.dtype) for array in arrays]
+
+        positions = []
+        size = 0
+        for shape, dtype in shapes:
+            positions.append(size)
+            size = _aligned(size + int(np.prod(shape, dtype=np.int64)) * dtype.itemsize)
+
+        start = self.reserve(size)
+        if start is None:
+            self.n_fallbacks += 1
+            if self.n_fallbacks == 1:
+                L.debug("shared memory ring is full, sim data goes through the queue")
+            return None
+
+        descriptors = [(dtype.str, shape, start + position) for (shape, dtype), position in zip(shapes, positions)]
+        views = [self.array_view(descriptor) for descriptor in descriptors]
+
+        if observables is not None:
+            views[0][...] = times
+            for idx, column in enumerate(columns):
+                views[1][:, idx] = column
+        else:
+            for view, array in zip(views, arrays):
+                view[...] = array
+
+        return RingFrame(sim_data.type, header, descriptors, start + size, observables)
+
+    def get(self, timeout: float) -> Union[SimData, List[RingFrame]]:
+        """Next sim data, frames of a message in the ring are returned as a list.
+
+        Trace frames already waiting in the queue which continue each other are returned together,
+        to be sent as a single message, the same goes for traces which haven't fit into the ring.
+
+        Raises:
+            queue.Empty: If there is no sim data within the timeout.
+        """
+        item = self.pending.popleft() if self.pending else self.queue.get(timeout=timeout)
+        if isinstance(item, SimTrace):
+            return self.coalesce_traces(item)
+
+        if not isinstance(item, RingFrame):
+            return item
+
+        frames = [item]
+        while frames[-1].type == "simTrace" and len(frames) < TRACE_COALESCE_MAX_FRAMES:
+            try:
+                next_item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if isinstance(next_item, RingFrame) and frames[-1].continued_by(next_item):
+                frames.append(next_item)
+            else:
+                self.pending.append(next_item)
+                break
+
+        return frames
+
+    def coalesce_traces(self, trace: SimTrace) -> SimTrace:
+        traces = [trace]
+        while len(traces) < TRACE_COALESCE_MAX_FRAMES:
+            try:
+                next_item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if isinstance(next_item, SimTrace) and trace_continued_by(traces[-1], next_item):
+                traces.append(next_item)
+            else:
+                self.pending.append(next_item)
+                break
+
+        return merge_traces(traces)
+
+    def read(self, frames: List[RingFrame]) -> dict:
+        """Data of the message of frames.
+
+        Arrays of a single frame are views into the ring, which are valid until the frame is released.
+        """
+        frame = frames[0]
+        if frame.observables is None:
+            return insert_arrays(frame.header, [self.array_view(descriptor) for descriptor in frame.arrays])
+
+        if len(frames) == 1:
+            times = self.array_view(frame.arrays[0])
+            values = self.array_view(frame.arrays[1])
+        else:
+            times = np.concatenate([self.array_view(frame.arrays[0]) for frame in frames])
+            values = np.concatenate([self.array_view(frame.arrays[1]) for frame in frames])
+
+        return {
+            **frame.header,
+            "times": times,
+            "values_by_observable": {name: values[:, idx] for idx, name in enumerate(frame.observables)},
+        }
+
+    def release(self, frames: List[RingFrame]) -> None:
+        """Free the ring space of frames, threadsafe, frames released out of order or after closing are ignored."""
+        with self.lock:
+            if self.shm is None:
+                return
+
+            (released_pos,) = RELEASED_POS.unpack_from(self.shm.buf, 0)
+            RELEASED_POS.pack_into(self.shm.buf, 0, max(released_pos, frames[-1].end))
+
+    def close(self) -> None:
+        """Free the shared memory, called by the reader once the sim process has exited."""
+        with self.lock:
+            if self.shm is None:
+                return
+
+            self.shm.unlink()
+            try:
+                self.shm.close()
+            except BufferError:
+                # a view is still referenced, memory is freed with it
+                L.warning("shared memory of a sim channel is still in use")
+            self.shm = None
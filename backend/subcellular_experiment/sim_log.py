@@ -0,0 +1,89 @@
+import time
+import zlib
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+from .envvars import SIM_LOG_LEVEL
+from .sim import SimLogBatch, SimLogMessage
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+# Batched log lines are sent by a worker at most this number of seconds after they were logged
+SIM_LOG_BATCH_SECS = 1
+# or as soon as a batch has this number of lines
+SIM_LOG_BATCH_MAX_LINES = 1000
+# Number of last lines of every source a worker keeps to serve logs of running sims
+SIM_LOG_TAIL_LINES = 2000
+
+
+def sim_log_level(sim_config: dict) -> str:
+    level = (sim_config.get("solverConf") or {}).get("logLevel") or SIM_LOG_LEVEL
+    return level if level in LOG_LEVELS else "info"
+
+
+def log_level_enabled(level: str, threshold: str) -> bool:
+    return LOG_LEVELS.get(level, LOG_LEVELS["info"]) >= LOG_LEVELS[threshold]
+
+
+def compress_lines(lines: List[str]) -> bytes:
+    return zlib.compress("\n".join(lines).encode("utf-8"))
+
+
+def decompress_lines(data: bytes) -> List[str]:
+    return zlib.decompress(data).decode("utf-8").split("\n")
+
+
+class SimLogBuffer:
+    """Log of a running sim on a worker: last lines of every source and lines pending to be sent.
+
+    Pending lines are sent in one batch once the oldest of them is SIM_LOG_BATCH_SECS old or there are
+    SIM_LOG_BATCH_MAX_LINES of them, instead of a message per log line. The tail is read by the thread
+    handling backend messages while the slot thread adds lines, hence the lock.
+    """
+
+    def __init__(self, tail_lines: int = SIM_LOG_TAIL_LINES) -> None:
+        self.tail_by_source: Dict[str, Deque[str]] = defaultdict(lambda: deque(maxlen=tail_lines))
+        self.n_lines_by_source: Dict[str, int] = defaultdict(int)
+        self.pending_by_source: Dict[str, List[str]] = defaultdict(list)
+        self.n_pending = 0
+        self.pending_since: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def add(self, sim_log_msg: SimLogMessage) -> None:
+        # multiline messages are stored as separate lines, so that line indices are the same everywhere
+        lines = sim_log_msg.message.split("\n")
+        with self.lock:
+            self.tail_by_source[sim_log_msg.source].extend(lines)
+            self.pending_by_source[sim_log_msg.source].extend(lines)
+            self.n_pending += len(lines)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+
+    @property
+    def batch_due(self) -> bool:
+        if self.pending_since is None:
+            return False
+        return self.n_pending >= SIM_LOG_BATCH_MAX_LINES or time.monotonic() - self.pending_since >= SIM_LOG_BATCH_SECS
+
+    def pop_batch(self) -> Optional[SimLogBatch]:
+        with self.lock:
+            if not self.n_pending:
+                return None
+
+            first_line = {source: self.n_lines_by_source[source] for source in self.pending_by_source}
+            for source, lines in self.pending_by_source.items():
+                self.n_lines_by_source[source] += len(lines)
+
+            batch = SimLogBatch(lines=dict(self.pending_by_source), firstLine=first_line)
+
+            self.pending_by_source = defaultdict(list)
+            self.n_pending = 0
+            self.pending_since = None
+
+        return batch
+
+    @property
+    def tail(self) -> Dict[str, List[str]]:
+        with self.lock:
+            return {source: list(lines) for source, lines in self.tail_by_source.items()}
@@ -1,13 +1,14 @@
 # pylint: disable=dangerous-default-value
-import os
-from typing import Optional, List, Dict, Any
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Callable, Tuple
 from collections import defaultdict
-import json
 
 from .sim import (
     SimProgress,
     SimTrace,
-    SimLogMessage,
+    SimLogBatch,
     SimSpatialStepTrace,
     SimLog,
     SimStatus,
@@ -22,14 +23,94 @@ from .types import (
 )
 from .logger import get_logger
 from .db import Db
+from .trace_store import TraceWriter, SpatialTraceWriter, read_spatial_step_trace
+from .spatial_encoding import SpatialTraceDecoder
+from .scheduler import SimScheduler, estimate_model_size, estimate_sim_cost
+from .ensemble import Ensemble, expand_ensemble
 
 L = get_logger(__name__)
 
+FINAL_SIM_STATUSES = ["error", "finished", "cancelled"]
+# Number of rows per trace chunk of an ensemble summary
+ENSEMBLE_TRACE_CHUNK_SIZE = 10000
+# Min number of seconds between two updates of queue positions
+QUEUE_POSITIONS_INTERVAL_SECS = 1
+# Users aren't notified about estimated start times which have moved by less than this
+QUEUE_ETA_TOLERANCE_SECS = 5
+
+# Position in the queue and estimated start timestamp of a sim
+QueuePosition = Tuple[int, Optional[float]]
+
+
+def eta_close(start_at: Optional[float], other_start_at: Optional[float]) -> bool:
+    if start_at is None or other_start_at is None:
+        return start_at is other_start_at
+
+    return abs(start_at - other_start_at) < QUEUE_ETA_TOLERANCE_SECS
+
 
 class SimWorker:
     def __init__(self, worker_websocket: WebSocketHandler) -> None:
         self.ws = worker_websocket
-        self.sim_conf: Optional[SimConfig] = None
+        self.slots = 1
+        self.sim_conf_by_id: Dict[str, SimConfig] = {}
+        # Estimated wall clock time at which each running sim finishes
+        self.sim_end_time_by_id: Dict[str, float] = {}
+
+    @property
+    def free_slots(self) -> int:
+        return max(self.slots - len(self.sim_conf_by_id), 0)
+
+    def slot_free_times(self, now: float) -> List[float]:
+        """Number of seconds until each slot of the worker becomes free."""
+        busy_slot_free_times = [
+            max(self.sim_end_time_by_id.get(sim_id, now) - now, 0) for sim_id in self.sim_conf_by_id
+        ]
+        return [0.0] * self.free_slots + busy_slot_free_times
+
+
+class SpatialTraceSubscription:
+    """Delivery of spatial step traces of a sim to one client connection.
+
+    Frames are sent at most `fps` times per second and only every `stride`-th step is considered.
+    Only the latest undelivered frame is kept, so frames are dropped instead of queued when the client
+    can't keep up. The next frame is sent once the previous one has been written to the connection.
+    """
+
+    def __init__(self, ws: WebSocketHandler, sim_id: str, fps: Optional[float] = None, stride: int = 1) -> None:
+        self.ws = ws
+        self.sim_id = sim_id
+        self.min_interval = 1 / fps if fps else 0
+        self.stride = max(stride, 1)
+        self.pending: Optional[dict] = None
+        self.last_sent = 0.0
+        self.dropped = 0
+        self.delivery: Optional[asyncio.Task] = None
+
+    def push(self, frame: dict) -> None:
+        if frame["stepIdx"] % self.stride != 0:
+            return
+
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = frame
+
+        if self.delivery is None or self.delivery.done():
+            self.delivery = asyncio.create_task(self.deliver())
+
+    async def deliver(self) -> None:
+        while self.pending is not None:
+            wait_secs = self.last_sent + self.min_interval - time.time()
+            if wait_secs > 0:
+                await asyncio.sleep(wait_secs)
+
+            frame, self.pending = self.pending, None
+            self.last_sent = time.time()
+            await self.ws.send_message("simSpatialStepTrace", frame)
+
+    def cancel(self) -> None:
+        if self.delivery is not None:
+            self.delivery.cancel()
 
 
 class SimManager:
@@ -37,8 +118,20 @@ class SimManager:
         self.workers: List[SimWorker] = []
         self.worker_by_sim_id: Dict[str, SimWorker] = {}
         self.clients: Dict[str, List[WebSocketHandler]] = defaultdict(list)
-        self.sim_conf_queue: List[SimConfig] = []
+        self.scheduler = SimScheduler()
         self.db = db
+        self.trace_writers: Dict[str, TraceWriter] = {}
+        self.spatial_trace_writers: Dict[str, SpatialTraceWriter] = {}
+        # Workers send spatial traces as keyframes and deltas, clients get full steps
+        self.spatial_trace_decoders: Dict[str, SpatialTraceDecoder] = {}
+        self.spatial_subscriptions: Dict[str, List[SpatialTraceSubscription]] = defaultdict(list)
+        self.ensembles: Dict[str, Ensemble] = {}
+        self.queue_positions_task: Optional[asyncio.Future] = None
+        self.queue_positions_sent_at = 0.0
+        # Position and estimated start time of queued sims as last sent to their users
+        self.sent_queue_position_by_id: Dict[str, QueuePosition] = {}
+        # Single thread keeps trace file writes ordered and off the event loop
+        self.trace_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace_io")
 
     def add_worker(self, worker: SimWorker) -> None:
         self.workers.append(worker)
@@ -46,18 +139,35 @@ class SimManager:
         self.log_workers_status()
 
     async def remove_worker(self, worker: SimWorker) -> None:
-        if worker.sim_conf is not None:
-            await self.process_sim_status(worker.sim_conf.userId, worker.sim_conf.simId, "error")
+        for sim_conf in list(worker.sim_conf_by_id.values()):
+            if sim_conf.ensembleId is not None:
+                await self.process_ensemble_member_status(sim_conf, "error")
+            else:
+                await self.process_sim_status(sim_conf.userId, sim_conf.simId, "error")
+            self.release_sim(worker, sim_conf.id)
         self.workers.remove(worker)
         L.debug("worker has been removed")
         self.log_workers_status()
 
     def log_workers_status(self) -> None:
-        L.debug(f"workers: {len(self.workers)}, free: {len(self.free_workers)}")
+        free_slots = sum(worker.free_slots for worker in self.workers)
+        L.debug(f"workers: {len(self.workers)}, free: {len(self.free_workers)}, free slots: {free_slots}")
 
     @property
     def free_workers(self) -> List[SimWorker]:
-        return [worker for worker in self.workers if worker.sim_conf is None]
+        return [worker for worker in self.workers if worker.free_slots > 0]
+
+    def get_sim_worker(self, sim_id: str) -> Optional[SimWorker]:
+        worker = self.worker_by_sim_id.get(sim_id)
+        if worker is None or sim_id not in worker.sim_conf_by_id:
+            return None
+        return worker
+
+    def release_sim(self, worker: SimWorker, sim_id: str) -> None:
+        worker.sim_conf_by_id.pop(sim_id, None)
+        worker.sim_end_time_by_id.pop(sim_id, None)
+        if self.worker_by_sim_id.get(sim_id) is worker:
+            del self.worker_by_sim_id[sim_id]
 
     def add_client(self, user_id: str, ws: WebSocketHandler) -> None:
         self.clients[user_id].append(ws)
@@ -65,169 +175,285 @@ class SimManager:
 
     def remove_client(self, user_id: str, ws: WebSocketHandler) -> None:
         self.clients[user_id].remove(ws)
+        for sim_id in list(self.spatial_subscriptions):
+            self.unsubscribe_spatial_trace(ws, sim_id)
         L.debug("connection for client {user_id} has been removed")
 
-    def prune_workers(self, worker: SimWorker, sim_config: SimConfig) -> None:
+    def subscribe_spatial_trace(
+        self, ws: WebSocketHandler, sim_id: str, fps: Optional[float] = None, stride: int = 1
+    ) -> None:
+        self.unsubscribe_spatial_trace(ws, sim_id)
+        self.spatial_subscriptions[sim_id].append(SpatialTraceSubscription(ws, sim_id, fps, stride))
+        L.debug(f"subscribed to spatial trace of {sim_id}, fps: {fps}, stride: {stride}")
+
+    def unsubscribe_spatial_trace(self, ws: WebSocketHandler, sim_id: str) -> None:
+        subscriptions = self.spatial_subscriptions.get(sim_id, [])
+        for subscription in [subscription for subscription in subscriptions if subscription.ws is ws]:
+            subscription.cancel()
+            subscriptions.remove(subscription)
+            L.debug(f"unsubscribed from spatial trace of {sim_id}, dropped frames: {subscription.dropped}")
+
+        if sim_id in self.spatial_subscriptions and not subscriptions:
+            del self.spatial_subscriptions[sim_id]
+
+    def prune_workers(self, worker: SimWorker, sim_configs: List[SimConfig]) -> None:
         """
-        When a worker with a running sim reconnects find the old worker instance
-        and assign it's config to the newly created one.
+        When a worker with running sims reconnects find the old worker instance
+        and assign it's configs to the newly created one.
         """
-        stale_worker = self.worker_by_sim_id.get(sim_config.id)
+        for sim_config in sim_configs:
+            stale_worker = self.worker_by_sim_id.get(sim_config.id)
+
+            if stale_worker is not None and stale_worker is not worker and stale_worker in self.workers:
+                self.workers.remove(stale_worker)
 
-        if stale_worker is not None:
-            self.workers.remove(stale_worker)
+            self.worker_by_sim_id[sim_config.id] = worker
+            worker.sim_conf_by_id[sim_config.id] = sim_config
 
-        self.worker_by_sim_id[sim_config.id] = worker
-        worker.sim_conf = sim_config
         self.log_workers_status()
 
     async def process_worker_message(self, worker: SimWorker, msg: SimWorkerMessage) -> None:
         if msg.message == "worker_connect":
             if msg.data:
                 L.info("worker_reconnected")
-                sim_config = SimConfig(**msg.data)
-                self.prune_workers(worker, sim_config)
+                sim_configs = [SimConfig(**sim_config) for sim_config in msg.data]
+                self.prune_workers(worker, sim_configs)
             return
 
         if msg.message == "status":
-            status = Status(**msg.dict())
+            capacity = Status(**msg.dict()).data
 
-            if status.data == "ready":
-                worker.sim_conf = None
-            L.debug(f"sim worker reported as {status.data}")
+            worker.slots = capacity.slots
+            if capacity.releasedSimId is not None:
+                self.release_sim(worker, capacity.releasedSimId)
+            L.debug(f"sim worker reported {capacity.freeSlots} of {capacity.slots} slots as free")
             self.log_workers_status()
             await self.run_available()
             return
 
-        if worker.sim_conf is None:
+        sim_conf = worker.sim_conf_by_id.get((msg.data or {}).get("simId") or "")
+
+        if sim_conf is None:
             L.warning("Worker doesn't have a sim config")
             return
 
         if msg.message == "simProgress":
             sim_progress = SimProgress(**msg.data)
-            await self.process_sim_progress(worker.sim_conf, sim_progress.progress)
+            if sim_progress.eta is not None:
+                worker.sim_end_time_by_id[sim_conf.id] = time.time() + sim_progress.eta
+
+        if sim_conf.ensembleId is not None:
+            await self.process_ensemble_member_message(sim_conf, msg)
+            return
+
+        if msg.message == "simProgress":
+            await self.process_sim_progress(sim_conf, sim_progress.progress, sim_progress.eta)
         elif msg.message == "simTrace":
             sim_trace = SimTrace(**msg.data)
-            await self.process_sim_trace(worker.sim_conf, sim_trace)
+            await self.process_sim_trace(sim_conf, sim_trace)
         elif msg.message == "simStatus":
             sim_status = SimStatus(**msg.data)
 
             await self.process_sim_status(
-                worker.sim_conf.userId,
-                worker.sim_conf.simId,
+                sim_conf.userId,
+                sim_conf.simId,
                 sim_status.status,
                 sim_status.dict(),
             )
 
-        elif msg.message == "simLog":
-            sim_log = SimLog(**msg.data)
-
-            log = {
-                "log": sim_log.log,
-                "userId": worker.sim_conf.userId,
-                "simId": worker.sim_conf.id,
-            }
-
-            await self.db.create_sim_log(log)
-
-        elif msg.message == "simLogMessage":
-            sim_log_msg = SimLogMessage(**msg.data)
-            await self.send_message(
-                worker.sim_conf.userId,
-                "simLogMessage",
-                {**sim_log_msg.dict(), "simId": worker.sim_conf.id},
-            )
+        elif msg.message == "simLogBatch":
+            await self.process_sim_log_batch(sim_conf, SimLogBatch(**msg.data))
         elif msg.message == "simSpatialStepTrace":
             trace = SimSpatialStepTrace(**msg.data)
 
-            await self.process_sim_spatial_step_trace(worker.sim_conf, trace)
+            await self.process_sim_spatial_step_trace(sim_conf, trace)
         elif msg.message == "tmp_sim_log":
             sim_log = SimLog(**msg.data)
 
             tmp_sim_log = {
                 "log": sim_log.log,
-                "userId": worker.sim_conf.userId,
-                "simId": worker.sim_conf.id,
+                "userId": sim_conf.userId,
+                "simId": sim_conf.id,
             }
-            await self.send_message(worker.sim_conf.userId, "tmp_sim_log", tmp_sim_log, cmdid=msg.cmdid)
+            await self.send_message(sim_conf.userId, "tmp_sim_log", tmp_sim_log, cmdid=msg.cmdid)
+
+    async def process_ensemble_member_message(self, member_conf: SimConfig, msg: SimWorkerMessage) -> None:
+        """Fold messages of an ensemble member run into the state of its ensemble.
+
+        Members don't have their own simulation documents, traces of all members are aggregated
+        and stored under the ensemble id once all of them are done.
+        """
+        ensemble = self.ensembles.get(member_conf.ensembleId or "")
+        if ensemble is None:
+            return
+
+        if msg.message == "simProgress":
+            ensemble.progress_by_member[member_conf.id] = SimProgress(**msg.data).progress
+            await self.process_sim_progress(ensemble.sim_conf, ensemble.progress)
+        elif msg.message == "simTrace":
+            sim_trace = SimTrace(**msg.data)
+            if sim_trace.persist:
+                ensemble.add_trace(member_conf.id, sim_trace.index, sim_trace.times, sim_trace.values_by_observable)
+        elif msg.message == "simStatus":
+            await self.process_ensemble_member_status(member_conf, SimStatus(**msg.data).status)
+        elif msg.message == "simLogBatch" and member_conf.ensembleIdx == 0:
+            await self.process_sim_log_batch(ensemble.sim_conf, SimLogBatch(**msg.data))
+
+    async def process_ensemble_member_status(self, member_conf: SimConfig, status: SimStatusLiteral) -> None:
+        ensemble = self.ensembles.get(member_conf.ensembleId or "")
+        if ensemble is None:
+            return
+
+        sim_conf = ensemble.sim_conf
+
+        if status == "started" and not ensemble.started:
+            ensemble.started = True
+            await self.process_sim_status(sim_conf.userId, sim_conf.id, "started")
+
+        if status not in FINAL_SIM_STATUSES:
+            return
+
+        ensemble.status_by_member[member_conf.id] = status
+        ensemble.progress_by_member[member_conf.id] = 100
+        if not ensemble.done:
+            return
+
+        del self.ensembles[sim_conf.id]
+        L.debug(f"ensemble {sim_conf.id} is done, {ensemble.n_finished} of {len(ensemble.member_ids)} runs finished")
+
+        if ensemble.n_finished == 0:
+            await self.process_sim_status(sim_conf.userId, sim_conf.id, "error")
+            return
+
+        await self.process_ensemble_summary(ensemble)
+        await self.process_sim_status(sim_conf.userId, sim_conf.id, "finished")
+
+    async def process_ensemble_summary(self, ensemble: Ensemble) -> None:
+        """Store and stream aggregated traces of an ensemble as regular traces of the ensemble sim."""
+        for start in range(0, ensemble.length, ENSEMBLE_TRACE_CHUNK_SIZE):
+            times, values_by_observable = ensemble.summary(start, start + ENSEMBLE_TRACE_CHUNK_SIZE)
+            await self.process_sim_trace(
+                ensemble.sim_conf,
+                SimTrace(index=start, times=times, values_by_observable=values_by_observable, persist=True),
+            )
 
     async def schedule_sim(self, sim_conf: SimConfig) -> None:
         L.debug("scheduling a simulation")
-        self.sim_conf_queue.append(sim_conf)
+        model = await self.db.get_model(sim_conf.modelId) if sim_conf.modelId else None
+
+        if sim_conf.ensemble is not None:
+            await self.schedule_ensemble(sim_conf, model)
+            return
 
-        with open(f"/data/traces/{sim_conf.id}.json", "a") as file:
-            file.write("[]")
+        cost = estimate_sim_cost(sim_conf, estimate_model_size(model, sim_conf.model_str))
+        self.scheduler.push(sim_conf, cost)
+
+        await self.process_sim_status(sim_conf.userId, sim_conf.id, "queued")
+        await self.run_available()
 
-        spatial_sampling = sim_conf.solverConf.get("spatialSampling")
+    async def schedule_ensemble(self, sim_conf: SimConfig, model: Optional[dict]) -> None:
+        members = expand_ensemble(sim_conf)
+        self.ensembles[sim_conf.id] = Ensemble(sim_conf, members)
+        L.debug(f"scheduling ensemble {sim_conf.id} with {len(members)} runs")
 
-        if spatial_sampling and spatial_sampling["enabled"]:
-            with open(f"/data/spatial-traces/{sim_conf.id}.json", "a") as file:
-                file.write("[]")
+        model_size = estimate_model_size(model, sim_conf.model_str)
+        for member_conf in members:
+            self.scheduler.push(member_conf, estimate_sim_cost(member_conf, model_size))
 
         await self.process_sim_status(sim_conf.userId, sim_conf.id, "queued")
         await self.run_available()
 
     @property
     def running_sim_ids(self) -> List[str]:
-        return [worker.sim_conf.id for worker in self.workers if worker.sim_conf is not None]
+        return [sim_id for worker in self.workers for sim_id in worker.sim_conf_by_id]
 
     async def request_tmp_sim_log(self, sim_id, cmdid):
-        worker = next(
-            (worker for worker in self.workers if worker.sim_conf is not None and worker.sim_conf.id == sim_id),
-            None,
-        )
+        worker = self.get_sim_worker(sim_id)
 
         if worker:
-            await worker.ws.send_message("get_tmp_sim_log", cmdid=cmdid)
+            await worker.ws.send_message("get_tmp_sim_log", {"simId": sim_id}, cmdid=cmdid)
 
     async def request_tmp_sim_trace(self, sim_id, cmdid):
-        worker = next(
-            (worker for worker in self.workers if worker.sim_conf is not None and worker.sim_conf.id == sim_id),
-            None,
-        )
+        worker = self.get_sim_worker(sim_id)
 
         if worker:
-            await worker.ws.send_message("get_tmp_sim_trace", cmdid=cmdid)
+            await worker.ws.send_message("get_tmp_sim_trace", {"simId": sim_id}, cmdid=cmdid)
 
     async def cancel_sim(self, sim: SimId):
-        queue_idx = next(
-            (index for (index, sim_conf) in enumerate(self.sim_conf_queue) if sim_conf.id == sim.id),
-            None,
-        )
+        ensemble = self.ensembles.pop(sim.id, None)
+        if ensemble is not None:
+            await self.cancel_ensemble(ensemble)
+            return
+
+        queued_sim_conf = self.scheduler.remove(sim.id)
 
         await self.process_sim_status(sim.userId, sim.id, "cancelled")
 
-        if queue_idx is not None:
-            L.debug(f"sim to cancel is in queue, id: {queue_idx}")
-            self.sim_conf_queue.pop(queue_idx)
+        if queued_sim_conf is not None:
+            L.debug("sim to cancel has been removed from the queue")
+            await self.send_queue_positions()
             return
 
-        worker = next(
-            (worker for worker in self.workers if worker.sim_conf is not None and worker.sim_conf.id == sim.id),
-            None,
-        )
+        worker = self.get_sim_worker(sim.id)
 
         if not worker:
             L.debug("sim to cancel is not in the queue")
             return
 
         L.debug("sending message to worker to cancel the sim")
-        await worker.ws.send_message("cancel_sim")  # type: ignore
+        await worker.ws.send_message("cancel_sim", {"simId": sim.id})  # type: ignore
+
+    async def cancel_ensemble(self, ensemble: Ensemble) -> None:
+        """Remove queued member runs of an ensemble and cancel the running ones."""
+        sim_conf = ensemble.sim_conf
+        await self.process_sim_status(sim_conf.userId, sim_conf.id, "cancelled")
+
+        for member_id in ensemble.member_ids:
+            if self.scheduler.remove(member_id) is not None:
+                continue
+
+            worker = self.get_sim_worker(member_id)
+            if worker:
+                await worker.ws.send_message("cancel_sim", {"simId": member_id})  # type: ignore
+
+        L.debug(f"ensemble {sim_conf.id} has been cancelled")
+        await self.send_queue_positions()
 
     async def process_sim_status(self, user_id: str, sim_id: str, status: SimStatusLiteral, context={}) -> None:
+        await self.db.flush_sim_writes(sim_id)
         await self.db.update_simulation(
             UpdateSimulation(**{**context, "id": sim_id, "userId": user_id, "status": status})
         )
+
+        if status in FINAL_SIM_STATUSES:
+            await self.close_trace_writers(sim_id)
+
         await self.send_sim_status(user_id, sim_id, status, context=context)
 
-    async def process_sim_progress(self, sim_conf: SimConfig, progress: float, context={}) -> None:
+    async def run_trace_io(self, fn: Callable, *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(self.trace_io_executor, fn, *args)
+
+    async def close_trace_writers(self, sim_id: str) -> None:
+        trace_writer = self.trace_writers.pop(sim_id, None)
+        if trace_writer is not None:
+            await self.run_trace_io(trace_writer.close)
+
+        spatial_trace_writer = self.spatial_trace_writers.pop(sim_id, None)
+        if spatial_trace_writer is not None:
+            await self.run_trace_io(spatial_trace_writer.close)
+
+        self.spatial_trace_decoders.pop(sim_id, None)
+
+    async def process_sim_progress(
+        self, sim_conf: SimConfig, progress: float, eta: Optional[float] = None, context={}
+    ) -> None:
         user_id = sim_conf.userId
         sim_id = sim_conf.id
-        await self.db.update_simulation(
+        await self.db.buffer_sim_progress(
             UpdateSimulation(**{**context, "id": sim_id, "userId": user_id, "progress": progress})
         )
 
-        await self.send_message(user_id, "simProgress", {**context, "simId": sim_id, "progress": progress})
+        await self.send_message(user_id, "simProgress", {**context, "simId": sim_id, "progress": progress, "eta": eta})
 
     async def process_sim_spatial_step_trace(
         self, sim_conf: SimConfig, spatial_step_trace: SimSpatialStepTrace
@@ -236,23 +462,50 @@ class SimManager:
 
         trace = spatial_step_trace.dict()
 
-        await self.db.create_sim_spatial_step_trace({**trace, "userId": user_id, "simId": sim_conf.id})
+        await self.db.buffer_sim_spatial_step_trace(sim_conf.id, {**trace, "userId": user_id, "simId": sim_conf.id})
 
-        with open(f"/data/spatial-traces/{sim_conf.id}.json", "a") as file:
-            file.seek(0, os.SEEK_END)
-            file.seek(file.tell() - 1, os.SEEK_SET)
-            file.truncate()
+        if sim_conf.id not in self.spatial_trace_writers:
+            self.spatial_trace_writers[sim_conf.id] = SpatialTraceWriter(sim_conf.id)
 
-            lead_char = ", " if trace["stepIdx"] > 0 else ""
-            trace_str = json.dumps({**trace, "simId": sim_conf.id})
+        spatial_trace_writer = self.spatial_trace_writers[sim_conf.id]
+        await self.run_trace_io(
+            spatial_trace_writer.append,
+            spatial_step_trace.stepIdx,
+            spatial_step_trace.t,
+            spatial_step_trace.data,
+            spatial_step_trace.keyframe,
+        )
 
-            file.write(f"{lead_char}{trace_str}]")
+        subscriptions = self.spatial_subscriptions.get(sim_conf.id)
+        if not subscriptions:
+            # steps are only decoded for subscribers, a new one resyncs from the stored trace
+            self.spatial_trace_decoders.pop(sim_conf.id, None)
+            return
 
-        await self.send_message(
-            user_id,
-            "simSpatialStepTrace",
-            {**trace, "simId": sim_conf.id},
-        )
+        decoder = self.spatial_trace_decoders.get(sim_conf.id)
+        if decoder is not None:
+            data = decoder.decode(spatial_step_trace.data, spatial_step_trace.keyframe)
+        elif spatial_step_trace.keyframe:
+            decoder = self.spatial_trace_decoders[sim_conf.id] = SpatialTraceDecoder()
+            data = decoder.decode(spatial_step_trace.data)
+        else:
+            # the step just written is reconstructed from the last keyframe and the following deltas
+            step_trace = await self.run_trace_io(read_spatial_step_trace, sim_conf.id, spatial_step_trace.stepIdx)
+            if step_trace is None:
+                L.warning(f"can't resync spatial trace of {sim_conf.id} at step {spatial_step_trace.stepIdx}")
+                return
+            decoder = self.spatial_trace_decoders[sim_conf.id] = SpatialTraceDecoder()
+            data = decoder.decode(step_trace["data"])
+
+        frame = {**trace, "data": data, "keyframe": True, "simId": sim_conf.id}
+        for subscription in self.spatial_subscriptions.get(sim_conf.id, []):
+            if getattr(subscription.ws, "user_id", None) == user_id:
+                subscription.push(frame)
+
+    async def process_sim_log_batch(self, sim_conf: SimConfig, batch: SimLogBatch) -> None:
+        """Forward a log batch to the user as a single message and store it."""
+        await self.send_message(sim_conf.userId, "simLogBatch", {**batch.dict(), "simId": sim_conf.id})
+        await self.db.buffer_sim_log_batch(sim_conf.id, sim_conf.userId, batch)
 
     async def process_sim_trace(self, sim_conf: SimConfig, sim_trace: SimTrace) -> None:
         user_id = sim_conf.userId
@@ -260,24 +513,20 @@ class SimManager:
 
         trace = sim_trace.dict()
 
-        if not sim_trace.stream:
-            with open(f"/data/traces/{sim_conf.id}.json", "a") as file:
-                file.seek(0, os.SEEK_END)
-                file.seek(file.tell() - 1, os.SEEK_SET)
-                file.truncate()
-
-                lead_char = ", " if trace["index"] > 0 else ""
-                trace_str = json.dumps({**trace, "simId": sim_conf.id})
+        if sim_trace.persist:
+            if sim_id not in self.trace_writers:
+                self.trace_writers[sim_id] = TraceWriter(sim_id)
 
-                file.write(f"{lead_char}{trace_str}]")
+            trace_writer = self.trace_writers[sim_id]
+            await self.run_trace_io(trace_writer.append, sim_trace.times, sim_trace.values_by_observable)
 
-        if sim_trace.persist:
-            await self.db.create_sim_trace(
+            await self.db.buffer_sim_trace(
+                sim_id,
                 {
                     **trace,
                     "simId": sim_id,
                     "userId": user_id,
-                }
+                },
             )
 
         status_message = {"simId": sim_id, "userId": user_id, "status": "finished"}
@@ -298,21 +547,70 @@ class SimManager:
             await connection.send_message(name, message, cmdid=cmdid)
 
     async def run_available(self):
-        if len(self.sim_conf_queue) == 0:
-            L.debug("sim queueu is empty, nothing to run")
-            return
-
-        L.debug(f"{len(self.sim_conf_queue)} simulations in the queue")
-
-        if len(self.free_workers) == 0:
-            L.debug("all workers are busy")
-            return
-
-        worker = self.free_workers[0]
-        worker.sim_conf = self.sim_conf_queue.pop(0)
-        self.worker_by_sim_id[worker.sim_conf.id] = worker
-
-        L.debug("ready to run simulation, sending sim config to sim worker")
-        await worker.ws.send_message("run_sim", worker.sim_conf.dict(exclude_none=True))
+        while len(self.scheduler) > 0:
+            L.debug(f"{len(self.scheduler)} simulations in the queue")
+
+            if len(self.free_workers) == 0:
+                L.debug("all workers are busy")
+                break
+
+            # spread simulations over workers, the one with the most free slots gets the next one
+            worker = max(self.free_workers, key=lambda free_worker: free_worker.free_slots)
+            sim_conf, cost = self.scheduler.pop()
+            worker.sim_conf_by_id[sim_conf.id] = sim_conf
+            worker.sim_end_time_by_id[sim_conf.id] = time.time() + cost
+            self.worker_by_sim_id[sim_conf.id] = worker
+
+            L.debug("ready to run simulation, sending sim config to sim worker")
+            await worker.ws.send_message("run_sim", sim_conf.dict(exclude_none=True))
+        else:
+            L.debug("sim queue is empty, nothing to run")
+
+        await self.send_queue_positions()
+
+    async def send_queue_positions(self) -> None:
+        """Schedule an update of queue positions, sent at most once per `QUEUE_POSITIONS_INTERVAL_SECS`."""
+        if self.queue_positions_task is None:
+            self.queue_positions_task = asyncio.ensure_future(self.send_queue_positions_throttled())
+
+    async def send_queue_positions_throttled(self) -> None:
+        await asyncio.sleep(max(self.queue_positions_sent_at + QUEUE_POSITIONS_INTERVAL_SECS - time.time(), 0))
+        # changes made while sending are sent with the next update
+        self.queue_positions_task = None
+        self.queue_positions_sent_at = time.time()
+        await self.send_changed_queue_positions()
+
+    async def send_changed_queue_positions(self) -> None:
+        """Send positions in the queue and estimated number of seconds until start of queued sims to their users.
+
+        Only users with a sim which has moved in the queue, or whose estimated start time has changed, are notified.
+        """
+        now = time.time()
+        slot_free_times = [free_time for worker in self.workers for free_time in worker.slot_free_times(now)]
+        start_time_by_id = self.scheduler.estimate_start_times(slot_free_times)
+
+        queue_by_user: Dict[str, List[dict]] = defaultdict(list)
+        queue_position_by_id: Dict[str, QueuePosition] = {}
+        changed_user_ids = set()
+        for position, sim_conf in enumerate(self.scheduler, start=1):
+            start_eta = start_time_by_id.get(sim_conf.id)
+            queue_by_user[sim_conf.userId].append({"simId": sim_conf.id, "position": position, "startEta": start_eta})
+
+            start_at = None if start_eta is None else now + start_eta
+            queue_position_by_id[sim_conf.id] = (position, start_at)
+            sent = self.sent_queue_position_by_id.get(sim_conf.id)
+            if sent is None or sent[0] != position or not eta_close(sent[1], start_at):
+                changed_user_ids.add(sim_conf.userId)
+
+        self.sent_queue_position_by_id = {
+            queued_sim["simId"]: (
+                queue_position_by_id[queued_sim["simId"]]
+                if user_id in changed_user_ids
+                else self.sent_queue_position_by_id[queued_sim["simId"]]
+            )
+            for user_id, queued_sims in queue_by_user.items()
+            for queued_sim in queued_sims
+        }
 
-        await self.run_available()
+        for user_id in changed_user_ids:
+            await self.send_message(user_id, "simQueue", {"sims": queue_by_user[user_id]})
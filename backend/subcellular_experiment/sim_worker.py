@@ -7,11 +7,14 @@ import threading
 import signal
 import asyncio
 from threading import Thread
-from multiprocessing import Process, Queue
-from collections import defaultdict
-from typing import Optional, Any, Dict, List, Union
+from multiprocessing import Process
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+from typing import Optional, Any, List, Union, Callable
 from types import FrameType
 import itertools
+import queue
 import time
 
 import sentry_sdk
@@ -22,14 +25,17 @@ from tornado.websocket import (
     WebSocketClientConnection,
 )
 
-from .worker_message import WorkerStatus
-from .sim import SimStatus, SimLogMessage, SimData
+from .worker_message import WorkerCapacity, encode_frame
+from .sim import SimStatus, SimLogMessage, SimData, SimTrace, SimSpatialStepTrace
+from .sim_log import SimLogBuffer, SIM_LOG_BATCH_SECS, sim_log_level, log_level_enabled
+from .sim_channel import SimDataChannel, RingFrame
 from .utils import ExtendedJSONEncoder
 from .nf_sim import NfSim
 from .steps_sim import StepsSim
 from .bng import run_bng
+from .api import fetch_model
 from .logger import get_logger, log_many
-from .envvars import SENTRY_DSN, MASTER_HOST
+from .envvars import SENTRY_DSN, MASTER_HOST, SIM_WORKER_WIRE_FORMAT, SIM_WORKER_SLOTS, SIM_WORKER_SHM_SIZE
 
 if SENTRY_DSN is not None:
     sentry_sdk.init(
@@ -39,18 +45,38 @@ if SENTRY_DSN is not None:
 
 L = get_logger(__name__)
 TIMEOUT_SECS = 3600
+# Number of ensembles with their models kept in memory by a worker
+ENSEMBLE_MODEL_CACHE_SIZE = 4
+# Number of trace messages of a slot being sent at once, more wait for the oldest ones to be written to the socket
+SIM_DATA_MAX_IN_FLIGHT = 10
 
 
-class SimWorker:
-    def __init__(self) -> None:
+class SimSlot:
+    """Slot of a worker running one simulation at a time in its own process and temp dir."""
+
+    def __init__(self, idx: int) -> None:
+        self.idx = idx
         self.sim_proc: Optional[Process] = None
         self.sim_thread: Optional[Thread] = None
-        self.sim_queue: Queue = Queue(10)
+        self.sim_log = SimLogBuffer()
+        self.sim_config: dict = {}
+        self.tmp_dir: Optional[str] = None
+        # Model fetched by the worker, shared by the runs of an ensemble
+        self.model: Optional[dict] = None
+        self.sim_data_in_flight = threading.Semaphore(SIM_DATA_MAX_IN_FLIGHT)
+
+    @property
+    def free(self) -> bool:
+        return not self.sim_config and self.sim_thread is None
+
+
+class SimWorker:
+    def __init__(self, n_slots: int = SIM_WORKER_SLOTS) -> None:
+        self.slots = [SimSlot(idx) for idx in range(n_slots)]
+        self.model_by_ensemble_id: OrderedDict[str, dict] = OrderedDict()
+        self.model_lock = threading.Lock()
         self.terminating = False
-        self.status: WorkerStatus = "ready"
         self.socket: Optional[WebSocketClientConnection] = None
-        self.sim_log: Dict[str, List[str]] = defaultdict(list)
-        self.sim_config: dict = {}
         self.closed = True
         self.loop = asyncio.new_event_loop()
 
@@ -66,6 +92,29 @@ class SimWorker:
 
         asyncio.run_coroutine_threadsafe(self._send_message(message, data, cmdid), self.loop)
 
+    def send_payload(self, payload: Union[bytes, str]) -> Optional[Future]:
+        """Schedules an encoded message to be sent, threadsafe, returns the future of the write."""
+        if not self.loop.is_running():
+            L.warning("No running loop")
+            return None
+
+        return asyncio.run_coroutine_threadsafe(self._write_payload(payload), self.loop)
+
+    @property
+    def busy_slots(self) -> List[SimSlot]:
+        return [slot for slot in self.slots if not slot.free]
+
+    def get_slot(self, sim_id: Optional[str]) -> Optional[SimSlot]:
+        return next((slot for slot in self.slots if slot.sim_config.get("id") == sim_id), None)
+
+    def send_capacity(self, released_sim_id: Optional[str] = None) -> None:
+        capacity = WorkerCapacity(
+            slots=len(self.slots),
+            freeSlots=len(self.slots) - len(self.busy_slots),
+            releasedSimId=released_sim_id,
+        )
+        self.send_message("status", capacity.dict())
+
     async def listen(self) -> None:
         await self.ws_connect()
         while True:
@@ -93,8 +142,8 @@ class SimWorker:
 
         self.closed = False
         L.debug("ws connection open")
-        self.send_message("status", "ready" if self.sim_proc is None else "busy")
-        self.send_message("worker_connect", self.sim_config)
+        self.send_message("worker_connect", [slot.sim_config for slot in self.slots if slot.sim_config])
+        self.send_capacity()
 
     def teardown(self) -> None:
         if self.socket is not None:
@@ -107,127 +156,258 @@ class SimWorker:
         if any(key not in message for key in ["data", "cmd", "cmdid"]):
             raise ValueError("Invalid message")
 
-        sim_config = message["data"]
+        data = message["data"] or {}
         msg = message["cmd"]
         cmdid = message["cmdid"]
         L.debug(f"got {msg} from the backend")
 
         if msg == "run_sim":
-            self.on_run_sim_msg(sim_config)
+            self.on_run_sim_msg(data)
 
         elif msg == "cancel_sim":
-            self.on_cancel_sim_msg()
+            self.on_cancel_sim_msg(data.get("simId"))
 
         elif msg == "get_tmp_sim_log":
-            self.send_message("tmp_sim_log", {"log": self.sim_log}, cmdid=cmdid)
-
-    def on_cancel_sim_msg(self) -> None:
-        L.debug("send SIGTERM to simulation process")
-        if self.sim_proc is not None:
-            self.sim_proc.terminate()
+            slot = self.get_slot(data.get("simId"))
+            sim_log = slot.sim_log.tail if slot is not None else {}
+            self.send_message("tmp_sim_log", {"log": sim_log, "simId": data.get("simId")}, cmdid=cmdid)
+
+    def on_cancel_sim_msg(self, sim_id: Optional[str]) -> None:
+        slot = self.get_slot(sim_id)
+        if slot is None:
+            L.warning(f"sim {sim_id} to cancel is not running on this worker")
+            return
 
-    def wait_for_sim_result(self) -> None:
-        if not self.sim_config:
+        self.cancel_slot(slot)
+
+    def cancel_slot(self, slot: SimSlot) -> None:
+        L.debug(f"send SIGTERM to simulation process of slot {slot.idx}")
+        if slot.sim_proc is not None:
+            slot.sim_proc.terminate()
+
+    def get_ensemble_model(self, sim_config: dict) -> Optional[dict]:
+        """Model of an ensemble run, fetched once for all runs of the ensemble which go to this worker."""
+        ensemble_id = sim_config.get("ensembleId")
+        if ensemble_id is None or not sim_config.get("modelId"):
+            return None
+
+        with self.model_lock:
+            model = self.model_by_ensemble_id.get(ensemble_id)
+            if model is None:
+                try:
+                    model = fetch_model(sim_config["modelId"], sim_config["userId"], geometry=False)
+                except Exception as error:  # pylint: disable=broad-except
+                    # the sim process fetches the model on its own and reports the error
+                    L.warning(f"can't fetch model of ensemble {ensemble_id}: {error}")
+                    return None
+                self.model_by_ensemble_id[ensemble_id] = model
+
+            self.model_by_ensemble_id.move_to_end(ensemble_id)
+            while len(self.model_by_ensemble_id) > ENSEMBLE_MODEL_CACHE_SIZE:
+                self.model_by_ensemble_id.popitem(last=False)
+
+            return model
+
+    def wait_for_sim_result(self, slot: SimSlot) -> None:
+        if not slot.sim_config:
             L.warning("No sim config")
             return
 
-        L.debug("creating process to run a sim")
-        self.sim_proc = Process(target=self.run_sim_proc)
+        sim_id = slot.sim_config["id"]
+        user_id = slot.sim_config["userId"]
+
+        slot.model = self.get_ensemble_model(slot.sim_config)
+
+        L.debug(f"creating process to run a sim in slot {slot.idx}")
+        slot.tmp_dir = tempfile.mkdtemp(prefix=f"sim-slot-{slot.idx}-")
+        # created for every sim, so that nothing left by a cancelled one is read
+        channel = SimDataChannel(SIM_WORKER_SHM_SIZE)
+        slot.sim_proc = Process(target=self.run_sim_proc, args=(slot, channel))
         initial = time.time()
-        self.sim_proc.start()
+        slot.sim_proc.start()
         L.debug("start loop to get sim data from MP queue")
 
         sim_finished = False
 
         while True:
-            sim_data: SimData = self.sim_queue.get()
+            try:
+                sim_data = channel.get(timeout=SIM_LOG_BATCH_SECS)
+            except queue.Empty:
+                self.send_sim_log_batch(slot)
+                continue
 
             if sim_data is None:
                 sim_finished = True
                 break
 
-            if isinstance(sim_data, SimLogMessage):
-                self.sim_log[sim_data.source].append(sim_data.message)
+            if isinstance(sim_data, list):
+                self.forward_frames(slot, channel, sim_data)
+            elif isinstance(sim_data, SimLogMessage):
+                slot.sim_log.add(sim_data)
+                if slot.sim_log.batch_due:
+                    self.send_sim_log_batch(slot)
+            else:
+                if isinstance(sim_data, SimStatus):
+                    # logs leading to a status change go first
+                    self.send_sim_log_batch(slot)
 
-            payload = {
-                **sim_data.dict(),
-                **{"simId": self.sim_config["id"], "userId": self.sim_config["userId"]},
-            }
+                payload = {
+                    **sim_data.dict(),
+                    **{"simId": sim_id, "userId": user_id},
+                }
 
-            self.send_message(sim_data.type, payload)
+                if isinstance(sim_data, (SimTrace, SimSpatialStepTrace)):
+                    # traces which haven't fit into the ring
+                    self.send_sim_data_payload(slot, self.encode_message(sim_data.type, payload))
+                else:
+                    self.send_message(sim_data.type, payload)
 
-            if time.time() - initial > TIMEOUT_SECS and self.sim_proc is not None:
+            if time.time() - initial > TIMEOUT_SECS and slot.sim_proc is not None:
                 L.debug("stopping simulation")
-                self.on_cancel_sim_msg()
-                self.send_message("simLog", {"log": self.sim_log})
+                self.cancel_slot(slot)
+                self.send_sim_log_batch(slot)
 
                 payload = {
                     **SimStatus(status="error").dict(),
-                    **{"simId": self.sim_config["id"], "userId": self.sim_config["userId"]},
+                    **{"simId": sim_id, "userId": user_id},
                 }
 
                 L.debug("sending error status")
                 self.send_message("simStatus", payload)
-                
+
                 break
 
+        self.send_sim_log_batch(slot)
+
         if sim_finished:
             L.debug("joining simulator process")
-            self.sim_proc.join()
+            slot.sim_proc.join()
+
+        channel.close()
+        shutil.rmtree(slot.tmp_dir, ignore_errors=True)
+
+        slot.sim_proc = None
+        slot.sim_config = {}
+        slot.model = None
+        slot.sim_log = SimLogBuffer()
+        slot.tmp_dir = None
+        slot.sim_thread = None
+
+        L.debug(f"slot {slot.idx} is free, sending capacity")
+        self.send_capacity(released_sim_id=sim_id)
+
+    def send_sim_log_batch(self, slot: SimSlot) -> None:
+        batch = slot.sim_log.pop_batch()
+        if batch is None:
+            return
+
+        payload = {**batch.dict(), "simId": slot.sim_config["id"], "userId": slot.sim_config["userId"]}
+        self.send_message(batch.type, payload)
 
-        self.sim_proc = None
-        self.sim_config = {}
-        self.sim_log = defaultdict(list)
+    def send_sim_data_payload(
+        self, slot: SimSlot, payload: Union[bytes, str], on_sent: Optional[Callable[[], None]] = None
+    ) -> None:
+        """Send an encoded trace message, waits while `SIM_DATA_MAX_IN_FLIGHT` ones of the slot are being sent.
 
-        L.debug("sending ready status")
+        `on_sent` is called once the message is written to the socket or dropped.
+        """
+        slot.sim_data_in_flight.acquire()  # pylint: disable=consider-using-with
 
-        self.send_message("status", "ready")
+        def on_done(_future: Optional[Future] = None) -> None:
+            if on_sent is not None:
+                on_sent()
+            slot.sim_data_in_flight.release()
+
+        future = self.send_payload(payload)
+        if future is None:
+            on_done()
+        else:
+            future.add_done_callback(on_done)
+
+    def forward_frames(self, slot: SimSlot, channel: SimDataChannel, frames: List[RingFrame]) -> None:
+        """Send sim data from the shared memory ring, arrays are copied once, into the encoded message.
+
+        Ring space is released once the message is written, so that while the connection is slow the ring fills up
+        and frames waiting in the queue are sent coalesced, instead of messages piling up in the worker.
+        """
+        data = {**channel.read(frames), "simId": slot.sim_config["id"], "userId": slot.sim_config["userId"]}
+        payload = self.encode_message(frames[0].type, data)
+        self.send_sim_data_payload(slot, payload, partial(channel.release, frames))
 
     def on_run_sim_msg(self, sim_config: dict) -> None:
-        self.send_message("status", "busy")
-        self.sim_config = sim_config
+        slot = next((slot for slot in self.slots if slot.free), None)
+
+        if slot is None:
+            L.warning(f"no free slot to run sim {sim_config.get('id')}")
+            payload = {**SimStatus(status="error").dict(), "simId": sim_config["id"], "userId": sim_config["userId"]}
+            self.send_message("simStatus", payload)
+            self.send_capacity(released_sim_id=sim_config["id"])
+            return
 
-        L.debug("starting a simulation loop")
-        self.sim_thread =  Thread(target=self.wait_for_sim_result)
-        self.sim_thread.start()
+        slot.sim_config = sim_config
+        self.send_capacity()
+
+        L.debug(f"starting a simulation loop in slot {slot.idx}")
+        slot.sim_thread = Thread(target=self.wait_for_sim_result, args=(slot,))
+        slot.sim_thread.start()
+
+    def encode_message(self, message: str, data: Any, cmdid: Optional[int] = None) -> Union[bytes, str]:
+        message_dict = {"message": message, "data": data, "cmdid": cmdid}
+
+        if SIM_WORKER_WIRE_FORMAT == "binary":
+            return encode_frame(message_dict)
+
+        return json.dumps(message_dict, cls=ExtendedJSONEncoder)
 
     async def _send_message(self, message: str, data: Any, cmdid=None) -> None:
         if self.closed or self.socket is None:
             return
 
-        payload = json.dumps(
-            {"message": message, "data": data, "cmdid": cmdid},
-            cls=ExtendedJSONEncoder,
-        )
+        await self._write_payload(self.encode_message(message, data, cmdid))
+
+    async def _write_payload(self, payload: Union[bytes, str]) -> None:
+        if self.closed or self.socket is None:
+            return
 
         try:
-            await self.socket.write_message(payload)
+            await self.socket.write_message(payload, binary=isinstance(payload, bytes))
         except (ConnectionError, WebSocketClosedError):
             log_many("web socket connection closed", L.error, capture_message)
 
-    def run_sim_proc(self) -> None:
-        if not self.sim_config:
+    def run_sim_proc(self, slot: SimSlot, channel: SimDataChannel) -> None:
+        if not slot.sim_config:
             L.warning("No sim config")
             return
 
         def on_sigterm(sig_num, frame):  # pylint: disable=unused-argument
             L.debug("got SIGTERM on simulation process")
-            self.sim_queue.put(SimLogMessage(message="STOP"))
-            self.sim_queue.put(None)
+            channel.put(SimLogMessage(message="STOP"))
+            channel.put(None)
             L.debug("exiting")
             sys.exit(0)
 
         signal.signal(signal.SIGTERM, on_sigterm)
 
-        tmp_dir = tempfile.mkdtemp()
-        os.chdir(tmp_dir)
+        if slot.tmp_dir is None:
+            L.warning("No temp dir for the sim")
+            return
+
+        os.chdir(slot.tmp_dir)
 
-        solver = self.sim_config.get("solver")
+        log_level = sim_log_level(slot.sim_config)
+
+        def send_sim_data(sim_data: SimData) -> None:
+            # messages below the log level don't even go through the queue
+            if isinstance(sim_data, SimLogMessage) and not log_level_enabled(sim_data.level, log_level):
+                return
+            channel.put(sim_data)
+
+        solver = slot.sim_config.get("solver")
 
         if solver == "nfsim":
-            sim: Union[NfSim, StepsSim, None] = NfSim(self.sim_config, self.sim_queue.put)
+            sim: Union[NfSim, StepsSim, None] = NfSim(slot.sim_config, send_sim_data, model=slot.model)
         elif solver in ("tetexact", "tetopsplit"):
-            sim = StepsSim(self.sim_config, self.sim_queue.put)
+            sim = StepsSim(slot.sim_config, send_sim_data, model=slot.model)
         elif solver in ("ode", "ssa"):
             sim = None
         else:
@@ -238,22 +418,20 @@ class SimWorker:
             if sim is not None:
                 sim.run()
             else:
-                run_bng(self.sim_config, self.sim_queue.put)
-            self.sim_queue.put(None)
+                run_bng(slot.sim_config, send_sim_data, model=slot.model)
+            channel.put(None)
         except Exception as error:
             L.debug("Sim error")
             L.exception(error)
             sim_status = SimStatus(status="error")
-            sim_log = SimLogMessage(message=str(error))
-            self.sim_queue.put(sim_log)
-            self.sim_queue.put(sim_status)
-            self.sim_queue.put(None)
-
-        shutil.rmtree(tmp_dir)
+            sim_log = SimLogMessage(message=str(error), level="error")
+            channel.put(sim_log)
+            channel.put(sim_status)
+            channel.put(None)
 
     def on_terminate(self, signum: int, frame: FrameType):  # pylint: disable=unused-argument
         L.debug("received main process shutdown signal")
-        if not self.sim_proc and not self.sim_thread:
+        if not self.busy_slots:
             L.debug("Closing socket and exiting")
             self.teardown()
         else:
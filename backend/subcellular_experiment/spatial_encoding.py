@@ -0,0 +1,174 @@
+from typing import Dict, Tuple, Iterable
+
+import numpy as np
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+KEYFRAME_INTERVAL = 20
+
+# Sparse molecule counts by structure name and molecule name, as (idxs, molCounts) pairs
+SpatialState = Dict[str, Dict[str, Tuple[np.ndarray, np.ndarray]]]
+
+
+def compact_uint(values: np.ndarray) -> np.ndarray:
+    """Cast non-negative integer values to the smallest unsigned dtype, other values are returned as is."""
+    values = np.asarray(values)
+    if values.size == 0:
+        return values.astype(np.uint8)
+
+    if values.dtype.kind == "f" and not np.array_equal(values, np.floor(values)):
+        return values
+
+    if values.min() < 0:
+        return values
+
+    return values.astype(np.min_scalar_type(int(values.max())))
+
+
+def to_state(data: Dict[str, Dict[str, dict]]) -> SpatialState:
+    """Convert step trace data into a state with sorted indices."""
+    state: SpatialState = {}
+    for structure_name, structure_data in data.items():
+        for mol_name, mol_data in structure_data.items():
+            idxs = np.asarray(mol_data["idxs"])
+            counts = np.asarray(mol_data["molCounts"])
+            order = np.argsort(idxs, kind="stable")
+            state.setdefault(structure_name, {})[mol_name] = (idxs[order], counts[order])
+
+    return state
+
+
+def to_data(state: SpatialState) -> Dict[str, Dict[str, dict]]:
+    return {
+        structure_name: {
+            mol_name: {"idxs": compact_uint(idxs), "molCounts": compact_uint(counts)}
+            for mol_name, (idxs, counts) in structure_state.items()
+        }
+        for structure_name, structure_state in state.items()
+    }
+
+
+def diff_counts(
+    idxs: np.ndarray, counts: np.ndarray, new_idxs: np.ndarray, new_counts: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return indices with changed counts and their new values, removed elements get 0."""
+    all_idxs = np.union1d(idxs, new_idxs)
+
+    values = np.zeros(len(all_idxs), dtype=np.result_type(counts, new_counts))
+    values[np.searchsorted(all_idxs, idxs)] = counts
+
+    new_values = np.zeros(len(all_idxs), dtype=values.dtype)
+    new_values[np.searchsorted(all_idxs, new_idxs)] = new_counts
+
+    changed = values != new_values
+    return all_idxs[changed], new_values[changed]
+
+
+def merge_counts(
+    idxs: np.ndarray, counts: np.ndarray, delta_idxs: np.ndarray, delta_counts: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply changed counts to sorted sparse counts, elements set to 0 are dropped."""
+    all_idxs = np.union1d(idxs, delta_idxs)
+
+    values = np.zeros(len(all_idxs), dtype=np.result_type(counts, delta_counts))
+    values[np.searchsorted(all_idxs, idxs)] = counts
+    values[np.searchsorted(all_idxs, delta_idxs)] = delta_counts
+
+    non_zero = values != 0
+    return all_idxs[non_zero], values[non_zero]
+
+
+class SpatialTraceEncoder:
+    """Encode spatial step traces as periodic keyframes and sparse deltas between them.
+
+    A keyframe holds all non-zero counts of a step. A delta holds, for each structure and molecule
+    which has changed since the previous encoded step, the indices with changed counts and their new
+    values, where 0 means the element became empty. Unchanged molecules are left out of a delta.
+    """
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL) -> None:
+        self.keyframe_interval = keyframe_interval
+        self.state: SpatialState = {}
+        self.steps_since_keyframe = 0
+
+    def encode(
+        self, data: Dict[str, Dict[str, dict]], keyframe: bool = False
+    ) -> Tuple[bool, Dict[str, Dict[str, dict]]]:
+        """Encode step trace data.
+
+        Args:
+            data: Full step trace data as produced by the spatial sampler.
+            keyframe: Force a keyframe.
+
+        Returns:
+            Whether the step is a keyframe, and the encoded data.
+        """
+        new_state = to_state(data)
+        keyframe = keyframe or not self.state or self.steps_since_keyframe + 1 >= self.keyframe_interval
+
+        if keyframe:
+            self.state = new_state
+            self.steps_since_keyframe = 0
+            return True, to_data(new_state)
+
+        delta: SpatialState = {}
+        empty = np.zeros(0, dtype=np.uintc)
+        structure_names = set(self.state) | set(new_state)
+
+        for structure_name in structure_names:
+            structure_state = self.state.get(structure_name, {})
+            new_structure_state = new_state.get(structure_name, {})
+
+            for mol_name in set(structure_state) | set(new_structure_state):
+                idxs, counts = structure_state.get(mol_name, (empty, empty))
+                new_idxs, new_counts = new_structure_state.get(mol_name, (empty, empty))
+                changed_idxs, changed_counts = diff_counts(idxs, counts, new_idxs, new_counts)
+
+                if len(changed_idxs):
+                    delta.setdefault(structure_name, {})[mol_name] = (changed_idxs, changed_counts)
+
+        self.state = new_state
+        self.steps_since_keyframe += 1
+        return False, to_data(delta)
+
+
+class SpatialTraceDecoder:
+    """Reconstruct full spatial step traces from a sequence of keyframes and deltas."""
+
+    def __init__(self) -> None:
+        self.state: SpatialState = {}
+
+    def decode(self, data: Dict[str, Dict[str, dict]], keyframe: bool = True) -> Dict[str, Dict[str, dict]]:
+        if keyframe:
+            self.state = to_state(data)
+            return to_data(self.state)
+
+        for structure_name, structure_data in to_state(data).items():
+            structure_state = self.state.setdefault(structure_name, {})
+
+            for mol_name, (delta_idxs, delta_counts) in structure_data.items():
+                empty = np.zeros(0, dtype=delta_idxs.dtype)
+                idxs, counts = structure_state.get(mol_name, (empty, empty))
+                idxs, counts = merge_counts(idxs, counts, delta_idxs, delta_counts)
+
+                if len(idxs):
+                    structure_state[mol_name] = (idxs, counts)
+                else:
+                    structure_state.pop(mol_name, None)
+
+            if not structure_state:
+                del self.state[structure_name]
+
+        return to_data(self.state)
+
+
+def decode_steps(steps: Iterable[dict]) -> Dict[str, Dict[str, dict]]:
+    """Reconstruct data of the last step from a keyframe followed by deltas, all ordered by step index."""
+    decoder = SpatialTraceDecoder()
+    data: Dict[str, Dict[str, dict]] = {}
+    for step in steps:
+        data = decoder.decode(step["data"], step.get("keyframe", True))
+
+    return data
@@ -0,0 +1,48 @@
+"""Entry point of the ranks of a TetOpSplit simulation launched with mpirun by `StepsSim.run_mpi`.
+
+Every rank sets up the model and mesh and runs the solver loop, STEPS gathers observable values
+from all ranks, so rank 0 has complete traces and is the only one sending messages.
+"""
+
+import os
+import sys
+import pickle
+from typing import Any
+
+import steps.mpi
+
+from .steps_sim import StepsSim, MPI_SIM_FILENAME, MPI_MESSAGES_FILENAME
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+def main(sim_dir: str) -> None:
+    rank = steps.mpi.rank
+
+    with open(os.path.join(sim_dir, MPI_SIM_FILENAME), "rb") as sim_file:
+        sim = pickle.load(sim_file)
+
+    # ranks write model files, each of them needs its own working directory
+    rank_dir = os.path.join(sim_dir, f"rank-{rank}")
+    os.makedirs(rank_dir, exist_ok=True)
+    os.chdir(rank_dir)
+
+    if rank == 0:
+        messages_file = open(os.path.join(sim_dir, MPI_MESSAGES_FILENAME), "wb")  # pylint: disable=consider-using-with
+
+        def send_message(message: Any) -> None:
+            pickle.dump(message, messages_file)
+            messages_file.flush()
+
+    else:
+
+        def send_message(message: Any) -> None:  # pylint: disable=unused-argument
+            pass
+
+    L.debug(f"rank {rank} of {steps.mpi.nhosts} started")
+    StepsSim(sim["simConfig"], send_message, model=sim["model"], mpi_rank=rank).run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,56 @@
+from typing import Dict, List, Sequence, Tuple
+
+from steps.utilities.geom_decompose import linearPartition, partitionTris
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+def prime_factors(n: int) -> List[int]:
+    factors = []
+    factor = 2
+    while factor * factor <= n:
+        while n % factor == 0:
+            factors.append(factor)
+            n //= factor
+        factor += 1
+    if n > 1:
+        factors.append(n)
+    return factors
+
+
+def partition_grid(n_parts: int, extents: Sequence[float]) -> List[int]:
+    """Split `n_parts` into numbers of bins along x, y and z, keeping bins of the bounding box close to cubes.
+
+    Largest prime factors go first to the axis with the longest bins.
+    """
+    bins = [1, 1, 1]
+    for factor in sorted(prime_factors(n_parts), reverse=True):
+        axis = max(range(3), key=lambda axis_idx: extents[axis_idx] / bins[axis_idx])
+        bins[axis] *= factor
+    return bins
+
+
+def partition_mesh(mesh, n_parts: int, tri_idxs: Sequence[int]) -> Tuple[List[int], Dict[int, int]]:
+    """Assign tets and patch triangles of a STEPS mesh to MPI ranks with a linear grid partition.
+
+    Args:
+        mesh: STEPS Tetmesh.
+        n_parts: Number of ranks.
+        tri_idxs: Triangles of all patches, each is assigned to the rank of one of its tets.
+
+    Returns:
+        Rank of every tet and rank by triangle index, as expected by TetOpSplit.
+    """
+    bound_min = mesh.getBoundMin()
+    bound_max = mesh.getBoundMax()
+    extents = [bound_max[axis] - bound_min[axis] for axis in range(3)]
+
+    bins = partition_grid(n_parts, extents)
+    L.debug(f"partition mesh into {bins[0]}x{bins[1]}x{bins[2]} bins")
+
+    tet_hosts = linearPartition(mesh, bins)
+    tri_hosts = partitionTris(mesh, tet_hosts, list(tri_idxs))
+
+    return tet_hosts, tri_hosts
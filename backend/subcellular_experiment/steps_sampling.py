@@ -0,0 +1,157 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+COMPARTMENT = "compartment"
+
+
+class TraceSampler:
+    """Precompiled plan to sample trace observables from a STEPS solver.
+
+    Every (structure, species) pair referenced by the observables is queried from the solver
+    exactly once per step, molecule counts are then reduced into observable columns with a single
+    vectorized call.
+
+    Attributes:
+        comp_names: Structure name for every unique (structure, species) pair.
+        spec_names: STEPS species name for every unique (structure, species) pair.
+        is_compartment: Whether a pair belongs to a compartment (True) or to a patch (False).
+        pair_idxs: Index into unique pairs for every (observable, species) entry.
+        observable_idxs: Observable column for every (observable, species) entry.
+    """
+
+    def __init__(self, observables: list, pysb_species: list, structure_type_by_name: Dict[str, str]) -> None:
+        pair_idx_by_key: Dict[Tuple[str, str], int] = {}
+        pair_idxs: List[int] = []
+        observable_idxs: List[int] = []
+
+        for observable_idx, observable in enumerate(observables):
+            for pysb_spec_idx in observable.species:
+                pysb_spec = pysb_species[pysb_spec_idx]
+                key = (pysb_spec.comp_name, pysb_spec.name)
+                pair_idx = pair_idx_by_key.setdefault(key, len(pair_idx_by_key))
+                pair_idxs.append(pair_idx)
+                observable_idxs.append(observable_idx)
+
+        self.n_observables = len(observables)
+        self.comp_names = [comp_name for comp_name, _ in pair_idx_by_key]
+        self.spec_names = [spec_name for _, spec_name in pair_idx_by_key]
+        self.is_compartment = np.array(
+            [structure_type_by_name[comp_name] == COMPARTMENT for comp_name in self.comp_names], dtype=bool
+        )
+        self.pair_idxs = np.array(pair_idxs, dtype=np.intp)
+        self.observable_idxs = np.array(observable_idxs, dtype=np.intp)
+        self.pair_counts = np.zeros(len(pair_idx_by_key), dtype=np.float64)
+
+    def sample(self, sim, out: np.ndarray) -> None:
+        """Fill `out` (one row of trace values) with current molecule counts of each observable."""
+        pair_counts = self.pair_counts
+
+        for pair_idx, (comp_name, spec_name, is_compartment) in enumerate(
+            zip(self.comp_names, self.spec_names, self.is_compartment)
+        ):
+            try:
+                if is_compartment:
+                    pair_counts[pair_idx] = sim.getCompCount(comp_name, spec_name)
+                else:
+                    pair_counts[pair_idx] = sim.getPatchCount(comp_name, spec_name)
+            except Exception:
+                L.warning("Runtime warning")
+                L.warning(f"{comp_name}:{spec_name}")
+                pair_counts[pair_idx] = 0
+
+        out[:] = np.bincount(
+            self.observable_idxs,
+            weights=pair_counts[self.pair_idxs],
+            minlength=self.n_observables,
+        )
+
+
+class StructureSampler:
+    """Sampling plan of spatial molecule counts for one geometry structure.
+
+    Attributes:
+        idxs: Tet or tri indices of the structure.
+        spec_names: STEPS species located in the structure which are referenced by spatial observables.
+        mol_names: Molecule names with at least one species in the structure.
+        weights: Matrix of shape (n_mols, n_specs) reducing species counts into molecule counts.
+        spec_counts: Reusable buffer of shape (n_specs, n_elements) for solver batch calls.
+        mol_counts: Reusable buffer of shape (n_mols, n_elements).
+    """
+
+    def __init__(self, structure: dict, spatial_observables: list, pysb_species: list, mol_prefix: str) -> None:
+        self.name: str = structure["name"]
+        self.is_compartment = structure["type"] == COMPARTMENT
+        self.idxs = np.array(structure["idxs"], dtype=np.uintc)
+
+        spec_row_by_name: Dict[str, int] = {}
+        spec_rows_by_mol: Dict[str, List[int]] = {}
+
+        for observable in spatial_observables:
+            mol_name = observable.name.replace(mol_prefix, "")
+            for pysb_spec_idx in observable.species:
+                pysb_spec = pysb_species[pysb_spec_idx]
+                if pysb_spec.comp_name != self.name:
+                    continue
+                spec_row = spec_row_by_name.setdefault(pysb_spec.name, len(spec_row_by_name))
+                spec_rows_by_mol.setdefault(mol_name, []).append(spec_row)
+
+        self.spec_names = list(spec_row_by_name)
+        self.mol_names = list(spec_rows_by_mol)
+        self.weights = np.zeros((len(self.mol_names), len(self.spec_names)))
+        for mol_row, spec_rows in enumerate(spec_rows_by_mol.values()):
+            np.add.at(self.weights[mol_row], spec_rows, 1)
+
+        self.spec_counts = np.zeros((len(self.spec_names), len(self.idxs)))
+        self.mol_counts = np.zeros((len(self.mol_names), len(self.idxs)))
+
+    def sample(self, sim) -> Dict[str, dict]:
+        get_batch_counts = sim.getBatchTetCountsNP if self.is_compartment else sim.getBatchTriCountsNP
+
+        for spec_row, spec_name in enumerate(self.spec_names):
+            get_batch_counts(self.idxs, spec_name, self.spec_counts[spec_row])
+
+        np.matmul(self.weights, self.spec_counts, out=self.mol_counts)
+
+        # np.nonzero walks rows in order, so entries of every molecule end up in a contiguous range
+        mol_rows, elem_idxs = np.nonzero(self.mol_counts > 0)
+        counts = self.mol_counts[mol_rows, elem_idxs]
+        bounds = np.searchsorted(mol_rows, np.arange(len(self.mol_names) + 1))
+
+        data = {}
+        for mol_row, mol_name in enumerate(self.mol_names):
+            start, end = bounds[mol_row], bounds[mol_row + 1]
+            if start == end:
+                continue
+            data[mol_name] = {"idxs": self.idxs[elem_idxs[start:end]], "molCounts": counts[start:end]}
+
+        return data
+
+
+class SpatialSampler:
+    """Precompiled plan to sample per tet/tri molecule counts of spatial observables.
+
+    Index arrays, species groupings and count buffers are built once per run, so that sampling a step
+    costs one solver batch call per (structure, species) pair and a few vectorized operations.
+    """
+
+    def __init__(self, structures: list, spatial_observables: list, pysb_species: list, mol_prefix: str) -> None:
+        self.structure_samplers = [
+            StructureSampler(structure, spatial_observables, pysb_species, mol_prefix) for structure in structures
+        ]
+        self.structure_samplers = [sampler for sampler in self.structure_samplers if sampler.mol_names]
+
+    def sample(self, sim) -> Dict[str, Dict[str, dict]]:
+        """Return molecule counts by structure and molecule name, only non-zero counts are included."""
+        data = {}
+        for structure_sampler in self.structure_samplers:
+            structure_data = structure_sampler.sample(sim)
+            if structure_data:
+                data[structure_sampler.name] = structure_data
+
+        return data
@@ -1,19 +1,25 @@
 import os
 import re
-import time
+import sys
 import math
+import time
+import queue
+import pickle
+import signal
+import multiprocessing
+from threading import Thread
 from datetime import datetime
-from typing import Callable, Any, Dict, List, Literal
+from typing import Callable, Any, Dict, List, Literal, Optional, Tuple
 from collections import defaultdict
 
 import numpy as np
 import pysb
 from pysb.importers import bngl
-import sympy
 import steps.model as smodel
 import steps.geom as sgeom
 import steps.rng as srng
 import steps.solver as ssolver
+import steps.mpi
 from steps.mpi.solver import TetOpSplit
 from steps.geom import Tetmesh
 
@@ -25,13 +31,30 @@ from .sim import (
     SimSpatialStepTrace,
     SimStatus,
     SimLogMessage,
-    decompress_stimulation,
 )
+from .steps_sampling import TraceSampler, SpatialSampler
+from .steps_partition import partition_mesh
+from .spatial_encoding import SpatialTraceEncoder
+from .mesh_index import MeshIndex
+from .geometry_store import GeometryStore
+from .model_cache import ModelCache
+from .rate_evaluator import RateEvaluator
+from .stimulation import get_stimuli, sim_timeline
+from .ensemble import ReplicateTraceMerger
+from .envvars import STEPS_REPLICATE_PROCESSES, STEPS_MPI_RANKS
+from .process_runner import ProcessRunner
+from .settings import MPIRUN_PATH
 from .logger import get_logger
 
 L = get_logger(__name__)
 
-GEOMETRY_ROOT_PATH = "/data/geometries"
+DEFAULT_SEED = 654
+REPLICATE_POLL_SECS = 1
+
+# Ranks get fewer tets than this only when the number of ranks is set explicitly
+MIN_TETS_PER_RANK = 5000
+MPI_SIM_FILENAME = "mpi_sim.pickle"
+MPI_MESSAGES_FILENAME = "mpi_messages.fifo"
 
 
 COMPARTMENT: Literal["compartment"] = "compartment"
@@ -40,43 +63,253 @@ MEMBRANE: Literal["membrane"] = "membrane"
 
 PATCH_COMP_TYPE_DICT = {0: "i", 1: "s", 2: "o"}  # inner  # surface  # outer
 
+SPEC_COMP_NAME_RE = re.compile(r".*\*\*\s+(\w+)")
+BNGL_COMP_RE = re.compile(r"@\s+\w+")
+OUTER_PARENS_RE = re.compile(r"\((.+)\)")
+COMP_RE = re.compile(r"\*\*\s+\w+")
+NON_WORD_RE = re.compile(r"\W+")
+
+
+# TODO: refactor weird use of simplify_string, remove stim_name
+def stim_name(stim):
+    return "{}{}".format(STIM_PREFIX, simplify_string(stim["target"]))
+
 
 def get_pysb_spec_comp_name(pysb_spec):
-    spec_str = str(pysb_spec)
-    return re.search(r".*\*\*\s+(\w+)", spec_str).groups()[0]
+    spec_str = pysb_spec if isinstance(pysb_spec, str) else str(pysb_spec)
+    return SPEC_COMP_NAME_RE.search(spec_str).groups()[0]
+
+
+class SetupTimer:
+    """Durations of consecutive phases of sim setup."""
+
+    def __init__(self) -> None:
+        self.durations: List[Tuple[str, float]] = []
+        self.last_time = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        """Record the time since the previous lap as the duration of a phase."""
+        now = time.perf_counter()
+        self.durations.append((phase, now - self.last_time))
+        self.last_time = now
+
+    def report(self) -> str:
+        total = sum(duration for _, duration in self.durations)
+        phases = ", ".join(f"{phase}: {duration:.3f}s" for phase, duration in self.durations)
+        return f"{phases} (total: {total:.3f}s)"
 
 
 class StepsSim:
-    def __init__(self, sim_config: dict, progress_cb: Callable[[Any], None]) -> None:
+    def __init__(
+        self,
+        sim_config: dict,
+        progress_cb: Callable[[Any], None],
+        model: Optional[dict] = None,
+        mpi_rank: Optional[int] = None,
+    ) -> None:
         self.sim_config = sim_config
+        self.model = model
+        # set when running as one of the ranks launched by `run_mpi`
+        self.mpi_rank = mpi_rank
         self.t_start = datetime.now()
         self.send_progress = progress_cb
 
-    def log(self, message: str) -> None:
+    def log(self, message: str, level: str = "info", source: str = "system") -> None:
         sim_time = datetime.now() - self.t_start
         hours, remainder = divmod(sim_time.seconds, 3600)
         minutes, seconds = divmod(remainder, 60)
         timestamp = f"{int(hours):02}:{int(minutes):02}:{int(seconds):02}"
 
-        sim_log_msg = SimLogMessage(message=f"{timestamp} {message}")
+        sim_log_msg = SimLogMessage(message=f"{timestamp} {message}", level=level, source=source)
         self.send_progress(sim_log_msg)
 
-    def run(self) -> None:
-        self.send_progress(SimStatus(status="init"))
-        self.log("init sim")
+    def run_replicate(self, run_solver: Callable, replicate_idx: int, seed: int, replicate_queue) -> None:
+        """Entry point of a replicate process, messages are sent to the parent tagged with the replicate index."""
+        # the sim process handles SIGTERM by reporting to the worker, replicates should just stop
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.send_progress = lambda message: replicate_queue.put((replicate_idx, message))
+
+        try:
+            run_solver(seed, sample_spatial=replicate_idx == 0)
+        except Exception as error:  # pylint: disable=broad-except
+            L.exception(error)
+            self.send_progress(SimLogMessage(message=f"replicate {replicate_idx}: {error}", source="replicates"))
+            self.send_progress(SimStatus(status="error"))
+        finally:
+            replicate_queue.put((replicate_idx, None))
+
+    def run_replicates(self, run_solver: Callable, seed: int, n_replicates: int) -> None:
+        """Run replicates with seeds `seed`, `seed + 1`, ... in forked processes.
+
+        Replicates share the mesh and model set up by the parent. Traces are merged into rows with values
+        of every replicate and their mean and std, logs and spatial traces are reported for replicate 0 only.
+        """
+        context = multiprocessing.get_context("fork")
+        replicate_queue = context.Queue()
+        send_progress = self.send_progress
+
+        n_processes = max(min(n_replicates, STEPS_REPLICATE_PROCESSES), 1)
+        self.log(f"run {n_replicates} replicates in {n_processes} processes, seeds from {seed}")
+
+        pending_idxs = list(range(n_replicates))
+        proc_by_idx: Dict[int, multiprocessing.process.BaseProcess] = {}
+        n_done = 0
+
+        progress_by_idx = [0.0] * n_replicates
+        started = False
+        merger = ReplicateTraceMerger(n_replicates)
+
+        def stop_replicates(reason: str) -> None:
+            for proc in proc_by_idx.values():
+                proc.terminate()
+            raise RuntimeError(reason)
+
+        while n_done < n_replicates:
+            while pending_idxs and len(proc_by_idx) < n_processes:
+                replicate_idx = pending_idxs.pop(0)
+                proc: multiprocessing.process.BaseProcess = context.Process(
+                    target=self.run_replicate,
+                    args=(run_solver, replicate_idx, seed + replicate_idx, replicate_queue),
+                    daemon=True,
+                )
+                proc.start()
+                proc_by_idx[replicate_idx] = proc
 
-        model_dict = fetch_model(self.sim_config["modelId"], self.sim_config["userId"])
-        geometry = model_dict["geometry"]
+            # checked on every message too, as other replicates may keep the queue busy
+            for replicate_idx, proc in proc_by_idx.items():
+                if proc.exitcode not in (None, 0):
+                    stop_replicates(f"Replicate {replicate_idx} has exited with code {proc.exitcode}")
 
-        if (model_dict["geometry_id"]) is None:
-            raise ValueError("Model doesn't have a geometry defined.")
+            try:
+                replicate_idx, message = replicate_queue.get(timeout=REPLICATE_POLL_SECS)
+            except queue.Empty:
+                continue
+
+            if message is None:
+                proc_by_idx.pop(replicate_idx).join()
+                n_done += 1
+            elif isinstance(message, SimTrace):
+                if not message.persist:
+                    continue
+                merger.add(replicate_idx, message.index, message.times, message.values_by_observable)
+                rows = merger.pop_complete()
+                if rows is not None:
+                    index, times, values_by_observable = rows
+                    send_progress(
+                        SimTrace(index=index, times=times, values_by_observable=values_by_observable, persist=True)
+                    )
+            elif isinstance(message, SimProgress):
+                progress_by_idx[replicate_idx] = message.progress
+                send_progress(SimProgress(progress=int(sum(progress_by_idx) / n_replicates)))
+            elif isinstance(message, SimStatus):
+                if message.status == "error":
+                    stop_replicates(f"Replicate {replicate_idx} has failed")
+                if message.status == "started" and not started:
+                    started = True
+                    send_progress(message)
+            elif replicate_idx == 0 or isinstance(message, SimLogMessage) and message.source == "replicates":
+                send_progress(message)
+
+        self.log("done")
+        send_progress(SimStatus(status="finished"))
+
+    def get_mpi_ranks(self, n_tets: int) -> int:
+        """Number of MPI ranks of a TetOpSplit sim, from `solverConf.mpiRanks` or the available cores."""
+        solver_config = self.sim_config["solverConf"]
+
+        # replicates already run in parallel on the cores of the worker
+        if self.sim_config["solver"] != "tetopsplit" or int(solver_config.get("replicates") or 1) > 1:
+            return 1
+
+        mpi_ranks = solver_config.get("mpiRanks")
+        if mpi_ranks:
+            return int(mpi_ranks)
+
+        return max(min(STEPS_MPI_RANKS, n_tets // MIN_TETS_PER_RANK), 1)
+
+    def run_mpi(self, model_dict: dict, n_ranks: int) -> None:
+        """Run the sim under mpirun with `n_ranks` ranks, see `steps_mpi`.
+
+        Rank 0 sends its messages through a named pipe, they are forwarded as if the sim was running in this process.
+        """
+        self.log(f"run TetOpSplit with {n_ranks} MPI ranks")
+
+        if GeometryStore().has(model_dict["geometry_id"]):
+            # ranks load the geometry from the store
+            model_dict = {key: value for key, value in model_dict.items() if key != "geometry"}
+
+        with open(MPI_SIM_FILENAME, "wb") as sim_file:
+            pickle.dump({"simConfig": self.sim_config, "model": model_dict}, sim_file)
+
+        messages_path = os.path.abspath(MPI_MESSAGES_FILENAME)
+        os.mkfifo(messages_path)
+
+        def forward_messages() -> None:
+            with open(messages_path, "rb") as messages_file:
+                while True:
+                    try:
+                        message = pickle.load(messages_file)
+                    except EOFError:
+                        break
+                    self.send_progress(message)
+
+        forward_thread = Thread(target=forward_messages, daemon=True)
+        forward_thread.start()
+
+        package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [package_path, os.getenv("PYTHONPATH")]))}
+        cmd = [MPIRUN_PATH, "-n", str(n_ranks), sys.executable, "-m", "subcellular_experiment.steps_mpi", os.getcwd()]
+
+        try:
+            returncode = ProcessRunner(self.send_progress, "mpi").run(cmd, env=env)
+        finally:
+            # rank 0 might have failed before opening the pipe, open it here to let the forwarding thread finish
+            try:
+                os.close(os.open(messages_path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            forward_thread.join()
+
+        if returncode != 0:
+            raise RuntimeError(f"mpirun has exited with code {returncode}")
+
+    def load_geometry(self, model_dict: dict) -> dict:
+        """Load geometry memory-mapped from the geometry store, geometries not stored yet are stored on first use.
+
+        Models are fetched without their geometry, it's fetched along with the model only when it isn't stored yet.
+        """
+        geometry_id = model_dict["geometry_id"]
+        geometry_store = GeometryStore()
+
+        geometry = geometry_store.load(geometry_id)
+        if geometry is not None:
+            self.log(f"load geometry {geometry_id} from the geometry store")
+            return geometry
 
+        geometry = model_dict.get("geometry")
+        if geometry is None:
+            self.log(f"fetch geometry {geometry_id}")
+            geometry = fetch_model(self.sim_config["modelId"], self.sim_config["userId"])["geometry"]
+            model_dict["geometry"] = geometry
+
+        try:
+            geometry_store.write(geometry_id, geometry)
+        except OSError as error:
+            L.warning(f"can't store geometry {geometry_id}: {error}")
+
+        return geometry
+
+    def prepare_model(self, model_dict: dict) -> str:
+        """Write the model as a BNGL file for STEPS and return it, `model_dict` is updated in place.
+
+        Reactions with functional rate laws are skipped, observables of stimuli and spatial sampling are added.
+        """
         react_with_standard_rate_laws = [
             reaction for reaction in model_dict["reactions"] if not has_functional_rate_laws(reaction)
         ]
 
         if len(model_dict["reactions"]) != len(react_with_standard_rate_laws):
-            self.log("Warning reactions with functional will be skipeed")
+            self.log("reactions with functional rate laws will be skipped", level="warning")
 
             model_dict["reactions"] = react_with_standard_rate_laws
             model_dict["functions"] = [
@@ -84,37 +317,11 @@ class StepsSim:
             ]
 
         solver_config = self.sim_config["solverConf"]
+        stimuli = get_stimuli(solver_config)
 
-        def get_comp_name_by_tet_idx(tet_idx):
-            geom_comp_name = next(
-                st["name"] for st in geometry["structures"] if st["type"] == COMPARTMENT and tet_idx in st["idxs"]
-            )
-
-            comp_name = next(
-                (
-                    st["name"]
-                    for st in model_dict["structures"]
-                    if st["type"] == COMPARTMENT and st["name"] == geom_comp_name
-                ),
-                "",
-            )
-
-            return comp_name
-
-        if solver_config.get("stimulation") is not None:
+        if stimuli:
             self.log("extend model observables with molecule definitions from stimulation")
 
-            stimuli = solver_config.get("stimulation", [])
-
-            if isinstance(stimuli, list):
-                pass
-            else:
-                stimuli = decompress_stimulation(stimuli)
-
-            # TODO: refactor weird use of simplify_string, remove stim_name
-            def stim_name(stim):
-                return "{}{}".format(STIM_PREFIX, simplify_string(stim["target"]))
-
             model_stim_observable_dict = {
                 stim_name(stim): {"name": stim_name(stim), "definition": stim["target"]}
                 for stim in stimuli
@@ -139,41 +346,112 @@ class StepsSim:
 
         bngl_str = model_to_bngl(model_dict, artificial_structures=True, add_diff_observables=True)
 
-        self.log(f"write BNGL model file: \n\n {bngl_str}")
+        self.log("write BNGL model file")
+        self.log(bngl_str, level="debug", source="model_bngl")
         with open("model.bngl", "w") as model_file:
             model_file.write(bngl_str)
 
+        return bngl_str
+
+    def load_pysb_model(self, bngl_str: str):
+        """Load the PySB model of the BNGL model with generated equations, from the model cache when it's there."""
+        model_cache = ModelCache()
+        model_cache_key = ModelCache.key(bngl_str)
+        cached_pysb_model = model_cache.get(model_cache_key)
+
+        if cached_pysb_model is not None:
+            self.log(f"load pySB model with generated equations from cache: {model_cache_key}")
+            return cached_pysb_model
+
         self.log("create pySB model from BNGL file")
         pysb_model = bngl.model_from_bngl(os.path.join(os.getcwd(), "model.bngl"))
 
         self.log("generate equations")
         pysb.bng.generate_equations(pysb_model)
 
+        self.log(f"save pySB model to cache: {model_cache_key}")
+        model_cache.put(model_cache_key, pysb_model)
+
+        return pysb_model
+
+    def run(self) -> None:
+        self.send_progress(SimStatus(status="init"))
+        self.log("init sim")
+
+        model_dict = self.model or fetch_model(self.sim_config["modelId"], self.sim_config["userId"], geometry=False)
+
+        if (model_dict["geometry_id"]) is None:
+            raise ValueError("Model doesn't have a geometry defined.")
+
+        geometry = self.load_geometry(model_dict)
+
+        n_ranks = self.get_mpi_ranks(len(geometry["tets"]) // 4)
+        if self.mpi_rank is None and n_ranks > 1:
+            # ranks load the pySB model from the model cache instead of all of them generating equations at once
+            self.load_pysb_model(self.prepare_model({**model_dict, "observables": list(model_dict["observables"])}))
+            self.run_mpi(model_dict, n_ranks)
+            return
+
+        setup_timer = SetupTimer()
+
+        bngl_str = self.prepare_model(model_dict)
+        pysb_model = self.load_pysb_model(bngl_str)
+
+        solver_config = self.sim_config["solverConf"]
+
+        model_compartment_names = {st["name"] for st in model_dict["structures"] if st["type"] == COMPARTMENT}
+
+        def get_comp_names_by_tri_idxs(tri_idxs):
+            # compartment name is an empty string if there is no model structure
+            # corresponding to a given geometry structure
+            return [
+                comp_name if comp_name in model_compartment_names else ""
+                for comp_name in mesh_index.neighb_compartment_names(tri_idxs)
+            ]
+
+        stimuli = get_stimuli(solver_config)
+        spatial_sampling = solver_config.get("spatialSampling", None) or {"enabled": False}
+
+        # overrides are applied after the cache lookup, so that all runs of an ensemble share generated equations
+        for param_name, param_value in (self.sim_config.get("paramOverrides") or {}).items():
+            if param_name not in pysb_model.parameters.keys():
+                raise ValueError(f"Parameter {param_name} not found")
+
+            self.log(f"override parameter {param_name}: {param_value}")
+            pysb_model.parameters[param_name].value = param_value
+
+        setup_timer.lap("model")
+
         self.log("generate pysb spec names")
         for pysb_spec in pysb_model.species:
-            pysb_spec.name = simplify_string(pysb_spec, compartments=False)
-            pysb_spec.full_name = simplify_string(pysb_spec, compartments=True)
-            pysb_spec.bngl_def = simplify_string(pysb_spec, compartments=False, is_bngl=True)
-            pysb_spec.comp_name = get_pysb_spec_comp_name(pysb_spec)
+            spec_str = str(pysb_spec)
+            pysb_spec.name = simplify_string(spec_str, compartments=False)
+            pysb_spec.full_name = simplify_string(spec_str, compartments=True)
+            pysb_spec.bngl_def = simplify_string(spec_str, compartments=False, is_bngl=True)
+            pysb_spec.comp_name = get_pysb_spec_comp_name(spec_str)
 
         steps_model = smodel.Model()
 
         self.log("about to create STEPS species")
-        steps_species = []
-        spec_name_set = set()
+        steps_spec_by_name = {}
         for pysb_spec_idx, pysb_spec in enumerate(pysb_model.species):
-            if pysb_spec.name not in spec_name_set:
-                spec_name_set.add(pysb_spec.name)
-                self.log("add STEPS spec: {}".format(pysb_spec.name))
-                steps_species.append(smodel.Spec(pysb_spec.name, steps_model))
+            if pysb_spec.name not in steps_spec_by_name:
+                self.log("add STEPS spec: {}".format(pysb_spec.name), level="debug")
+                steps_spec_by_name[pysb_spec.name] = smodel.Spec(pysb_spec.name, steps_model)
 
         def get_steps_spec_by_pysb_spec_idx(pysb_spec_idx):
-            pysb_spec = pysb_model.species[pysb_spec_idx]
-            return next(steps_spec for steps_spec in steps_species if steps_spec.getID() == pysb_spec.name)
+            return steps_spec_by_name[pysb_model.species[pysb_spec_idx].name]
+
+        setup_timer.lap("species")
 
         self.log("load mesh id: {}".format(model_dict["geometry_id"]))
         mesh = Tetmesh(geometry["nodes"], geometry["tets"], geometry["tris"])
 
+        self.log("build mesh index")
+        mesh_index = MeshIndex(geometry)
+
+        setup_timer.lap("mesh")
+
         self.log("about to prepare STEPS Volume and Surface systems")
         sys_dict = {}
         for structure in model_dict["structures"]:
@@ -184,14 +462,14 @@ class StepsSim:
             else:
                 log_struct_sys_type = "Surface"
 
-            self.log(f"add STEPS {log_struct_sys_type} system for {name}")
+            self.log(f"add STEPS {log_struct_sys_type} system for {name}", level="debug")
 
             if structure["type"] == COMPARTMENT:
-                sys = smodel.Volsys(name, steps_model)
+                steps_sys = smodel.Volsys(name, steps_model)
             else:
-                sys = smodel.Surfsys(name, steps_model)
+                steps_sys = smodel.Surfsys(name, steps_model)
 
-            sys_dict[name] = sys
+            sys_dict[name] = steps_sys
 
         self.log("about to create STEPS compartments (TmComp)")
         tm_comp_dict = {}
@@ -201,14 +479,16 @@ class StepsSim:
             name = compartment["name"]
             tetIdxs = compartment["idxs"]
 
-            self.log(f"add STEPS compartment (TmComp) for {name}")
+            self.log(f"add STEPS compartment (TmComp) for {name}", level="debug")
 
             tm_comp = sgeom.TmComp(name, mesh, tetIdxs)
             tm_comp.addVolsys(name)
             tm_comp_dict[name] = tm_comp
 
+        structure_type_by_name = {structure["name"]: structure["type"] for structure in model_dict["structures"]}
+
         def comp_type_by_name(comp_name):
-            return next(structure["type"] for structure in model_dict["structures"] if structure["name"] == comp_name)
+            return structure_type_by_name[comp_name]
 
         def get_pysb_reac_comp_names(pysb_reac):
             spec_idxs = list(pysb_reac["reactants"] + pysb_reac["products"])
@@ -217,18 +497,22 @@ class StepsSim:
 
             return comp_names
 
+        patch_dict_by_comp_names: Dict[frozenset, dict] = {}
+
         def get_patch_dict_by_comp_names(comp_names):
-            comp_name_set = set(comp_names)
+            comp_name_set = frozenset(comp_names)
+            if comp_name_set in patch_dict_by_comp_names:
+                return patch_dict_by_comp_names[comp_name_set]
+
             valid_patch_dicts = [
-                patch_dict
-                for patch_dict in patch_dicts
-                if comp_name_set.issubset(set(patch_dict["comp_names_directional"]))
+                patch_dict for patch_dict in patch_dicts if comp_name_set.issubset(patch_dict["comp_names_directional"])
             ]
 
             if len(valid_patch_dicts) == 0:
                 raise ValueError("No membrane found for compartments: {}".format(comp_names))
 
             if len(valid_patch_dicts) == 1:
+                patch_dict_by_comp_names[comp_name_set] = valid_patch_dicts[0]
                 return valid_patch_dicts[0]
 
             raise NotImplementedError("Found multiple patches for compartments: {}".format(comp_names))
@@ -236,20 +520,12 @@ class StepsSim:
         self.log("about to create STEPS membrane (TmPatch)")
         patch_dicts = []
         membranes = [structure for structure in geometry["structures"] if structure["type"] == MEMBRANE]
-        st = [s for s in geometry["structures"] if s["type"] == COMPARTMENT]
-        idxs = [id_ for s in st for id_ in s["idxs"]]
-        max_id = max(idxs)
 
         for membrane in membranes:
             name = membrane["name"]
-            self.log(f"add STEPS membrane (TmPatch) for {name}")
-            # .getTriTetNeighb might return -1 if triangle is situated on border of the mesh, and there is no tet
-            # from one side
+            self.log(f"add STEPS membrane (TmPatch) for {name}", level="debug")
             triIdxs = membrane["idxs"]
-            neighbTetIdxs = np.array([mesh.getTriTetNeighb(triIdx) for triIdx in triIdxs]).flatten()
-            neighbTetIdxsFiltered = neighbTetIdxs[neighbTetIdxs <= max_id]
-
-            compartment_names = list({get_comp_name_by_tet_idx(tetIdx) for tetIdx in neighbTetIdxsFiltered})
+            compartment_names = get_comp_names_by_tri_idxs(triIdxs)
 
             if "" in compartment_names:
                 # compartment name can be empty string if there is no model structure
@@ -267,8 +543,8 @@ class StepsSim:
             ocomp = tm_comp_dict[comp_names_directional[2]] if len(comp_names_directional) == 3 else None
 
             ocomp_name = ocomp.getID() if ocomp is not None else None
-            self.log(f"inner compartment for {name} patch: {icomp.getID()}")
-            self.log(f"outer compartment for {name} patch: {ocomp_name}")
+            self.log(f"inner compartment for {name} patch: {icomp.getID()}", level="debug")
+            self.log(f"outer compartment for {name} patch: {ocomp_name}", level="debug")
 
             tm_patch = sgeom.TmPatch(id=name, container=mesh, tris=triIdxs, icomp=icomp, ocomp=ocomp)
 
@@ -278,9 +554,12 @@ class StepsSim:
                 "name": name,
                 "comp_names_directional": comp_names_directional,
                 "tm_patch": tm_patch,
+                "tri_idxs": triIdxs,
             }
             patch_dicts.append(patch_dict)
 
+        setup_timer.lap("structures")
+
         def hs_to_str(hs):
             if len(hs):
                 return ", ".join(map(lambda steps_spec: steps_spec.getID(), hs))
@@ -325,7 +604,8 @@ class StepsSim:
                 f"using {patch_name} Surface system, "
                 f"where"
                 f"ilhs: {ilhs_str}, slhs: {slhs_str}, olhs: {olhs_str}, "
-                f"irhs: {irhs_str}, srhs: {srhs_str}, orhs: {orhs_str}, "
+                f"irhs: {irhs_str}, srhs: {srhs_str}, orhs: {orhs_str}, ",
+                level="debug",
             )
 
             steps_reac = smodel.SReac(
@@ -355,7 +635,8 @@ class StepsSim:
             rhs_str = hs_to_str(rhs)
             self.log(
                 f"create STEPS Reac {reac_name} "
-                f"using {comp_name} Volume system, whith lhs: {lhs_str}, rhs: {rhs_str}"
+                f"using {comp_name} Volume system, whith lhs: {lhs_str}, rhs: {rhs_str}",
+                level="debug",
             )
 
             return smodel.Reac(reac_name, volsys, lhs=lhs, rhs=rhs)
@@ -378,15 +659,17 @@ class StepsSim:
                 steps_spec = get_steps_spec_by_pysb_spec_idx(pysb_spec_idx)
                 pysb_spec = pysb_model.species[pysb_spec_idx]
                 comp_name = get_pysb_spec_comp_name(pysb_spec)
-                sys = sys_dict[comp_name]
+                steps_sys = sys_dict[comp_name]
                 dcst = float(model_diffs[observable_idx]["diffusion_constant"])
                 diff_name = "{}_{}".format(diff_common_name, pysb_spec.name)
-                self.log(f"add diffusion for {pysb_spec.name} in {comp_name}")
-                diff = smodel.Diff(diff_name, sys, steps_spec, dcst=dcst)
+                self.log(f"add diffusion for {pysb_spec.name} in {comp_name}", level="debug")
+                diff = smodel.Diff(diff_name, steps_sys, steps_spec, dcst=dcst)
                 steps_diffs.append(diff)
 
                 diff_pysb_spec_idx_dict[comp_name].append(pysb_spec_idx)
 
+        setup_timer.lap("diffusions")
+
         self.log("about to create STEPS reactions")
         steps_reacs = []
         for idx, pysb_reac in enumerate(pysb_model.reactions):
@@ -401,54 +684,39 @@ class StepsSim:
             )
             steps_reacs.append(steps_reac)
 
-        atom_dict = {a.name: a for a in list(pysb_model.parameters) + list(pysb_model.expressions)}
-
-        def set_atom(name, num_value):
-            atom = atom_dict[name]
+        setup_timer.lap("reactions")
 
-            if atom is None:
-                raise ValueError(f"Expression or Parameter {name} not found")
-
-            if isinstance(atom, pysb.core.Parameter):
-                atom.value = num_value
-            else:
-                atom.expr = sympy.Float(num_value)
-
-        def expand_expr(expr):
-            subs = []
-            for a in expr.atoms():
-                if isinstance(a, pysb.core.Expression):
-                    subs.append((a, a.expand_expr()))
-            return expr.subs(subs)
-
-        def eval_expr(expr):
-            param_subs = {p: p.value for p in pysb_model.parameters}
-
-            if isinstance(expr, pysb.core.Parameter):
-                return expr.get_value()
-            elif isinstance(expr, pysb.core.Expression):
-                return expr.expand_expr().evalf(subs=param_subs)
-            else:
-                return expand_expr(expr).evalf(subs=param_subs)
-
-        def calculate_reac_rate(pysb_reac):
-            return eval_expr(pysb_reac["rate"].as_ordered_factors()[-1])
+        self.log("compile rate and initial condition expressions")
+        rate_evaluator = RateEvaluator(pysb_model)
 
         def init_reac_rates():
-            for idx, steps_reac in enumerate(steps_reacs):
-                rate_val = calculate_reac_rate(pysb_model.reactions[idx])
+            for steps_reac, rate_val in zip(steps_reacs, rate_evaluator.rates()):
                 steps_reac.setKcst(rate_val)
 
         init_reac_rates()
 
+        setup_timer.lap("rates")
+
+        self.log("resolve stimulation targets")
+        observable_by_name = {observable.name: observable for observable in pysb_model.observables}
+        stim_specs_by_target = {}
+        for stim in stimuli:
+            if stim["type"] not in ["setConc", "clampConc"] or stim["target"] in stim_specs_by_target:
+                continue
+
+            observable = observable_by_name[stim_name(stim)]
+            # TODO: check if species are present in particular compartments
+            stim_specs_by_target[stim["target"]] = [
+                (pysb_spec.comp_name, pysb_spec.name, comp_type_by_name(pysb_spec.comp_name))
+                for pysb_spec in (pysb_model.species[spec_idx] for spec_idx in observable.species)
+            ]
+
         self.log("about to create STEPS diffusion boundaries")
         diff_boundaries = []
         diff_boundary_spec_names_dict = {}
         for diff_boundary_idx, diff_boundary_dict in enumerate(geometry.get("freeDiffusionBoundaries", [])):
             tris = diff_boundary_dict["triIdxs"]
-            neighbTetIdxs = np.array([mesh.getTriTetNeighb(triIdx) for triIdx in tris]).flatten()
-            neighbTetIdxsFiltered = neighbTetIdxs[neighbTetIdxs >= 0]
-            comp_names = list({get_comp_name_by_tet_idx(tetIdx) for tetIdx in neighbTetIdxsFiltered})
+            comp_names = get_comp_names_by_tri_idxs(tris)
 
             if "" in comp_names:
                 # compartment name can be empty string if there is no model structure corresponding
@@ -476,297 +744,248 @@ class StepsSim:
 
             diff_boundaries.append(diff_boundary)
 
-        self.log("set up RNG")
-        rng = srng.create("mt19937", 512)
-        rng.initialize(654)
+        setup_timer.lap("diffusion boundaries")
+        self.log(f"setup timing: {setup_timer.report()}")
 
-        self.log("create STEPS solver")
+        seed = int(solver_config.get("seed", DEFAULT_SEED))
+        replicates = int(solver_config.get("replicates") or 1)
 
-        if self.sim_config["solver"] == "tetexact":
-            sim = ssolver.Tetexact(steps_model, mesh, rng)
-        else:
-            sim = TetOpSplit(steps_model, mesh, rng, False, [0] * mesh.ntets)
-
-        sim.reset()
-
-        # Sim params and targets for trace recording
-        dt = solver_config["dt"]
-        tend = solver_config["tEnd"]
-
-        stim_tpnt_set = {stim["t"] for stim in stimuli}
-        sample_tpnt_set = set(np.arange(0, tend, dt))
-        tpnts = np.unique(np.append(list(sample_tpnt_set), list(stim_tpnt_set)))
-        tpnts.sort()
-
-        self.log("about to set STEPS initial concentrations")
-        for condition in pysb_model.initial_conditions:
-            pysb_spec, expr = condition
-            spec_name = simplify_string(pysb_spec, compartments=False)
-            comp_name = get_pysb_spec_comp_name(pysb_spec)
-            comp_type = comp_type_by_name(comp_name)
-            value = eval_expr(expr)
-
-            # Unit conversion
-            # BNGL units:
-            # * 2d - # of molecules
-            # * 3d - mM/l
-            # STEPS units:
-            # * 2d - # of molecules
-            # * 3d - mM/m^3
-            try:
-                if comp_type == COMPARTMENT:
-                    self.log(f"set comp conc: @{comp_name}:{spec_name}, val: {value}")
-                    sim.setCompConc(comp_name, spec_name, value)
-
-                else:
-                    self.log(f"set patch count: @{comp_name}:{spec_name}, val: {value}")
-                    sim.setPatchCount(comp_name, spec_name, value)
-            except Exception:
-                L.warning("Runtime warning")
-                L.warning(f"{comp_name}:{spec_name}")
-
-        self.log("about to activate diffusion boundaries")
-        for diff_boundary_name, spec_names in diff_boundary_spec_names_dict.items():
-            self.log("activate diff boundary {} for {}".format(diff_boundary_name, ", ".join(spec_names)))
-            for spec_name in spec_names:
-                sim.setDiffBoundaryDiffusionActive(diff_boundary_name, spec_name, True)
-
-        trace_observables = [
-            observable
-            for observable in pysb_model.observables
-            if re.match(rf"({DIFF_PREFIX}|{STIM_PREFIX}|{SPAT_PREFIX})\w+", observable.name) is None
-        ]
-        trace_observable_names = [observable.name for observable in trace_observables]
-        trace_values = np.zeros((len(sample_tpnt_set), len(trace_observables)))
+        def run_solver(seed: int, sample_spatial: bool = True) -> None:
+            self.log("set up RNG")
+            rng = srng.create("mt19937", 512)
+            # every rank needs its own random stream
+            rng.initialize(seed + (self.mpi_rank or 0))
 
-        spatial_observables = [
-            observable for observable in pysb_model.observables if re.match(rf"({SPAT_PREFIX})\w+", observable.name)
-        ]
+            self.log("create STEPS solver")
 
-        def apply_stimulus(stim):
-            if stim["type"] == "setParam":
-                param_name = stim["target"]
-                value = float(stim["value"])
-                self.log(f"stimulation: setting param {param_name} to {value}")
-                set_atom(param_name, value)
-
-                for reac_idx, steps_reac in enumerate(steps_reacs):
-                    rate_val = calculate_reac_rate(pysb_model.reactions[reac_idx])
-                    if isinstance(steps_reac, smodel.Reac):
-                        curr_comp_reac_k = sim.getCompReacK(steps_reac.getVolsys().getID(), steps_reac.getID())
-                        if curr_comp_reac_k != rate_val:
-                            self.log(
-                                f"stimulation: update comp reacK for {steps_reac.getID()} "
-                                f"from {curr_comp_reac_k} to {rate_val}"
-                            )
-                        sim.setCompReacK(steps_reac.getVolsys().getID(), steps_reac.getID(), rate_val)
-                    else:
-                        curr_patch_reac_k = sim.getPatchSReacK(steps_reac.getSurfsys().getID(), steps_reac.getID())
-                        if curr_patch_reac_k != rate_val:
-                            self.log(
-                                f"stim: update surf reacK for {steps_reac.getID()} "
-                                f"from {curr_patch_reac_k} to {rate_val}"
-                            )
-                        sim.setPatchSReacK(
-                            steps_reac.getSurfsys().getID(),
-                            steps_reac.getID(),
-                            rate_val,
-                        )
-
-            elif stim["type"] == "setConc":
-                observable = next(
-                    observable
-                    for observable in pysb_model.observables
-                    if observable.name == "{}{}".format(STIM_PREFIX, simplify_string(stim["target"]))
-                )
-                pysb_specs = [pysb_model.species[spec_idx] for spec_idx in observable.species]
-                if len(pysb_specs) > 1:
-                    raise ValueError("setConc can be used only with one species: {} detected".format(len(pysb_specs)))
-                pysb_spec = pysb_specs[0]
-                comp_type = comp_type_by_name(pysb_spec.comp_name)
-                # TODO: check if species are present in particular compartments
-
-                target_str = "comp conc" if comp_type == COMPARTMENT else "patch count"
-                self.log(f"set {target_str} for @{pysb_spec.comp_name}:{pysb_spec.name} " f'to {stim["value"]}')
-
-                if comp_type == COMPARTMENT:
-                    sim.setCompConc(pysb_spec.comp_name, pysb_spec.name, stim["value"])
-                else:
-                    sim.setPatchCount(pysb_spec.comp_name, pysb_spec.name, stim["value"])
-
-            elif stim["type"] == "clampConc":
-                # TODO: DRY
-                clamp = stim["value"] == 1
-                observable = next(
-                    observable
-                    for observable in pysb_model.observables
-                    if observable.name == "{}{}".format(STIM_PREFIX, simplify_string(stim["target"]))
-                )
-                pysb_specs = [pysb_model.species[spec_idx] for spec_idx in observable.species]
-                for pysb_spec in pysb_specs:
-                    comp_name = pysb_spec.comp_name
-                    comp_type = comp_type_by_name(comp_name)
-                    # TODO: check if species are present in particular compartments
-                    self.log(f"set @{comp_name}:{pysb_spec.name} clamped to {clamp}")
-                    if comp_type == COMPARTMENT:
-                        sim.setCompClamped(comp_name, pysb_spec.name, clamp)
-                    else:
-                        sim.setPatchClamped(comp_name, pysb_spec.name, clamp)
-
-        self.log("run sim")
-        self.send_progress(SimStatus(status="started"))
-
-        tidx = 0
-        for tpnt in tpnts:
-            sim.run(tpnt)
-
-            if tpnt in stim_tpnt_set:
-                self.log(f"about to apply stimuli for t: {tpnt} s")
-                current_stimuli = [stim for stim in stimuli if stim["t"] == tpnt]
-                for stim in current_stimuli:
-                    apply_stimulus(stim)
-
-            if tpnt in sample_tpnt_set:
-                # sample compartemental molecule amounts
-                for observable_idx, observable in enumerate(trace_observables):
-                    mol_count = 0
-                    for pysb_spec_idx in observable.species:
-                        pysb_spec = pysb_model.species[pysb_spec_idx]
-                        spec_name = pysb_spec.name
-                        comp_name = pysb_spec.comp_name
-                        comp_type = comp_type_by_name(comp_name)
-
-                        try:
-                            if comp_type == COMPARTMENT:
-                                spec_count = sim.getCompCount(comp_name, pysb_spec.name)
-                            else:
-                                spec_count = sim.getPatchCount(comp_name, pysb_spec.name)
-                        except Exception:
-                            L.warning("Runtime warning")
-                        mol_count += spec_count
-                    trace_values[tidx, observable_idx] = mol_count  # Ndarray of (nPoints, nObservables)
-
-                values_by_observable = {
-                    observable: [value] for observable, value in zip(trace_observable_names, trace_values[tidx])
-                }
-
-                sim_trace = SimTrace(
-                    index=tidx,
-                    times=[tpnt],
-                    values_by_observable=values_by_observable,
-                    persist=True,
-                )
-
-                self.send_progress(sim_trace)
-                # sample spatial molecule amounts if requested by user
-
-                if (
-                    "spatialSampling" in solver_config
-                    and solver_config["spatialSampling"] is not None
-                    and solver_config["spatialSampling"]["enabled"]
-                ):
-                    # make a small pause not to flood a client in case of fast simulation
-                    # TODO: implement subscriptions and send spatial step traces only when
-                    # client requires them, waiting for ack for each of them.
-                    time.sleep(0.02)
-
-                    spatial_trace_data_dict: Dict[str, Dict[str, dict]] = defaultdict(dict)
-
-                    for structure in model_dict["geometry"]["structures"]:
-                        structure_name: str = structure["name"]
+            if self.sim_config["solver"] == "tetexact":
+                sim = ssolver.Tetexact(steps_model, mesh, rng)
+            elif steps.mpi.nhosts > 1:
+                self.log(f"partition mesh for {steps.mpi.nhosts} MPI ranks")
+                patch_tri_idxs = [tri_idx for patch_dict in patch_dicts for tri_idx in patch_dict["tri_idxs"]]
+                tet_hosts, tri_hosts = partition_mesh(mesh, steps.mpi.nhosts, patch_tri_idxs)
+                sim = TetOpSplit(steps_model, mesh, rng, False, tet_hosts, tri_hosts)
+            else:
+                sim = TetOpSplit(steps_model, mesh, rng, False, [0] * mesh.ntets)
 
-                        geom_idxs_np = np.array(structure["idxs"], dtype=np.uintc)
-                        for spatial_observable in spatial_observables:
-                            mol_name = spatial_observable.name.replace(SPAT_PREFIX, "")
-                            mol_counts = np.zeros(len(geom_idxs_np))
+            sim.reset()
+            rate_evaluator.reset()
 
-                            for pysb_spec_idx in spatial_observable.species:
-                                pysb_spec = pysb_model.species[pysb_spec_idx]
+            # Sim params and targets for trace recording
+            dt = solver_config["dt"]
+            tend = solver_config["tEnd"]
 
-                                if pysb_spec.comp_name != structure_name:
-                                    continue
+            sample_tpnts, time_points = sim_timeline(tend, dt, stimuli)
 
-                                spec_name = pysb_spec.name
-                                spec_counts = np.zeros(len(geom_idxs_np))
+            self.log("about to set STEPS initial concentrations")
+            initial_values = rate_evaluator.initial_values()
+            for condition, value in zip(pysb_model.initial_conditions, initial_values):
+                pysb_spec, _ = condition
+                spec_name = simplify_string(pysb_spec, compartments=False)
+                comp_name = get_pysb_spec_comp_name(pysb_spec)
+                comp_type = comp_type_by_name(comp_name)
+
+                # Unit conversion
+                # BNGL units:
+                # * 2d - # of molecules
+                # * 3d - mM/l
+                # STEPS units:
+                # * 2d - # of molecules
+                # * 3d - mM/m^3
+                try:
+                    if comp_type == COMPARTMENT:
+                        self.log(f"set comp conc: @{comp_name}:{spec_name}, val: {value}", level="debug")
+                        sim.setCompConc(comp_name, spec_name, value)
 
-                                if structure["type"] == COMPARTMENT:
-                                    sim.getBatchTetCountsNP(geom_idxs_np, spec_name, spec_counts)
-                                else:
-                                    sim.getBatchTriCountsNP(geom_idxs_np, spec_name, spec_counts)
-                                mol_counts = mol_counts + spec_counts
+                    else:
+                        self.log(f"set patch count: @{comp_name}:{spec_name}, val: {value}", level="debug")
+                        sim.setPatchCount(comp_name, spec_name, value)
+                except Exception:
+                    L.warning("Runtime warning")
+                    L.warning(f"{comp_name}:{spec_name}")
+
+            self.log("about to activate diffusion boundaries")
+            for diff_boundary_name, spec_names in diff_boundary_spec_names_dict.items():
+                self.log("activate diff boundary {} for {}".format(diff_boundary_name, ", ".join(spec_names)))
+                for spec_name in spec_names:
+                    sim.setDiffBoundaryDiffusionActive(diff_boundary_name, spec_name, True)
+
+            trace_observables = [
+                observable
+                for observable in pysb_model.observables
+                if re.match(rf"({DIFF_PREFIX}|{STIM_PREFIX}|{SPAT_PREFIX})\w+", observable.name) is None
+            ]
+            trace_observable_names = [observable.name for observable in trace_observables]
+            trace_values = np.zeros((len(sample_tpnts), len(trace_observables)))
+            trace_sampler = TraceSampler(trace_observables, pysb_model.species, structure_type_by_name)
 
-                            non_zero_counts = mol_counts > 0
+            spatial_sampler = None
+            if spatial_sampling["enabled"] and sample_spatial:
+                spatial_observables = [
+                    observable
+                    for observable in pysb_model.observables
+                    if re.match(rf"({SPAT_PREFIX})\w+", observable.name)
+                ]
+                spatial_sampler = SpatialSampler(
+                    geometry["structures"], spatial_observables, pysb_model.species, SPAT_PREFIX
+                )
+                spatial_encoder = SpatialTraceEncoder()
+
+            def apply_stimulus(stim):
+                if stim["type"] == "setParam":
+                    param_name = stim["target"]
+                    value = float(stim["value"])
+                    self.log(f"stimulation: setting param {param_name} to {value}")
+                    reac_idxs = rate_evaluator.set_value(param_name, value)
+                    rate_vals = rate_evaluator.rates()
+
+                    # only reactions with rates depending on the param
+                    for reac_idx in reac_idxs:
+                        steps_reac = steps_reacs[reac_idx]
+                        rate_val = rate_vals[reac_idx]
+                        if isinstance(steps_reac, smodel.Reac):
+                            curr_comp_reac_k = sim.getCompReacK(steps_reac.getVolsys().getID(), steps_reac.getID())
+                            if curr_comp_reac_k != rate_val:
+                                self.log(
+                                    f"stimulation: update comp reacK for {steps_reac.getID()} "
+                                    f"from {curr_comp_reac_k} to {rate_val}",
+                                    level="debug",
+                                )
+                            sim.setCompReacK(steps_reac.getVolsys().getID(), steps_reac.getID(), rate_val)
+                        else:
+                            curr_patch_reac_k = sim.getPatchSReacK(steps_reac.getSurfsys().getID(), steps_reac.getID())
+                            if curr_patch_reac_k != rate_val:
+                                self.log(
+                                    f"stim: update surf reacK for {steps_reac.getID()} "
+                                    f"from {curr_patch_reac_k} to {rate_val}",
+                                    level="debug",
+                                )
+                            sim.setPatchSReacK(
+                                steps_reac.getSurfsys().getID(),
+                                steps_reac.getID(),
+                                rate_val,
+                            )
 
-                            if np.any(non_zero_counts):
-                                spatial_trace_data_dict[structure_name][mol_name] = {
-                                    "idxs": geom_idxs_np[non_zero_counts],
-                                    "molCounts": mol_counts[non_zero_counts],
-                                }
+                elif stim["type"] == "setConc":
+                    stim_specs = stim_specs_by_target[stim["target"]]
+                    if len(stim_specs) > 1:
+                        raise ValueError(
+                            "setConc can be used only with one species: {} detected".format(len(stim_specs))
+                        )
+                    comp_name, spec_name, comp_type = stim_specs[0]
 
-                    self.send_progress(SimSpatialStepTrace(stepIdx=tidx, t=tpnt, data=spatial_trace_data_dict))
+                    target_str = "comp conc" if comp_type == COMPARTMENT else "patch count"
+                    self.log(f"set {target_str} for @{comp_name}:{spec_name} " f'to {stim["value"]}')
 
-                num_points = len(sample_tpnt_set)
-                progress = int((tidx + 1) / num_points * 100)
+                    if comp_type == COMPARTMENT:
+                        sim.setCompConc(comp_name, spec_name, stim["value"])
+                    else:
+                        sim.setPatchCount(comp_name, spec_name, stim["value"])
+
+                elif stim["type"] == "clampConc":
+                    clamp = stim["value"] == 1
+                    for comp_name, spec_name, comp_type in stim_specs_by_target[stim["target"]]:
+                        self.log(f"set @{comp_name}:{spec_name} clamped to {clamp}")
+                        if comp_type == COMPARTMENT:
+                            sim.setCompClamped(comp_name, spec_name, clamp)
+                        else:
+                            sim.setPatchClamped(comp_name, spec_name, clamp)
+
+            self.log("run sim")
+            self.send_progress(SimStatus(status="started"))
+
+            num_points = len(sample_tpnts)
+            for tpnt, tidx, current_stimuli in time_points:
+                sim.run(tpnt)
+
+                if current_stimuli:
+                    self.log(f"about to apply stimuli for t: {tpnt} s")
+                    for stim in current_stimuli:
+                        apply_stimulus(stim)
+
+                if tidx is not None:
+                    # sample compartemental molecule amounts
+                    trace_sampler.sample(sim, trace_values[tidx])  # Ndarray of (nPoints, nObservables)
+
+                    # a row as array views rather than lists, to be written to the shared memory ring as is
+                    trace_row = trace_values[tidx : tidx + 1]
+                    values_by_observable = {
+                        observable: trace_row[:, obs_idx] for obs_idx, observable in enumerate(trace_observable_names)
+                    }
+
+                    sim_trace = SimTrace(
+                        index=tidx,
+                        times=sample_tpnts[tidx : tidx + 1],
+                        values_by_observable=values_by_observable,
+                        persist=True,
+                    )
+
+                    self.send_progress(sim_trace)
+                    # sample spatial molecule amounts if requested by user
+
+                    if spatial_sampler is not None:
+                        keyframe, spatial_trace_data_dict = spatial_encoder.encode(spatial_sampler.sample(sim))
+                        self.send_progress(
+                            SimSpatialStepTrace(stepIdx=tidx, t=tpnt, data=spatial_trace_data_dict, keyframe=keyframe)
+                        )
 
-                if (tidx) % math.ceil(num_points / 100) == 0:
-                    self.log(f"done {progress}% (sim time: {tpnt} s)")
-                    self.send_progress(SimProgress(progress=progress))
+                    progress = int((tidx + 1) / num_points * 100)
 
-                tidx += 1
+                    if (tidx) % math.ceil(num_points / 100) == 0:
+                        self.log(f"done {progress}% (sim time: {tpnt} s)")
+                        self.send_progress(SimProgress(progress=progress))
 
-        values = trace_values.T
+            values = trace_values.T
 
-        # pylint: disable=unsubscriptable-object
-        values_by_observable = {
-            trace_observable_names[i]: values[i].tolist() for i in range(len(trace_observable_names))
-        }
+            # pylint: disable=unsubscriptable-object
+            values_by_observable = {trace_observable_names[i]: values[i] for i in range(len(trace_observable_names))}
 
-        self.send_progress(
-            SimTrace(
-                index=0,
-                times=sorted(sample_tpnt_set),
-                values_by_observable=values_by_observable,
-                persist=False,
-                stream=False,
+            self.send_progress(
+                SimTrace(
+                    index=0,
+                    times=sample_tpnts,
+                    values_by_observable=values_by_observable,
+                    persist=False,
+                    stream=False,
+                )
             )
-        )
 
-        self.log("done")
-        self.send_progress(SimStatus(status="finished"))
+            self.log("done")
+            self.send_progress(SimStatus(status="finished"))
+
+        if replicates > 1:
+            self.run_replicates(run_solver, seed, replicates)
+        else:
+            run_solver(seed)
 
 
 def simplify_string(st, compartments=True, is_bngl=False):
-    st0 = str(st)
+    st0 = st if isinstance(st, str) else str(st)
 
     if is_bngl:
-        name = re.sub(" ", "", st0)
-        name = re.sub("=None", "", name)
-        name = re.sub("=", "~", name)
-        name = re.sub("'", "", name)
-        name = re.sub(r"\*\*", "@", name)
-        name = re.sub("%", ".", name)
+        name = st0.replace(" ", "")
+        name = name.replace("=None", "")
+        name = name.replace("=", "~")
+        name = name.replace("'", "")
+        name = name.replace("**", "@")
+        name = name.replace("%", ".")
 
         if not compartments:
-            name = re.sub(r"@\s+\w+", "", name)
+            name = BNGL_COMP_RE.sub("", name)
 
         return name
 
     if st0[0] == "(":
         # find outer parens
-        outer = re.compile(r"\((.+)\)")
-        match = outer.search(st0)
+        match = OUTER_PARENS_RE.search(st0)
         st = match.group(1)
     else:
         st = st0
 
     if not compartments:
-        st = re.sub(r"\*\*\s+\w+", "", st)
+        st = COMP_RE.sub("", st)
 
-    sim = re.split(r"\W+", st)
-    st2 = sim[0]
-    for i in range(1, len(sim)):
-        st2 = st2 + "_" + sim[i]
-    return st2
+    return "_".join(NON_WORD_RE.split(st))
 
 
 def has_functional_rate_laws(reaction: dict):
@@ -0,0 +1,70 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .sim import decompress_stimulation
+
+# Times closer than this fraction of a sample step are the same time point
+TIME_TOLERANCE = 1e-6
+
+StimulusGroup = Tuple[float, List[dict]]
+TimePoint = Tuple[float, Optional[int], List[dict]]
+
+
+def get_stimuli(solver_conf: dict) -> List[dict]:
+    """Stimuli of a solver config, compressed stimulation is decompressed, empty list if there are none."""
+    stimulation = solver_conf.get("stimulation")
+    if stimulation is None:
+        return []
+
+    if isinstance(stimulation, list):
+        return stimulation
+
+    return decompress_stimulation(stimulation)
+
+
+def group_stimuli(stimuli: List[dict], tolerance: float) -> List[StimulusGroup]:
+    """Group stimuli by time, keeping their order within a group.
+
+    Returns:
+        Time of the first stimulus of a group and its stimuli, sorted by time.
+    """
+    groups: List[StimulusGroup] = []
+    for stim in sorted(stimuli, key=lambda stim: stim["t"]):
+        if groups and stim["t"] - groups[-1][0] <= tolerance:
+            groups[-1][1].append(stim)
+        else:
+            groups.append((stim["t"], [stim]))
+
+    return groups
+
+
+def sim_timeline(t_end: float, dt: float, stimuli: List[dict]) -> Tuple[np.ndarray, List[TimePoint]]:
+    """Merge sample times and times of stimuli into points to run a simulation to.
+
+    A stimulus within the tolerance of a sample time is applied at that sample, before sampling.
+    Stimuli at or after `t_end` are ignored as they can't change any sample.
+
+    Returns:
+        Sample times and time points with the index of their sample, if any, and stimuli to apply.
+    """
+    sample_times = np.arange(0, t_end, dt)
+    tolerance = dt * TIME_TOLERANCE
+
+    stimuli_by_sample_idx: Dict[int, List[dict]] = {}
+    extra_points: List[TimePoint] = []
+    for t, stimuli_group in group_stimuli(stimuli, tolerance):
+        sample_idx = int(round(t / dt))
+        if 0 <= sample_idx < len(sample_times) and abs(sample_times[sample_idx] - t) <= tolerance:
+            stimuli_by_sample_idx.setdefault(sample_idx, []).extend(stimuli_group)
+        elif 0 <= t < t_end:
+            extra_points.append((t, None, stimuli_group))
+
+    sample_points: List[TimePoint] = [
+        (float(t), sample_idx, stimuli_by_sample_idx.get(sample_idx, [])) for sample_idx, t in enumerate(sample_times)
+    ]
+
+    # both lists are sorted by time, stable sort merges them in linear time
+    time_points = sorted(sample_points + extra_points, key=lambda time_point: time_point[0])
+
+    return sample_times, time_points
@@ -0,0 +1,462 @@
+import os
+import json
+import bisect
+import time
+import shutil
+from typing import Dict, List, Optional, Iterator
+
+import numpy as np
+
+from .utils import umask
+from .spatial_encoding import SpatialTraceDecoder
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+TRACES_PATH = "/data/traces"
+SPATIAL_TRACES_PATH = "/data/spatial-traces"
+
+MANIFEST_FILENAME = "manifest.json"
+TIMES_FILENAME = "times.f64"
+COLUMN_DTYPE = np.dtype("<f8")
+
+FLUSH_ROWS = 4096
+FLUSH_INTERVAL_SECS = 1
+
+LOD_DIRNAME = "lod"
+LOD_FACTOR = 4
+# Levels with fewer bins than this are not built, raw or lower levels are small enough then
+LOD_MIN_LENGTH = 256
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, MANIFEST_FILENAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    tmp_path = os.path.join(path, f"{MANIFEST_FILENAME}.tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILENAME))
+
+
+def write_column(path: str, offset: int, values: np.ndarray) -> None:
+    """Write values at a given element offset of a raw column file, dropping anything after them."""
+    mode = "r+b" if os.path.exists(path) else "wb"
+    with open(path, mode) as file:
+        file.seek(offset * values.itemsize)
+        file.write(values.tobytes())
+        file.truncate()
+
+
+def read_column(path: str, start: int, end: int, dtype: np.dtype = COLUMN_DTYPE) -> np.ndarray:
+    if end <= start:
+        return np.zeros(0, dtype=dtype)
+
+    with open(path, "rb") as file:
+        file.seek(start * dtype.itemsize)
+        return np.fromfile(file, dtype=dtype, count=end - start)
+
+
+class TraceWriter:
+    """Append-only columnar storage of simulation traces.
+
+    Layout of a trace directory:
+        manifest.json: observable names with their column files and the number of committed rows
+        times.f64: time points, raw little-endian float64
+        {idx}.f64: values of an observable, raw little-endian float64
+        lod/: min/max detail levels, built when the writer is closed, see `build_trace_pyramid`
+
+    The manifest is written last, so rows beyond its `length` are never visible to readers and get
+    overwritten by the next flush. Rows are buffered in memory and flushed in blocks.
+    """
+
+    def __init__(self, sim_id: str, root_path: str = TRACES_PATH) -> None:
+        self.path = os.path.join(root_path, sim_id)
+
+        with umask():
+            os.makedirs(self.path, 0o777, exist_ok=True)
+
+        self.manifest = read_manifest(self.path) or {
+            "version": 1,
+            "dtype": COLUMN_DTYPE.str,
+            "times": TIMES_FILENAME,
+            "observables": [],
+            "length": 0,
+            "complete": False,
+        }
+        self.times_buffer: List[np.ndarray] = []
+        self.values_buffer: Dict[str, List[np.ndarray]] = {}
+        self.buffered_rows = 0
+        self.last_flush = time.time()
+
+    @property
+    def observable_names(self) -> List[str]:
+        return [observable["name"] for observable in self.manifest["observables"]]
+
+    def append(self, times: List[float], values_by_observable: Dict[str, List[float]]) -> None:
+        if not self.manifest["observables"]:
+            self.manifest["observables"] = [
+                {"name": name, "file": f"{idx}.f64"} for idx, name in enumerate(values_by_observable)
+            ]
+
+        if set(values_by_observable) != set(self.observable_names):
+            raise ValueError("Trace observables don't match already stored ones")
+
+        self.times_buffer.append(np.asarray(times, dtype=COLUMN_DTYPE))
+        for name, values in values_by_observable.items():
+            self.values_buffer.setdefault(name, []).append(np.asarray(values, dtype=COLUMN_DTYPE))
+        self.buffered_rows += len(times)
+
+        if self.buffered_rows >= FLUSH_ROWS or time.time() - self.last_flush > FLUSH_INTERVAL_SECS:
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.time()
+
+        if not self.buffered_rows:
+            return
+
+        offset = self.manifest["length"]
+
+        for observable in self.manifest["observables"]:
+            values = np.concatenate(self.values_buffer[observable["name"]])
+            write_column(os.path.join(self.path, observable["file"]), offset, values)
+        write_column(os.path.join(self.path, TIMES_FILENAME), offset, np.concatenate(self.times_buffer))
+
+        self.manifest["length"] = offset + self.buffered_rows
+        write_manifest(self.path, self.manifest)
+
+        self.times_buffer = []
+        self.values_buffer = {}
+        self.buffered_rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.manifest["lod"] = build_trace_pyramid(self.path, self.manifest)
+        self.manifest["complete"] = True
+        write_manifest(self.path, self.manifest)
+
+
+def read_trace(
+    sim_id: str,
+    observables: Optional[List[str]] = None,
+    t_start: Optional[float] = None,
+    t_end: Optional[float] = None,
+    root_path: str = TRACES_PATH,
+) -> Optional[dict]:
+    """Read selected observables of a stored trace within [t_start, t_end] time window."""
+    path = os.path.join(root_path, sim_id)
+    manifest = read_manifest(path)
+
+    if manifest is None:
+        return None
+
+    length = manifest["length"]
+    times: np.ndarray
+    if length:
+        times = np.memmap(os.path.join(path, manifest["times"]), dtype=COLUMN_DTYPE, mode="r", shape=(length,))
+    else:
+        times = np.zeros(0, dtype=COLUMN_DTYPE)
+
+    start = 0 if t_start is None else int(np.searchsorted(times, t_start, side="left"))
+    end = length if t_end is None else int(np.searchsorted(times, t_end, side="right"))
+
+    file_by_observable = {observable["name"]: observable["file"] for observable in manifest["observables"]}
+    names = list(file_by_observable) if observables is None else observables
+
+    unknown_names = [name for name in names if name not in file_by_observable]
+    if unknown_names:
+        raise ValueError(f"Unknown observables: {', '.join(unknown_names)}")
+
+    values_by_observable = {
+        name: read_column(os.path.join(path, file_by_observable[name]), start, end) for name in names
+    }
+
+    return {"times": np.array(times[start:end]), "values_by_observable": values_by_observable}
+
+
+def level_path(path: str, level: int) -> str:
+    return os.path.join(path, LOD_DIRNAME, str(level))
+
+
+def bin_starts(length: int, bin_size: int) -> np.ndarray:
+    return np.arange(0, length, bin_size)
+
+
+def build_trace_pyramid(path: str, manifest: dict) -> List[dict]:
+    """Build min/max level-of-detail levels of a stored trace.
+
+    Level `n` stores, for bins of `LOD_FACTOR ** n` raw rows, the time of the first row of the bin
+    and min and max of each observable within the bin. Every level is built from the previous one,
+    one observable column at a time, so memory is bounded by the size of a single column.
+
+    Layout of a level directory `lod/{level}/`:
+        times.f64: time of the first row of each bin
+        {idx}.min.f64, {idx}.max.f64: min and max of an observable in each bin
+
+    Returns:
+        Level descriptors with bin sizes and number of bins, to be stored in the manifest.
+    """
+    length = manifest["length"]
+
+    levels: List[dict] = []
+    level_length = length
+    bin_size = 1
+    while level_length // LOD_FACTOR >= LOD_MIN_LENGTH:
+        bin_size *= LOD_FACTOR
+        level_length = -(-length // bin_size)
+        levels.append({"level": len(levels) + 1, "binSize": bin_size, "length": level_length})
+
+    if not levels:
+        return []
+
+    with umask():
+        for level in levels:
+            os.makedirs(level_path(path, level["level"]), 0o777, exist_ok=True)
+
+    times = read_column(os.path.join(path, manifest["times"]), 0, length)
+    for level in levels:
+        level_times = times[bin_starts(length, level["binSize"])]
+        write_column(os.path.join(level_path(path, level["level"]), TIMES_FILENAME), 0, level_times)
+
+    for observable in manifest["observables"]:
+        values = read_column(os.path.join(path, observable["file"]), 0, length)
+        mins, maxs = values, values
+
+        for level in levels:
+            starts = bin_starts(len(mins), LOD_FACTOR)
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+
+            column_path = os.path.join(level_path(path, level["level"]), observable["file"])
+            write_column(f"{column_path[:-len('.f64')]}.min.f64", 0, mins)
+            write_column(f"{column_path[:-len('.f64')]}.max.f64", 0, maxs)
+
+    L.debug(f"built {len(levels)} lod levels for {path}")
+
+    return levels
+
+
+def read_trace_window(
+    sim_id: str,
+    resolution: int,
+    observables: Optional[List[str]] = None,
+    t_start: Optional[float] = None,
+    t_end: Optional[float] = None,
+    root_path: str = TRACES_PATH,
+) -> Optional[dict]:
+    """Read a time window of a stored trace with at most `resolution` points per observable.
+
+    Windows with no more rows than `resolution` are returned as raw values. Otherwise the most
+    detailed level which still fits is used and min and max of every bin are returned, so that peaks
+    survive downsampling. Bins at the window edges can include rows just outside of the window.
+    Traces of running simulations don't have levels yet, bins are computed from raw rows then.
+    """
+    path = os.path.join(root_path, sim_id)
+    manifest = read_manifest(path)
+
+    if manifest is None:
+        return None
+
+    length = manifest["length"]
+    times: np.ndarray
+    if length:
+        times = np.memmap(os.path.join(path, manifest["times"]), dtype=COLUMN_DTYPE, mode="r", shape=(length,))
+    else:
+        times = np.zeros(0, dtype=COLUMN_DTYPE)
+
+    start = 0 if t_start is None else int(np.searchsorted(times, t_start, side="left"))
+    end = length if t_end is None else int(np.searchsorted(times, t_end, side="right"))
+    n_rows = max(end - start, 0)
+
+    file_by_observable = {observable["name"]: observable["file"] for observable in manifest["observables"]}
+    names = list(file_by_observable) if observables is None else observables
+
+    unknown_names = [name for name in names if name not in file_by_observable]
+    if unknown_names:
+        raise ValueError(f"Unknown observables: {', '.join(unknown_names)}")
+
+    if resolution < 1:
+        raise ValueError("Resolution should be a positive number")
+
+    if n_rows <= resolution:
+        return {
+            "times": np.array(times[start:end]),
+            "binSize": 1,
+            "values_by_observable": {
+                name: read_column(os.path.join(path, file_by_observable[name]), start, end) for name in names
+            },
+        }
+
+    level = next(
+        (
+            level
+            for level in manifest.get("lod", [])
+            if -(-end // level["binSize"]) - start // level["binSize"] <= resolution
+        ),
+        None,
+    )
+
+    min_by_observable: Dict[str, np.ndarray] = {}
+    max_by_observable: Dict[str, np.ndarray] = {}
+
+    if level is None:
+        bin_size = -(-n_rows // resolution)
+        starts = bin_starts(n_rows, bin_size)
+        bin_times = np.array(times[start:end][starts])
+
+        for name in names:
+            values = read_column(os.path.join(path, file_by_observable[name]), start, end)
+            min_by_observable[name] = np.minimum.reduceat(values, starts)
+            max_by_observable[name] = np.maximum.reduceat(values, starts)
+    else:
+        bin_size = level["binSize"]
+        bin_start = start // bin_size
+        bin_end = -(-end // bin_size)
+        level_dir = level_path(path, level["level"])
+        bin_times = read_column(os.path.join(level_dir, TIMES_FILENAME), bin_start, bin_end)
+
+        for name in names:
+            column_path = os.path.join(level_dir, file_by_observable[name])[: -len(".f64")]
+            min_by_observable[name] = read_column(f"{column_path}.min.f64", bin_start, bin_end)
+            max_by_observable[name] = read_column(f"{column_path}.max.f64", bin_start, bin_end)
+
+    return {
+        "times": bin_times,
+        "binSize": bin_size,
+        "min_by_observable": min_by_observable,
+        "max_by_observable": max_by_observable,
+    }
+
+
+class SpatialTraceWriter:
+    """Storage of spatial step traces, every step is written into its own `{stepIdx}.npz` file.
+
+    Step time points are appended to `times.f64`, so that any step can be loaded without touching
+    the others. Steps are stored as encoded by the worker, indices of keyframes are kept in the
+    manifest to reconstruct delta steps.
+    """
+
+    def __init__(self, sim_id: str, root_path: str = SPATIAL_TRACES_PATH) -> None:
+        self.path = os.path.join(root_path, sim_id)
+
+        with umask():
+            os.makedirs(self.path, 0o777, exist_ok=True)
+
+        self.manifest = read_manifest(self.path) or {
+            "version": 1,
+            "times": TIMES_FILENAME,
+            "length": 0,
+            "keyframes": [],
+            "complete": False,
+        }
+
+    def append(self, step_idx: int, t: float, data: Dict[str, Dict[str, dict]], keyframe: bool = True) -> None:
+        arrays = {}
+        for structure_name, structure_data in data.items():
+            for mol_name, mol_data in structure_data.items():
+                arrays[f"{structure_name}/{mol_name}/idxs"] = np.asarray(mol_data["idxs"])
+                arrays[f"{structure_name}/{mol_name}/molCounts"] = np.asarray(mol_data["molCounts"])
+
+        tmp_path = os.path.join(self.path, f"{step_idx}.tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, os.path.join(self.path, f"{step_idx}.npz"))
+
+        write_column(os.path.join(self.path, TIMES_FILENAME), step_idx, np.array([t], dtype=COLUMN_DTYPE))
+
+        if keyframe:
+            self.manifest.setdefault("keyframes", []).append(step_idx)
+        self.manifest["length"] = max(self.manifest["length"], step_idx + 1)
+        write_manifest(self.path, self.manifest)
+
+    def close(self) -> None:
+        self.manifest["complete"] = True
+        write_manifest(self.path, self.manifest)
+
+
+def read_spatial_step_data(path: str, step_idx: int) -> Optional[Dict[str, Dict[str, dict]]]:
+    step_path = os.path.join(path, f"{step_idx}.npz")
+
+    if not os.path.isfile(step_path):
+        return None
+
+    data: Dict[str, Dict[str, dict]] = {}
+    with np.load(step_path) as arrays:
+        for key in arrays.files:
+            structure_name, mol_name, array_name = key.split("/")
+            data.setdefault(structure_name, {}).setdefault(mol_name, {})[array_name] = arrays[key]
+
+    return data
+
+
+def is_spatial_keyframe(manifest: dict, step_idx: int) -> bool:
+    # Steps written before keyframes were introduced are all full steps
+    if "keyframes" not in manifest:
+        return True
+
+    # keyframes are appended in step order
+    keyframe_idxs = manifest["keyframes"]
+    keyframe_pos = bisect.bisect_left(keyframe_idxs, step_idx)
+    return keyframe_pos < len(keyframe_idxs) and keyframe_idxs[keyframe_pos] == step_idx
+
+
+def read_spatial_step_trace(sim_id: str, step_idx: int, root_path: str = SPATIAL_TRACES_PATH) -> Optional[dict]:
+    """Read a step, delta steps are reconstructed from the nearest preceding keyframe."""
+    path = os.path.join(root_path, sim_id)
+    manifest = read_manifest(path)
+
+    if manifest is None or not os.path.isfile(os.path.join(path, f"{step_idx}.npz")):
+        return None
+
+    keyframe_idxs = manifest.get("keyframes", [step_idx])
+    keyframe_pos = bisect.bisect_right(keyframe_idxs, step_idx) - 1
+    if keyframe_pos < 0:
+        return None
+
+    decoder = SpatialTraceDecoder()
+    data: Dict[str, Dict[str, dict]] = {}
+    for idx in range(keyframe_idxs[keyframe_pos], step_idx + 1):
+        step_data = read_spatial_step_data(path, idx)
+        if step_data is not None:
+            data = decoder.decode(step_data, is_spatial_keyframe(manifest, idx))
+
+    t = read_column(os.path.join(path, TIMES_FILENAME), step_idx, step_idx + 1)
+
+    return {"stepIdx": step_idx, "t": float(t[0]), "data": data, "simId": sim_id}
+
+
+def iter_spatial_step_traces(sim_id: str, root_path: str = SPATIAL_TRACES_PATH) -> Iterator[dict]:
+    """Iterate over all steps in order, reconstructing delta steps on the way."""
+    path = os.path.join(root_path, sim_id)
+    manifest = read_manifest(path)
+
+    if manifest is None:
+        return
+
+    times = read_column(os.path.join(path, TIMES_FILENAME), 0, manifest["length"])
+    decoder = SpatialTraceDecoder()
+
+    for step_idx in range(manifest["length"]):
+        step_data = read_spatial_step_data(path, step_idx)
+        if step_data is None:
+            continue
+
+        data = decoder.decode(step_data, is_spatial_keyframe(manifest, step_idx))
+        yield {"stepIdx": step_idx, "t": float(times[step_idx]), "data": data, "simId": sim_id}
+
+
+def remove_traces(sim_id: str) -> None:
+    for root_path in [TRACES_PATH, SPATIAL_TRACES_PATH]:
+        path = os.path.join(root_path, sim_id)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        # Traces stored by previous versions of the backend
+        legacy_path = f"{path}.json"
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
@@ -1,4 +1,4 @@
-from typing import Optional, Any, List, Union, Literal
+from typing import Optional, Any, Dict, List, Union, Literal
 
 from tornado import websocket
 from pydantic import BaseModel
@@ -7,6 +7,23 @@ from pydantic import BaseModel
 SimStatus = Literal["created", "queued", "init", "started", "error", "finished", "cancelled"]
 ModelFormat = Literal["bngl", "ebngl", "pysb_flat", "sbml"]
 SimSolver = Literal["tetexact", "tetopsplit", "nfsim", "ode", "ssa"]
+LogLevel = Literal["debug", "info", "warning", "error"]
+
+
+class EnsembleSpec(BaseModel):
+    """Runs of an ensemble: every point of the parameter grid is simulated `replicates` times.
+
+    Attributes:
+        paramGrid: Values by parameter name, runs cover the cartesian product of all values
+        replicates: Number of runs per grid point
+        seeds: RNG seed of every replicate, derived from `solverConf.seed` when not given
+        quantiles: Quantiles of the aggregated traces
+    """
+
+    paramGrid: Dict[str, List[float]] = {}
+    replicates: int = 1
+    seeds: Optional[List[int]]
+    quantiles: List[float] = [0.05, 0.5, 0.95]
 
 
 class SimConfig(BaseModel):
@@ -21,6 +38,12 @@ class SimConfig(BaseModel):
     id: str
     annotation: str
     model_str = ""
+    priority: Optional[int] = 0
+    ensemble: Optional[EnsembleSpec]
+    # set on member runs of an ensemble
+    ensembleId: Optional[str]
+    ensembleIdx: Optional[int]
+    paramOverrides: Optional[Dict[str, float]]
 
 
 class Message(BaseModel):
@@ -69,6 +92,13 @@ class SolverConfig(BaseModel):
     spatialSampling: Optional[SpatialSampling]
     stimulation: Any
     tEnd: float
+    seed: Optional[int]
+    # STEPS only, number of independently seeded runs sharing the model and mesh setup
+    replicates: Optional[int]
+    # TetOpSplit only, number of MPI ranks, derived from the number of cores when not set
+    mpiRanks: Optional[int]
+    # lowest level of log messages sent by the sim, SIM_LOG_LEVEL when not set
+    logLevel: Optional[LogLevel]
 
 
 class Simulation(BaseModel):
@@ -100,6 +130,13 @@ class GetSimulations(BaseModel):
     modelId: str
 
 
+class GetSimLogPage(BaseModel):
+    simId: str
+    source: str = "system"
+    offset: int = 0
+    limit: int = 1000
+
+
 class Entity(BaseModel):
     name: str
     definition: str
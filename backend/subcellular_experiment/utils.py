@@ -38,3 +38,14 @@ def umask(mask=0):
         yield
     finally:
         os.umask(old_mask)
+
+
+def ndarrays_to_lists(obj):
+    """Recursively convert NumPy arrays to lists, e.g. to store a document in MongoDB."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return {key: ndarrays_to_lists(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [ndarrays_to_lists(value) for value in obj]
+    return obj
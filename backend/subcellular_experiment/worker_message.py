@@ -1,8 +1,11 @@
-from typing import Any, Optional, Literal
-from pydantic import BaseModel
+import json
+import struct
+from typing import Any, Optional, Literal, List, Union
 
+import numpy as np
+from pydantic import BaseModel
 
-WorkerStatus = Literal["ready", "busy"]
+from .utils import ExtendedJSONEncoder
 
 WorkerMessage = Literal[
     "worker_connect",
@@ -10,8 +13,7 @@ WorkerMessage = Literal[
     "simProgress",
     "simTrace",
     "simStatus",
-    "simLogMessage",
-    "simLog",
+    "simLogBatch",
     "simSpatialStepTrace",
     "tmp_sim_log",
 ]
@@ -23,6 +25,104 @@ class SimWorkerMessage(BaseModel):
     cmdid: Optional[int]
 
 
+class WorkerCapacity(BaseModel):
+    """Simulation slots of a worker.
+
+    Attributes:
+        slots: Number of simulations the worker can run concurrently
+        freeSlots: Number of slots which are not running a simulation
+        releasedSimId: Id of the simulation which has just finished and freed its slot
+    """
+
+    slots: int
+    freeSlots: int
+    releasedSimId: Optional[str]
+
+
 class Status(SimWorkerMessage):
     message: Literal["status"]
-    data: WorkerStatus
+    data: WorkerCapacity
+
+
+FRAME_HEADER_LEN = struct.Struct("<I")
+FRAME_ALIGNMENT = 8
+NDARRAY_KEY = "__ndarray__"
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // FRAME_ALIGNMENT) * FRAME_ALIGNMENT
+
+
+def extract_arrays(obj: Any, arrays: List[np.ndarray]) -> Any:
+    if isinstance(obj, np.ndarray):
+        arrays.append(obj)
+        return {NDARRAY_KEY: len(arrays) - 1}
+    if isinstance(obj, dict):
+        return {key: extract_arrays(value, arrays) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [extract_arrays(value, arrays) for value in obj]
+    return obj
+
+
+def insert_arrays(obj: Any, arrays: List[np.ndarray]) -> Any:
+    if isinstance(obj, dict):
+        if NDARRAY_KEY in obj:
+            return arrays[obj[NDARRAY_KEY]]
+        return {key: insert_arrays(value, arrays) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [insert_arrays(value, arrays) for value in obj]
+    return obj
+
+
+def encode_frame(message: dict) -> bytes:
+    """Encode a message into a binary frame with NumPy arrays sent as raw little-endian buffers.
+
+    Frame layout:
+        uint32 LE: length of the JSON header
+        JSON header: message with arrays replaced by {"__ndarray__": idx} plus array descriptors
+        array buffers, each starting at an offset aligned to 8 bytes
+    """
+    arrays: List[np.ndarray] = []
+    header = extract_arrays(message, arrays)
+    arrays = [np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")) for array in arrays]
+
+    descriptors = []
+    offset = 0
+    for array in arrays:
+        offset = _aligned(offset)
+        descriptors.append({"dtype": array.dtype.str, "shape": array.shape, "offset": offset})
+        offset += array.nbytes
+
+    header_bytes = json.dumps({**header, "arrays": descriptors}, cls=ExtendedJSONEncoder).encode("utf-8")
+    data_start = _aligned(FRAME_HEADER_LEN.size + len(header_bytes))
+
+    buffers: List[Union[bytes, memoryview]] = [
+        FRAME_HEADER_LEN.pack(len(header_bytes)),
+        header_bytes,
+        bytes(data_start - FRAME_HEADER_LEN.size - len(header_bytes)),
+    ]
+    position = 0
+    for array, descriptor in zip(arrays, descriptors):
+        buffers.append(bytes(descriptor["offset"] - position))
+        buffers.append(array.reshape(-1).view(np.uint8).data)
+        position = descriptor["offset"] + array.nbytes
+
+    return b"".join(buffers)
+
+
+def decode_frame(frame: bytes) -> dict:
+    """Decode a binary frame, arrays are read-only views into the frame buffer."""
+    (header_len,) = FRAME_HEADER_LEN.unpack_from(frame)
+    header_end = FRAME_HEADER_LEN.size + header_len
+    header = json.loads(frame[FRAME_HEADER_LEN.size : header_end])
+    data_start = _aligned(header_end)
+
+    arrays = []
+    for descriptor in header.pop("arrays"):
+        dtype = np.dtype(descriptor["dtype"])
+        shape = descriptor["shape"]
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(frame, dtype=dtype, count=count, offset=data_start + descriptor["offset"])
+        arrays.append(array.reshape(shape))
+
+    return insert_arrays(header, arrays)
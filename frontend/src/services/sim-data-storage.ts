@@ -21,15 +21,18 @@ function getSimStore(simId: str) {
   return store
 }
 
-bus.$on('ws:simLogMessage', (logMsg: {}) => {
-  if (!get(cache, `${logMsg.simId}.log.${logMsg.source}`)) {
-    set(cache, `${logMsg.simId}.log.${logMsg.source}`, [logMsg.message])
-  } else {
-    cache[logMsg.simId].log[logMsg.source].push(logMsg.message)
+bus.$on('ws:simLogBatch', (logBatch: {}) => {
+  // eslint-disable-next-line
+  for (const [source, lines] of Object.entries(logBatch.lines)) {
+    if (!get(cache, `${logBatch.simId}.log.${source}`)) {
+      set(cache, `${logBatch.simId}.log.${source}`, lines)
+    } else {
+      cache[logBatch.simId].log[source].push(...lines)
+    }
   }
 
-  const watcherCb = get(watcher, `${logMsg.simId}.log`, noop)
-  watcherCb(cache[logMsg.simId].log)
+  const watcherCb = get(watcher, `${logBatch.simId}.log`, noop)
+  watcherCb(cache[logBatch.simId].log)
 })
 
 bus.$on('ws:simTrace', (trace: SimTrace) => {
@@ -114,17 +117,23 @@ export async function requestTrace(simId: str) {
   return trace
 }
 
+export async function requestTraceWindow(simId: str, resolution: number, tStart?: number, tEnd?: number) {
+  return socket.request('get_trace_window', { simId, resolution, tStart, tEnd })
+}
+
 export function getTrace(simId: str) {
   return get(cache, `${simId}.trace`)
 }
 
-export function subscribeSpatialTrace(simId: str, cb: () => any) {
+export function subscribeSpatialTrace(simId: str, cb: () => any, fps = 4) {
   set(watcher, `${simId}.spatialTrace`, cb)
+  socket.send('subscribe_spatial_trace', { simId, fps })
 }
 
 export function unsubscribeSpatialTrace(simId: str) {
   if (get(watcher, `${simId}.spatialTrace`)) {
     delete watcher[simId].spatialTrace
+    socket.send('unsubscribe_spatial_trace', { simId })
   }
 }
 
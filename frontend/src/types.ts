@@ -114,6 +114,14 @@ export interface SimTrace {
   values_by_observable: { [observable: string]: number[] } //eslint-disable-line
 }
 
+export interface TraceWindow {
+  times: number[]
+  binSize: number
+  values_by_observable?: { [observable: string]: number[] } //eslint-disable-line
+  min_by_observable?: { [observable: string]: number[] } //eslint-disable-line
+  max_by_observable?: { [observable: string]: number[] } //eslint-disable-line
+}
+
 export interface Structure {
   name: string
   type: 'compartment' | 'membrane'